@@ -1,18 +1,38 @@
 import os
+import io
+import re
+import csv
+import base64
+import tempfile
+import unicodedata
 import calendar
 import uuid
+import time
+import threading
+import asyncio
+import random
+import heapq
+import bisect
+from itertools import islice
 from flask import Flask, render_template
 from datetime import date
 from werkzeug.utils import secure_filename
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, send_file, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func, extract, desc, cast, String, text, or_, and_
+from sqlalchemy import func, extract, desc, cast, String, text, or_, and_, event, update, insert, tuple_, bindparam, case, select, literal, DDL
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.orm import joinedload, selectinload
 from datetime import datetime, timedelta
 from sqlalchemy.exc import IntegrityError
+from openpyxl import Workbook, load_workbook
 import traceback
+import click
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///database.db') # testes apontam para um banco temporário
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.secret_key = 'printcontrol_secret'
 
@@ -40,6 +60,63 @@ def limpar_float(valor_str):
         return float(limpo)
     except ValueError: return 0.0
 
+def codificar_cursor(*valores):
+    bruto = '|'.join(v.isoformat() if isinstance(v, (datetime, date)) else str(v) for v in valores)
+    return base64.urlsafe_b64encode(bruto.encode()).decode()
+
+def decodificar_cursor(cursor):
+    return base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+
+def paginar_keyset(query, col_data, col_id, cursor=None, limite=50):
+    # Paginação por cursor (data desc, id desc): cada página é uma busca no índice (data, id),
+    # com custo constante independentemente da profundidade
+    if cursor:
+        data_str, id_str = decodificar_cursor(cursor)
+        query = query.filter(tuple_(col_data, col_id) < (datetime.fromisoformat(data_str), int(id_str)))
+    linhas = query.order_by(col_data.desc(), col_id.desc()).limit(limite + 1).all()
+    proximo = None
+    if len(linhas) > limite:
+        linhas = linhas[:limite]
+        ultimo = linhas[-1]
+        proximo = codificar_cursor(getattr(ultimo, col_data.key), getattr(ultimo, col_id.key))
+    return linhas, proximo
+
+def add_months(data, meses):
+    # Soma (ou subtrai) meses de calendário, ajustando o dia ao fim do mês quando necessário
+    total = data.month - 1 + meses
+    ano, mes = data.year + total // 12, total % 12 + 1
+    return data.replace(year=ano, month=mes, day=min(data.day, calendar.monthrange(ano, mes)[1]))
+
+def intervalo_periodo(periodo, hoje=None):
+    # 'mes_atual' | 'mes_passado' | 'todos' -> (inicio, fim) semiaberto, com ano; filtra por faixa no índice de data
+    if periodo == 'todos': return None, None
+    inicio_mes = (hoje or datetime.now()).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    if periodo == 'mes_passado': return add_months(inicio_mes, -1), inicio_mes
+    return inicio_mes, add_months(inicio_mes, 1)
+
+class CacheTTL:
+    # Cache em memória do processo com expiração curta, para leituras repetidas (telas e APIs consultadas em sequência).
+    # Cada processo tem o seu; quem precisa do dado exato passa por cima com atualizar=True.
+    def __init__(self, segundos, maximo=512):
+        self.segundos, self.maximo = segundos, maximo
+        self._dados, self._trava = {}, threading.Lock()
+
+    def obter(self, chave, calcular, atualizar=False):
+        agora = time.monotonic()
+        item = self._dados.get(chave)
+        if item and item[0] > agora and not atualizar: return item[1]
+        valor = calcular()
+        with self._trava:
+            if len(self._dados) >= self.maximo:
+                for k in [k for k, (expira, _) in self._dados.items() if expira <= agora] or list(self._dados)[:self.maximo // 4]: self._dados.pop(k, None)
+            self._dados[chave] = (agora + self.segundos, valor)
+        return valor
+
+    def limpar(self, chave=None):
+        with self._trava:
+            if chave is None: self._dados.clear()
+            else: self._dados.pop(chave, None)
+
 # --- MODELS ---
 class Configuracao(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -71,6 +148,7 @@ class Cliente(db.Model):
     observacao = db.Column(db.Text)
 
 class Produto(db.Model):
+    __table_args__ = (db.Index('ix_produto_alerta', 'ativo', 'quantidade', 'minimo'),)
     id = db.Column(db.Integer, primary_key=True)
     nome = db.Column(db.String(100), nullable=False)
     categoria = db.Column(db.String(50))
@@ -84,9 +162,16 @@ class Produto(db.Model):
     ativo = db.Column(db.Boolean, default=True)
 
 class Venda(db.Model):
+    __table_args__ = (
+        db.Index('ix_venda_data_id', 'data', 'id'),
+        db.Index('ix_venda_cliente_data', 'cliente_id', 'data', 'status_geral', 'valor_total'),
+        # Só as vendas em aberto (contas a receber): cobre os agregados por cliente/vencimento
+        db.Index('ix_venda_aberta', 'cliente_id', 'data_vencimento', 'valor_total', 'status_pagamento', 'status_geral',
+                 sqlite_where=text("status_pagamento != 'Pago' AND status_geral != 'Cancelada'")),
+    )
     id = db.Column(db.Integer, primary_key=True)
     cliente_id = db.Column(db.Integer, db.ForeignKey('cliente.id'), nullable=False)
-    data = db.Column(db.DateTime, default=datetime.now)
+    data = db.Column(db.DateTime, default=datetime.now, index=True)
     valor_total = db.Column(db.Float, default=0.0)
     forma_pagamento = db.Column(db.String(50)) 
     data_vencimento = db.Column(db.Date)
@@ -104,7 +189,7 @@ class Venda(db.Model):
 
 class ItemVenda(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    venda_id = db.Column(db.Integer, db.ForeignKey('venda.id'), nullable=False)
+    venda_id = db.Column(db.Integer, db.ForeignKey('venda.id'), nullable=False, index=True)
     produto_id = db.Column(db.Integer, db.ForeignKey('produto.id'), nullable=False)
     quantidade = db.Column(db.Integer, nullable=False)
     valor_unitario = db.Column(db.Float, nullable=False)
@@ -112,11 +197,17 @@ class ItemVenda(db.Model):
     produto = db.relationship('Produto')
 
 class PedidoSaida(db.Model):
+    __table_args__ = (
+        db.Index('ix_pedido_saida_cliente_data', 'cliente_id', 'data'),
+        db.Index('ix_pedido_saida_data_id', 'data', 'id'),
+        db.Index('ix_pedido_saida_impressora_data', 'impressora_id', 'data'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     numero_pedido = db.Column(db.Integer, unique=True)
     cliente_id = db.Column(db.Integer, db.ForeignKey('cliente.id'), nullable=False)
     data = db.Column(db.DateTime, default=datetime.now)
     impressora = db.Column(db.String(100))
+    impressora_id = db.Column(db.Integer, db.ForeignKey('impressora.id'), nullable=True)
     observacao = db.Column(db.String(200))
     status = db.Column(db.String(20), default='Ativo')
     justificativa_cancelamento = db.Column(db.String(255))
@@ -125,12 +216,19 @@ class PedidoSaida(db.Model):
 
 class ItemPedido(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    pedido_id = db.Column(db.Integer, db.ForeignKey('pedido_saida.id'), nullable=False)
+    pedido_id = db.Column(db.Integer, db.ForeignKey('pedido_saida.id'), nullable=False, index=True)
     produto_id = db.Column(db.Integer, db.ForeignKey('produto.id'), nullable=False)
     quantidade = db.Column(db.Integer, nullable=False)
     produto = db.relationship('Produto')
 
 class Movimentacao(db.Model):
+    __table_args__ = (
+        db.Index('ix_movimentacao_data_id', 'data', 'id'),
+        db.Index('ix_movimentacao_produto_data', 'produto_id', 'data', 'id'),
+        db.Index('ix_movimentacao_tipo_data', 'tipo', 'data', 'id'),
+        db.Index('ix_movimentacao_pedido', 'pedido_id'),
+        db.Index('ix_movimentacao_documento', 'numero_documento'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     produto_id = db.Column(db.Integer, db.ForeignKey('produto.id'), nullable=False)
     tipo = db.Column(db.String(20))
@@ -147,6 +245,7 @@ class Movimentacao(db.Model):
     produto = db.relationship('Produto', backref='movimentacoes')
 
 class Impressora(db.Model):
+    __table_args__ = (db.Index('ix_impressora_cliente_status', 'cliente_id', 'status'),)
     id = db.Column(db.Integer, primary_key=True)
     marca = db.Column(db.String(50))
     modelo = db.Column(db.String(100), nullable=False)
@@ -155,27 +254,36 @@ class Impressora(db.Model):
     contador = db.Column(db.Integer, default=0)
     status = db.Column(db.String(20), default='Disponível')
     localizacao = db.Column(db.String(100), default='Estoque')
+    cliente_id = db.Column(db.Integer, db.ForeignKey('cliente.id'), nullable=True)
     observacao = db.Column(db.Text)
     data_aquisicao = db.Column(db.Date)
+    endereco_ip = db.Column(db.String(60)) # coleta SNMP: 'ip' ou 'ip:porta'
     
     historico = db.relationship('MovimentacaoImpressora', backref='impressora', cascade="all, delete-orphan")
     manutencoes = db.relationship('Manutencao', backref='impressora', cascade="all, delete-orphan")
     logs_manutencao = db.relationship('LogManutencao', backref='impressora', cascade="all, delete-orphan")
+    cliente = db.relationship('Cliente')
 
 class MovimentacaoImpressora(db.Model):
+    __table_args__ = (
+        db.Index('ix_mov_impressora_destino_cliente', 'impressora_id', 'destino_cliente_id', 'data'),
+        db.Index('ix_mov_impressora_data', 'impressora_id', 'data', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     impressora_id = db.Column(db.Integer, db.ForeignKey('impressora.id'), nullable=False)
-    data = db.Column(db.DateTime, default=datetime.now)
+    data = db.Column(db.DateTime, default=datetime.now, index=True)
     tipo = db.Column(db.String(50)) 
     origem = db.Column(db.String(100))
     destino = db.Column(db.String(100))
+    origem_cliente_id = db.Column(db.Integer, db.ForeignKey('cliente.id'), nullable=True)
+    destino_cliente_id = db.Column(db.Integer, db.ForeignKey('cliente.id'), nullable=True)
     contador_momento = db.Column(db.Integer)
     usuario = db.Column(db.String(50), default='Admin')
     observacao = db.Column(db.Text)
 
 class Manutencao(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    impressora_id = db.Column(db.Integer, db.ForeignKey('impressora.id'), nullable=False)
+    impressora_id = db.Column(db.Integer, db.ForeignKey('impressora.id'), nullable=False, index=True)
     numero_ordem = db.Column(db.Integer)
     data_inicio = db.Column(db.DateTime, default=datetime.now)
     data_fim = db.Column(db.DateTime)
@@ -184,14 +292,37 @@ class Manutencao(db.Model):
     logs = db.relationship('LogManutencao', backref='manutencao_pai', cascade="all, delete-orphan")
 
 class LogManutencao(db.Model):
+    __table_args__ = (db.Index('ix_log_manutencao_impressora_data', 'impressora_id', 'data', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
-    manutencao_id = db.Column(db.Integer, db.ForeignKey('manutencao.id'), nullable=True) 
+    manutencao_id = db.Column(db.Integer, db.ForeignKey('manutencao.id'), nullable=True, index=True)
     impressora_id = db.Column(db.Integer, db.ForeignKey('impressora.id'), nullable=True)
     data = db.Column(db.DateTime, default=datetime.now)
     titulo = db.Column(db.String(100))
     observacao = db.Column(db.Text)
     usuario = db.Column(db.String(50), default='Admin')
 
+class LeituraContador(db.Model):
+    # Série temporal de contadores (planilhas dos clientes, API, coleta automática); uma leitura por impressora e instante
+    __table_args__ = (db.Index('ix_leitura_contador_impressora_data', 'impressora_id', 'data', unique=True),)
+    id = db.Column(db.Integer, primary_key=True)
+    impressora_id = db.Column(db.Integer, db.ForeignKey('impressora.id'), nullable=False)
+    data = db.Column(db.DateTime, nullable=False)
+    contador_pb = db.Column(db.Integer, nullable=False, default=0)
+    contador_cor = db.Column(db.Integer, nullable=False, default=0)
+    reinicio = db.Column(db.Boolean, default=False) # troca de placa/zeramento: o contador pode recomeçar menor
+    somente_total = db.Column(db.Boolean, default=False) # fonte sem divisão P&B/cor (ex.: SNMP): contador_pb guarda o total
+    origem = db.Column(db.String(20)) # 'Planilha', 'API', 'SNMP'
+
+class NivelToner(db.Model):
+    # Último nível de cada suprimento lido por SNMP (Printer-MIB prtMarkerSupplies), uma linha por impressora e suprimento
+    impressora_id = db.Column(db.Integer, db.ForeignKey('impressora.id'), primary_key=True)
+    indice = db.Column(db.Integer, primary_key=True)
+    descricao = db.Column(db.String(100))
+    capacidade = db.Column(db.Integer)
+    nivel = db.Column(db.Integer) # negativos seguem a MIB: -2 desconhecido, -3 há suprimento
+    percentual = db.Column(db.Float)
+    atualizado_em = db.Column(db.DateTime)
+
 class Fornecedor(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nome = db.Column(db.String(100), nullable=False)
@@ -225,7 +356,7 @@ class ItemPedidoCompra(db.Model):
 
 class Contrato(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    cliente_id = db.Column(db.Integer, db.ForeignKey('cliente.id'), nullable=False)
+    cliente_id = db.Column(db.Integer, db.ForeignKey('cliente.id'), nullable=False, index=True)
     cliente = db.relationship('Cliente', backref='contratos') 
     
     numero_contrato = db.Column(db.String(50))
@@ -256,7 +387,7 @@ class ContratoFranquia(db.Model):
 
 class ContratoItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    contrato_id = db.Column(db.Integer, db.ForeignKey('contrato.id'), nullable=False)
+    contrato_id = db.Column(db.Integer, db.ForeignKey('contrato.id'), nullable=False, index=True)
     impressora_id = db.Column(db.Integer, db.ForeignKey('impressora.id'), nullable=False)
     franquia_id = db.Column(db.Integer, db.ForeignKey('contrato_franquia.id'), nullable=True)
     valor_locacao_unitario = db.Column(db.Float, default=0.0)
@@ -304,6 +435,11 @@ class Banco(db.Model):
     def nome(self): return self.nome_banco # Compatibilidade
 
 class LancamentoFinanceiro(db.Model):
+    __table_args__ = (
+        # Receitas em aberto que não vêm de uma venda (as de venda são lidas pela própria Venda no aging)
+        db.Index('ix_lancamento_receita_aberta', 'venda_id', 'tipo', 'pago', 'data_vencimento', 'valor',
+                 sqlite_where=text("tipo = 'Receita' AND pago = 0 AND venda_id IS NULL")),
+    )
     id = db.Column(db.Integer, primary_key=True)
     descricao = db.Column(db.String(200), nullable=False)
     valor = db.Column(db.Float, nullable=False)
@@ -319,9 +455,10 @@ class LancamentoFinanceiro(db.Model):
     # O backref 'lancamentos_financeiros' deve estar na classe Fornecedor
     
     banco_id = db.Column(db.Integer, db.ForeignKey('banco.id'), nullable=True)
+    venda_id = db.Column(db.Integer, db.ForeignKey('venda.id'), nullable=True, index=True) # receita gerada pelo Módulo de Vendas
     
-    data_vencimento = db.Column(db.Date)
-    data_pagamento = db.Column(db.Date)
+    data_vencimento = db.Column(db.Date, index=True)
+    data_pagamento = db.Column(db.Date, index=True)
     pago = db.Column(db.Boolean, default=False)
     forma_pagamento = db.Column(db.String(50))
     observacao = db.Column(db.Text)
@@ -332,9 +469,1664 @@ class LancamentoFinanceiro(db.Model):
     identificador_recorrencia = db.Column(db.String(50))
 
 
+# ==========================================
+#       SNAPSHOT DE KPIs DO DASHBOARD
+# ==========================================
+# Os números do dashboard ficam pré-calculados em uma linha única (como Configuracao).
+# Cada flush aplica apenas a diferença causada pelos objetos alterados; a linha é
+# reconstruída com agregações SQL só quando não existe ou quando o dia de referência muda.
+
+class DashboardKPI(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    data_referencia = db.Column(db.Date)
+    vendas_mes = db.Column(db.Float, default=0.0)
+    vendas_atrasadas = db.Column(db.Integer, default=0)
+    contratos_ativos = db.Column(db.Integer, default=0)
+    contratos_valor = db.Column(db.Float, default=0.0)
+    itens_alerta = db.Column(db.Integer, default=0)
+    impressoras_disponiveis = db.Column(db.Integer, default=0)
+    impressoras_locadas = db.Column(db.Integer, default=0)
+    impressoras_manutencao = db.Column(db.Integer, default=0)
+    atualizado_em = db.Column(db.DateTime, default=datetime.now)
+
+def _como_data(valor):
+    return valor.date() if isinstance(valor, datetime) else valor
+
+def _kpi_venda(v, ref):
+    inicio_mes = ref.replace(day=1)
+    data_venda = _como_data(v['data']) or ref
+    ativa = v['status_geral'] != 'Cancelada'
+    no_mes = inicio_mes <= data_venda < add_months(inicio_mes, 1)
+    vencimento = _como_data(v['data_vencimento'])
+    return {
+        'vendas_mes': (v['valor_total'] or 0) if (ativa and no_mes) else 0,
+        'vendas_atrasadas': 1 if (v['status_pagamento'] == 'Pendente' and vencimento and vencimento < ref) else 0,
+    }
+
+def _kpi_contrato(c, ref):
+    ativo = c['status'] == 'Ativo'
+    return {'contratos_ativos': 1 if ativo else 0, 'contratos_valor': (c['valor_mensal_total'] or 0) if ativo else 0}
+
+def _kpi_impressora(i, ref):
+    return {
+        'impressoras_disponiveis': 1 if i['status'] == 'Disponível' else 0,
+        'impressoras_locadas': 1 if i['status'] in ('Locada', 'Em Cliente') else 0,
+        'impressoras_manutencao': 1 if i['status'] == 'Manutenção' else 0,
+    }
+
+def estoque_critico(quantidade, minimo, ativo):
+    # Mesma regra de nivel_alerta() (faixa 'Crítico'), para o contador incremental do snapshot
+    return bool(ativo) and quantidade is not None and minimo is not None and quantidade <= minimo
+
+def _kpi_produto(p, ref):
+    return {'itens_alerta': 1 if estoque_critico(p['quantidade'], p['minimo'], p['ativo']) else 0}
+
+KPI_RASTREADOS = {
+    'Venda': (('data', 'valor_total', 'status_geral', 'status_pagamento', 'data_vencimento'), _kpi_venda),
+    'Contrato': (('status', 'valor_mensal_total'), _kpi_contrato),
+    'Impressora': (('status',), _kpi_impressora),
+    'Produto': (('quantidade', 'minimo', 'ativo'), _kpi_produto),
+}
+
+def _valores_antes(obj, campos):
+    estado = sa_inspect(obj)
+    valores = {}
+    for campo in campos:
+        hist = estado.attrs[campo].history
+        if hist.deleted: valores[campo] = hist.deleted[0]
+        elif hist.unchanged: valores[campo] = hist.unchanged[0]
+        else: valores[campo] = getattr(obj, campo)
+    return valores
+
+def ajustar_kpis(conexao, deltas, data_referencia=None):
+    # UPDATE set-based (campo = campo + delta): sem corrida entre requisições simultâneas
+    deltas = {k: v for k, v in deltas.items() if v}
+    if not deltas: return
+    valores = {k: getattr(DashboardKPI, k) + v for k, v in deltas.items()}
+    valores['atualizado_em'] = datetime.now()
+    stmt = update(DashboardKPI).values(**valores)
+    if data_referencia: stmt = stmt.where(DashboardKPI.data_referencia == data_referencia)
+    conexao.execute(stmt)
+
+@event.listens_for(db.session, 'after_flush')
+def _atualizar_kpis_no_flush(session, flush_context):
+    try:
+        ref = datetime.now().date()
+        deltas = {}
+        def somar(contrib, sinal):
+            for k, v in contrib.items(): deltas[k] = deltas.get(k, 0) + sinal * v
+
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            regra = KPI_RASTREADOS.get(type(obj).__name__)
+            if not regra: continue
+            campos, calcular = regra
+            depois = {c: getattr(obj, c) for c in campos}
+            if obj in session.new:
+                somar(calcular(depois, ref), 1)
+            elif obj in session.deleted:
+                somar(calcular(_valores_antes(obj, campos), ref), -1)
+            elif session.is_modified(obj, include_collections=False):
+                somar(calcular(_valores_antes(obj, campos), ref), -1)
+                somar(calcular(depois, ref), 1)
+
+        # Só aplica sobre o snapshot do dia; um snapshot antigo será reconstruído na leitura
+        ajustar_kpis(session.connection(), deltas, data_referencia=ref)
+    except Exception as e: print(f"Erro KPI: {e}")
+
+def recalcular_kpis(kpi, hoje):
+    # Reconstrução completa, apenas com agregações no banco (sem carregar objetos)
+    inicio_mes = hoje.replace(day=1)
+    kpi.data_referencia = hoje
+    kpi.vendas_mes = db.session.query(func.coalesce(func.sum(Venda.valor_total), 0)).filter(
+        Venda.data >= inicio_mes, Venda.data < add_months(inicio_mes, 1), Venda.status_geral != 'Cancelada').scalar()
+    kpi.vendas_atrasadas = db.session.query(func.count(Venda.id)).filter(
+        Venda.status_pagamento == 'Pendente', Venda.data_vencimento < hoje).scalar()
+    kpi.contratos_ativos, kpi.contratos_valor = db.session.query(
+        func.count(Contrato.id), func.coalesce(func.sum(Contrato.valor_mensal_total), 0)).filter(Contrato.status == 'Ativo').one()
+    kpi.itens_alerta = db.session.query(func.count(Produto.id)).filter(Produto.ativo == True, Produto.quantidade <= Produto.minimo).scalar()
+    por_status = dict(db.session.query(Impressora.status, func.count(Impressora.id)).group_by(Impressora.status).all())
+    kpi.impressoras_disponiveis = por_status.get('Disponível', 0)
+    kpi.impressoras_locadas = por_status.get('Locada', 0) + por_status.get('Em Cliente', 0)
+    kpi.impressoras_manutencao = por_status.get('Manutenção', 0)
+    kpi.atualizado_em = datetime.now()
+    return kpi
+
+def invalidar_kpis():
+    # Para gravações em lote que não passam pelo flush do ORM: força a reconstrução na próxima leitura
+    db.session.execute(update(DashboardKPI).values(data_referencia=None))
+
+def obter_kpis():
+    hoje = datetime.now().date()
+    kpi = DashboardKPI.query.order_by(DashboardKPI.id).first()
+    if kpi and kpi.data_referencia == hoje: return kpi
+    if not kpi:
+        # id fixo: duas primeiras leituras simultâneas (widgets em paralelo) não criam duas linhas
+        db.session.execute(insert(DashboardKPI).prefix_with('OR IGNORE').values(id=1))
+        kpi = db.session.get(DashboardKPI, 1)
+    recalcular_kpis(kpi, hoje)
+    db.session.commit()
+    return kpi
+
+
+
 
 
 
+# ==========================================
+#     FECHAMENTO DE ESTOQUE (SALDOS POR DATA)
+# ==========================================
+# Produto.quantidade/valor_pago só guardam o saldo atual. O fechamento grava, para cada
+# produto, quantidade e custo médio em um instante (data_corte); o saldo em qualquer data
+# passada parte do fechamento anterior mais próximo e reaplica só as movimentações seguintes.
+# Movimentações canceladas são ignoradas (o cancelamento devolve o estoque).
+
+class FechamentoEstoque(db.Model):
+    __table_args__ = (db.Index('ix_fechamento_estoque_corte_produto', 'data_corte', 'produto_id', unique=True),)
+    id = db.Column(db.Integer, primary_key=True)
+    data_corte = db.Column(db.DateTime, nullable=False)
+    produto_id = db.Column(db.Integer, db.ForeignKey('produto.id'), nullable=False)
+    quantidade = db.Column(db.Integer, default=0)
+    custo_medio = db.Column(db.Float, default=0.0)
+    criado_em = db.Column(db.DateTime, default=datetime.now)
+
+def estoque_em(data_alvo, produto_ids=None):
+    # Saldo (quantidade, custo médio) de cada produto no instante data_alvo (exclusivo)
+    corte = db.session.query(func.max(FechamentoEstoque.data_corte)).filter(FechamentoEstoque.data_corte <= data_alvo).scalar()
+    saldos = {}
+    if corte:
+        base = db.session.query(FechamentoEstoque.produto_id, FechamentoEstoque.quantidade, FechamentoEstoque.custo_medio).filter(FechamentoEstoque.data_corte == corte)
+        if produto_ids is not None: base = base.filter(FechamentoEstoque.produto_id.in_(produto_ids))
+        saldos = {p_id: [qtd or 0, custo or 0.0] for p_id, qtd, custo in base}
+
+    saldos = replay_custo_medio(_movs_custo(produto_ids, desde=corte, ate=data_alvo), saldos)
+    return {p_id: {'quantidade': qtd, 'custo_medio': custo, 'valor': max(qtd, 0) * custo} for p_id, (qtd, custo) in saldos.items()}
+
+def fechar_estoque(data_corte=None):
+    # Sem data: fotografa o saldo atual dos produtos. Com data: reconstrói o saldo naquele instante.
+    if data_corte is None:
+        recalcular_custos(incremental=True)
+        data_corte = datetime.now()
+        saldos = {p_id: {'quantidade': qtd or 0, 'custo_medio': custo or 0.0} for p_id, qtd, custo in db.session.query(Produto.id, Produto.quantidade, Produto.valor_pago)}
+    else:
+        saldos = estoque_em(data_corte)
+    FechamentoEstoque.query.filter(FechamentoEstoque.data_corte == data_corte).delete()
+    linhas = [{'data_corte': data_corte, 'produto_id': p_id, 'quantidade': s['quantidade'], 'custo_medio': s['custo_medio'], 'criado_em': datetime.now()} for p_id, s in saldos.items()]
+    if linhas: db.session.execute(insert(FechamentoEstoque), linhas)
+    registrar_log('Fechamento Estoque', f'Fechamento em {data_corte.strftime("%d/%m/%Y %H:%M")} com {len(linhas)} produtos.')
+    db.session.commit()
+    return data_corte, len(linhas)
+
+@app.cli.command('fechar_estoque')
+@click.option('--data', 'data_str', default=None, help='Data do fechamento (AAAA-MM-DD). Padrão: virada do mês atual.')
+def fechar_estoque_cmd(data_str):
+    # Para agendar (cron) no dia 1º: "flask --app app fechar_estoque" fecha o mês anterior
+    data_corte = datetime.strptime(data_str, '%Y-%m-%d') + timedelta(days=1) if data_str else datetime.combine(datetime.now().date().replace(day=1), datetime.min.time())
+    corte, total = fechar_estoque(data_corte)
+    print(f"Fechamento em {corte} gravado para {total} produtos.")
+
+# ==========================================
+#     CUSTO MÉDIO (RECÁLCULO EM LOTE)
+# ==========================================
+# O custo médio gravado em Produto.valor_pago é corrigido em tempo real pelas rotas, mas editar ou
+# cancelar uma entrada antiga muda todo o caminho seguinte. Aqui o custo é refeito a partir do ledger,
+# em ordem cronológica, para todos os produtos de uma vez: a k-ésima movimentação de cada produto
+# é aplicada numa única operação numpy (passo k). Regra: só Entrada com valor muda o custo
+# (média ponderada com o saldo positivo anterior); as demais movimentações só mexem na quantidade.
+# Cada gravação no ledger marca o produto em CustoPendente; o modo incremental refaz só esses.
+
+class CustoPendente(db.Model):
+    produto_id = db.Column(db.Integer, db.ForeignKey('produto.id'), primary_key=True)
+    marcado_em = db.Column(db.DateTime, default=datetime.now)
+
+def replay_custo_medio(movs, saldos=None):
+    # movs: DataFrame [produto_id, tipo, quantidade, valor] em ordem cronológica; saldos: {produto_id: [qtd, custo]} iniciais
+    saldos = saldos or {}
+    ids = pd.Index(sorted(set(saldos) | set(movs['produto_id'].unique())))
+    qtd = np.zeros(len(ids)); custo = np.zeros(len(ids))
+    if saldos:
+        pos_ini = ids.get_indexer(list(saldos))
+        qtd[pos_ini] = [s[0] for s in saldos.values()]; custo[pos_ini] = [s[1] for s in saldos.values()]
+    if len(movs):
+        pos = ids.get_indexer(movs['produto_id'])
+        passo = movs.groupby('produto_id').cumcount().to_numpy()
+        ordem = np.argsort(passo, kind='stable')
+        limites = np.searchsorted(passo[ordem], np.arange(passo.max() + 2))
+        entrada = (movs['tipo'] == 'Entrada').to_numpy()[ordem]
+        n = movs['quantidade'].fillna(0).to_numpy(dtype=float)[ordem]
+        valor = movs['valor'].fillna(0).to_numpy(dtype=float)[ordem]
+        pos = pos[ordem]
+        for k in range(len(limites) - 1):
+            sl = slice(limites[k], limites[k + 1])
+            p, q, c, e, nk, vk = pos[sl], qtd[pos[sl]], custo[pos[sl]], entrada[sl], n[sl], valor[sl]
+            base = np.maximum(q, 0)
+            com_valor = e & (vk != 0) & (q + nk > 0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                custo[p] = np.where(com_valor, (base * c + nk * vk) / (base + nk), c)
+            qtd[p] = q + np.where(e, nk, -nk)
+    return {int(p_id): [int(q), float(c)] for p_id, q, c in zip(ids, qtd, custo)}
+
+def _movs_custo(produto_ids=None, desde=None, ate=None):
+    m = Movimentacao
+    stmt = select(m.produto_id, m.tipo, m.quantidade, m.valor_unitario_entrada).where(or_(m.status != 'Cancelado', m.status == None))
+    if produto_ids is not None: stmt = stmt.where(m.produto_id.in_(list(produto_ids)))
+    if desde is not None: stmt = stmt.where(m.data >= desde)
+    if ate is not None: stmt = stmt.where(m.data < ate)
+    return pd.DataFrame(db.session.execute(stmt.order_by(m.data, m.id)).all(), columns=['produto_id', 'tipo', 'quantidade', 'valor'])
+
+def marcar_custo_pendente(conexao, produto_ids):
+    ids = {p for p in produto_ids if p is not None}
+    if ids: conexao.execute(insert(CustoPendente.__table__).prefix_with('OR REPLACE'), [{'produto_id': p, 'marcado_em': datetime.now()} for p in ids])
+
+@event.listens_for(db.session, 'after_flush')
+def _marcar_custo_no_flush(session, flush_context):
+    try:
+        ids = set()
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if not isinstance(obj, Movimentacao): continue
+            if obj in session.dirty and not session.is_modified(obj, include_collections=False): continue
+            ids.update({obj.produto_id, _valores_antes(obj, ('produto_id',))['produto_id']})
+        if ids: marcar_custo_pendente(session.connection(), ids)
+    except Exception as e: print(f"Erro custo pendente: {e}")
+
+def recalcular_custos(incremental=True, produto_ids=None):
+    # incremental: só os produtos marcados em CustoPendente; completo: todo o catálogo; produto_ids: só esses (telas que alteram o histórico)
+    inicio = datetime.now()
+    if produto_ids is not None:
+        ids, incremental = list({p for p in produto_ids if p is not None}), True
+        if not ids: return {'produtos': 0, 'alterados': 0, 'divergencias': 0}
+    elif incremental:
+        ids = db.session.execute(select(CustoPendente.produto_id)).scalars().all()
+        if not ids: return {'produtos': 0, 'alterados': 0, 'divergencias': 0}
+    else:
+        ids = db.session.execute(select(Produto.id)).scalars().all()
+    # Parte do último fechamento (saldo de abertura de produtos legados); sem fechamento, do zero
+    corte = db.session.query(func.max(FechamentoEstoque.data_corte)).scalar()
+    iniciais = {p_id: [0, 0.0] for p_id in ids}
+    if corte:
+        base = select(FechamentoEstoque.produto_id, FechamentoEstoque.quantidade, FechamentoEstoque.custo_medio).where(FechamentoEstoque.data_corte == corte)
+        if incremental: base = base.where(FechamentoEstoque.produto_id.in_(ids))
+        iniciais.update({p_id: [qtd or 0, custo or 0.0] for p_id, qtd, custo in db.session.execute(base)})
+    saldos = replay_custo_medio(_movs_custo(ids if incremental else None, desde=corte), iniciais)
+    atuais = db.session.execute(select(Produto.id, Produto.quantidade, Produto.valor_pago).where(Produto.id.in_(ids)) if incremental else select(Produto.id, Produto.quantidade, Produto.valor_pago)).all()
+    alterar, divergencias = [], 0
+    for p_id, qtd_atual, custo_atual in atuais:
+        qtd, custo = saldos.get(p_id, [0, 0.0])
+        # Saldo que o ledger não explica (estoque anterior às movimentações): o custo atual é mantido
+        if qtd != (qtd_atual or 0): divergencias += 1; continue
+        # Sem entradas valorizadas o replay não tem custo a oferecer: nunca zera um custo existente
+        if custo == 0 and custo_atual: continue
+        if abs(custo - (custo_atual or 0.0)) > 1e-6: alterar.append({'p_id': p_id, 'p_custo': round(float(custo), 6)})
+    if alterar:
+        t = Produto.__table__
+        db.session.execute(update(t).where(t.c.id == bindparam('p_id')).values(valor_pago=bindparam('p_custo')), alterar)
+        invalidar_custo_pagina(db.session.connection())
+    # Só limpa as marcas anteriores ao início: gravações feitas durante o recálculo ficam para a próxima rodada
+    db.session.execute(CustoPendente.__table__.delete().where(CustoPendente.produto_id.in_(ids), CustoPendente.marcado_em <= inicio) if incremental else CustoPendente.__table__.delete().where(CustoPendente.marcado_em <= inicio))
+    if produto_ids is None and (alterar or not incremental):
+        registrar_log('Custo Médio', f"Recálculo {'incremental' if incremental else 'completo'}: {len(atuais)} produtos, {len(alterar)} custos corrigidos, {divergencias} saldos divergentes do ledger (custo mantido).")
+    db.session.commit()
+    return {'produtos': len(atuais), 'alterados': len(alterar), 'divergencias': divergencias}
+
+def refazer_custo_produtos(produto_ids):
+    # Após cancelar/editar uma movimentação já gravada: refaz só os produtos dela. Falha aqui não desfaz a operação
+    # (já confirmada); o produto continua marcado e o lote (CLI ou /configuracoes) corrige depois.
+    try: recalcular_custos(produto_ids=produto_ids)
+    except Exception as e: db.session.rollback(); print(f"Erro recalculo custo: {e}")
+
+@app.cli.command('recalcular_custos')
+@click.option('--completo', is_flag=True, help='Recalcula todos os produtos (padrão: só os alterados desde a última execução).')
+def recalcular_custos_cmd(completo):
+    r = recalcular_custos(incremental=not completo)
+    print(f"Custo médio: {r['produtos']} produtos, {r['alterados']} corrigidos, {r['divergencias']} saldos divergentes do ledger (custo mantido).")
+
+# ==========================================
+#     CONSUMO MENSAL (ROLLUPS)
+# ==========================================
+# Totais por (produto, mês, tipo) e (cliente, mês) mantidos junto com as gravações: cada flush
+# recalcula só as chaves tocadas (consultas pelos índices produto/data e cliente/data).
+# Rankings e gráficos de tendência leem estas tabelas em vez do histórico inteiro.
+# Gravações em lote via Core chamam atualizar_consumo_* diretamente; "flask --app app reconstruir_consumo" refaz tudo.
+
+TIPOS_SAIDA = ('Saida_Locacao', 'Venda', 'Ajuste_Saida')
+
+class ConsumoProdutoMensal(db.Model):
+    __table_args__ = (
+        db.Index('ix_consumo_produto_chave', 'produto_id', 'ano_mes', 'tipo', unique=True),
+        db.Index('ix_consumo_produto_mes', 'ano_mes', 'tipo', 'produto_id', 'quantidade'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    produto_id = db.Column(db.Integer, db.ForeignKey('produto.id'), nullable=False)
+    ano_mes = db.Column(db.String(7), nullable=False) # 'AAAA-MM'
+    tipo = db.Column(db.String(20), nullable=False)
+    quantidade = db.Column(db.Integer, default=0)
+    movimentacoes = db.Column(db.Integer, default=0)
+
+class ConsumoClienteMensal(db.Model):
+    __table_args__ = (
+        db.Index('ix_consumo_cliente_chave', 'cliente_id', 'ano_mes', unique=True),
+        db.Index('ix_consumo_cliente_mes', 'ano_mes'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    cliente_id = db.Column(db.Integer, db.ForeignKey('cliente.id'), nullable=False)
+    ano_mes = db.Column(db.String(7), nullable=False)
+    total_itens = db.Column(db.Integer, default=0)
+    total_pedidos = db.Column(db.Integer, default=0)
+
+def ano_mes(data):
+    return data.strftime('%Y-%m') if data else None
+
+def _chaves_por_mes(chaves):
+    # {(id, 'AAAA-MM')} -> {'AAAA-MM': (inicio, fim, [ids])}: um filtro por mês (IN + faixa de data) em vez de um OR por chave
+    meses = {}
+    for c_id, am in chaves:
+        if c_id is not None and am: meses.setdefault(am, set()).add(c_id)
+    resultado = {}
+    for am, ids in meses.items():
+        inicio = datetime.strptime(am, '%Y-%m')
+        resultado[am] = (inicio, add_months(inicio, 1), list(ids))
+    return resultado
+
+def atualizar_consumo_produtos(conexao, chaves):
+    # Regrava os totais das chaves (produto_id, ano_mes) a partir de Movimentacao (canceladas não contam)
+    t, m = ConsumoProdutoMensal.__table__, Movimentacao.__table__
+    for am, (inicio, fim, ids) in _chaves_por_mes(chaves).items():
+        conexao.execute(t.delete().where(t.c.ano_mes == am, t.c.produto_id.in_(ids)))
+        conexao.execute(insert(t).from_select(['produto_id', 'ano_mes', 'tipo', 'quantidade', 'movimentacoes'],
+            select(m.c.produto_id, literal(am), m.c.tipo, func.sum(m.c.quantidade), func.count(m.c.id))
+            .where(m.c.produto_id.in_(ids), m.c.data >= inicio, m.c.data < fim, m.c.tipo != None, or_(m.c.status != 'Cancelado', m.c.status == None))
+            .group_by(m.c.produto_id, m.c.tipo)))
+
+def atualizar_consumo_clientes(conexao, chaves):
+    # Regrava os totais das chaves (cliente_id, ano_mes) a partir dos pedidos de saída ativos
+    t, p, i = ConsumoClienteMensal.__table__, PedidoSaida.__table__, ItemPedido.__table__
+    for am, (inicio, fim, ids) in _chaves_por_mes(chaves).items():
+        conexao.execute(t.delete().where(t.c.ano_mes == am, t.c.cliente_id.in_(ids)))
+        conexao.execute(insert(t).from_select(['cliente_id', 'ano_mes', 'total_itens', 'total_pedidos'],
+            select(p.c.cliente_id, literal(am), func.sum(i.c.quantidade), func.count(func.distinct(p.c.id)))
+            .select_from(p.join(i, i.c.pedido_id == p.c.id))
+            .where(p.c.cliente_id.in_(ids), p.c.data >= inicio, p.c.data < fim, p.c.status == 'Ativo')
+            .group_by(p.c.cliente_id)))
+
+@event.listens_for(db.session, 'after_flush')
+def _atualizar_consumo_no_flush(session, flush_context):
+    try:
+        chaves_produto, chaves_cliente, pedidos = set(), set(), set()
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if obj in session.dirty and not session.is_modified(obj, include_collections=False): continue
+            if isinstance(obj, Movimentacao):
+                antes = _valores_antes(obj, ('produto_id', 'data'))
+                chaves_produto.update({(antes['produto_id'], ano_mes(antes['data'])), (obj.produto_id, ano_mes(obj.data))})
+            elif isinstance(obj, PedidoSaida):
+                antes = _valores_antes(obj, ('cliente_id', 'data'))
+                chaves_cliente.update({(antes['cliente_id'], ano_mes(antes['data'])), (obj.cliente_id, ano_mes(obj.data))})
+            elif isinstance(obj, ItemPedido):
+                pedidos.add(obj.pedido_id)
+        if not (chaves_produto or chaves_cliente or pedidos): return
+        conexao = session.connection()
+        if pedidos:
+            p = PedidoSaida.__table__
+            chaves_cliente.update((c_id, ano_mes(data)) for c_id, data in conexao.execute(select(p.c.cliente_id, p.c.data).where(p.c.id.in_(pedidos))))
+        atualizar_consumo_produtos(conexao, chaves_produto)
+        atualizar_consumo_clientes(conexao, chaves_cliente)
+    except Exception as e: print(f"Erro consumo mensal: {e}")
+
+def reconstruir_consumo():
+    # Backfill / correção: refaz os dois rollups com um INSERT ... SELECT agrupado cada
+    tp, tc = ConsumoProdutoMensal.__table__, ConsumoClienteMensal.__table__
+    m, p, i = Movimentacao.__table__, PedidoSaida.__table__, ItemPedido.__table__
+    mes_mov, mes_ped = func.strftime('%Y-%m', m.c.data), func.strftime('%Y-%m', p.c.data)
+    db.session.execute(tp.delete())
+    db.session.execute(insert(tp).from_select(['produto_id', 'ano_mes', 'tipo', 'quantidade', 'movimentacoes'],
+        select(m.c.produto_id, mes_mov, m.c.tipo, func.sum(m.c.quantidade), func.count(m.c.id))
+        .where(m.c.data != None, m.c.tipo != None, or_(m.c.status != 'Cancelado', m.c.status == None))
+        .group_by(m.c.produto_id, mes_mov, m.c.tipo)))
+    db.session.execute(tc.delete())
+    db.session.execute(insert(tc).from_select(['cliente_id', 'ano_mes', 'total_itens', 'total_pedidos'],
+        select(p.c.cliente_id, mes_ped, func.sum(i.c.quantidade), func.count(func.distinct(p.c.id)))
+        .select_from(p.join(i, i.c.pedido_id == p.c.id))
+        .where(p.c.data != None, p.c.status == 'Ativo')
+        .group_by(p.c.cliente_id, mes_ped)))
+    totais = (db.session.query(func.count(ConsumoProdutoMensal.id)).scalar(), db.session.query(func.count(ConsumoClienteMensal.id)).scalar())
+    registrar_log('Consumo Mensal', f'Rollups reconstruídos: {totais[0]} linhas de produtos, {totais[1]} de clientes.')
+    db.session.commit()
+    return totais
+
+@app.cli.command('reconstruir_consumo')
+def reconstruir_consumo_cmd():
+    produtos, clientes = reconstruir_consumo()
+    print(f"Consumo mensal reconstruído: {produtos} linhas de produtos, {clientes} de clientes.")
+
+# ==========================================
+#     ESTOQUE: ATUALIZAÇÕES ATÔMICAS
+# ==========================================
+# Toda alteração de Produto.quantidade é feita com UPDATE condicional no banco
+# (quantidade = quantidade + delta WHERE quantidade + delta >= 0), nunca com leitura-verificação-gravação
+# em Python: duas requisições simultâneas não conseguem deixar o estoque negativo.
+# Como esses UPDATEs não passam pelo flush do ORM, o contador de alertas do snapshot é ajustado aqui.
+
+def _kpi_alertas_estoque(linhas):
+    # linhas: (quantidade_depois, minimo, ativo, delta) retornadas pelo UPDATE ... RETURNING
+    delta = 0
+    for qtd, minimo, ativo, variacao in linhas:
+        if qtd is None: continue
+        delta += (1 if estoque_critico(qtd, minimo, ativo) else 0) - (1 if estoque_critico(qtd - variacao, minimo, ativo) else 0)
+    ajustar_kpis(db.session.connection(), {'itens_alerta': delta}, data_referencia=datetime.now().date())
+
+def alterar_estoque(variacoes, exigir_saldo=True):
+    # variacoes: {produto_id: delta} (delta negativo = saída). Um único UPDATE para todos os produtos.
+    # Retorna os ids que NÃO foram alterados (saldo insuficiente ou inexistentes); nesse caso o chamador faz rollback.
+    variacoes = {int(p_id): d for p_id, d in variacoes.items() if d}
+    if not variacoes: return []
+    t = Produto.__table__
+    delta = case(variacoes, value=t.c.id)
+    stmt = update(t).where(t.c.id.in_(list(variacoes))).values(quantidade=t.c.quantidade + delta)
+    if exigir_saldo: stmt = stmt.where(t.c.quantidade + delta >= 0)
+    linhas = db.session.execute(stmt.returning(t.c.id, t.c.quantidade, t.c.minimo, t.c.ativo)).all()
+    _kpi_alertas_estoque([(qtd, minimo, ativo, variacoes[p_id]) for p_id, qtd, minimo, ativo in linhas])
+    alterados = {p_id for p_id, _, _, _ in linhas}
+    return [p_id for p_id in variacoes if p_id not in alterados]
+
+def entrada_estoque(produto_id, qtd, custo):
+    # Entrada com custo médio ponderado calculado no próprio UPDATE (usa os valores anteriores da linha)
+    t = Produto.__table__
+    nova_qtd = t.c.quantidade + qtd
+    linha = db.session.execute(update(t).where(t.c.id == produto_id).values(
+        quantidade=nova_qtd,
+        valor_pago=case((nova_qtd > 0, (t.c.quantidade * t.c.valor_pago + qtd * custo) / nova_qtd), else_=t.c.valor_pago)
+    ).returning(t.c.quantidade, t.c.minimo, t.c.ativo)).first()
+    if linha: _kpi_alertas_estoque([(*linha, qtd)])
+    return linha is not None
+
+def somar_itens(pares):
+    # [(produto_id, qtd), ...] -> {produto_id: qtd total}
+    total = {}
+    for p_id, qtd in pares: total[int(p_id)] = total.get(int(p_id), 0) + int(qtd)
+    return total
+
+def nomes_produtos(ids):
+    return ', '.join(nome for (nome,) in db.session.query(Produto.nome).filter(Produto.id.in_(ids))) or 'produto não encontrado'
+
+# ==========================================
+#     BUSCA GLOBAL (SQLITE FTS5)
+# ==========================================
+# Índice de texto único para clientes, impressoras, produtos, pedidos de saída e contratos.
+# O rowid codifica o registro (id * 8 + código do tipo), então atualizar/remover um documento é
+# uma busca pela chave primária. O índice acompanha cada flush; inserts em lote chamam indexar_busca.
+
+BUSCA_DDL = "CREATE VIRTUAL TABLE IF NOT EXISTS busca_global USING fts5(titulo, detalhe, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3 4')"
+event.listen(db.metadata, 'after_create', DDL(BUSCA_DDL))
+
+def _juntar(*partes):
+    return ' · '.join(str(p) for p in partes if p)
+
+BUSCA_FONTES = {
+    'Cliente': (1, lambda: select(Cliente.id, Cliente.nome, Cliente.documento, Cliente.telefone, Cliente.email),
+                lambda r: (r.nome, _juntar(r.documento, r.telefone, r.email))),
+    'Impressora': (2, lambda: select(Impressora.id, Impressora.serial, Impressora.mlt, Impressora.marca, Impressora.modelo, Impressora.localizacao),
+                   lambda r: (_juntar(r.modelo, r.serial), _juntar(r.marca, f'MLT {r.mlt}' if r.mlt else None, r.localizacao))),
+    'Produto': (3, lambda: select(Produto.id, Produto.nome, Produto.marca, Produto.compatibilidade, Produto.categoria),
+                lambda r: (r.nome, _juntar(r.marca, r.compatibilidade, r.categoria))),
+    'PedidoSaida': (4, lambda: select(PedidoSaida.id, PedidoSaida.numero_pedido, Cliente.nome.label('cliente'), PedidoSaida.impressora, PedidoSaida.status).join_from(PedidoSaida, Cliente),
+                    lambda r: (f'Pedido #{r.numero_pedido}', _juntar(r.cliente, r.impressora, r.status))),
+    'Contrato': (5, lambda: select(Contrato.id, Contrato.numero_contrato, Cliente.nome.label('cliente'), Contrato.status).join_from(Contrato, Cliente),
+                 lambda r: (f'Contrato {r.numero_contrato or r.id}', _juntar(r.cliente, r.status))),
+}
+BUSCA_TIPOS = {codigo: tipo for tipo, (codigo, _, _) in BUSCA_FONTES.items()}
+
+def indexar_busca(conexao, ids_por_tipo):
+    # ids_por_tipo: {'Produto': {ids}, ...}; None como conjunto = todos os registros do tipo
+    for tipo, ids in ids_por_tipo.items():
+        codigo, consulta, formatar = BUSCA_FONTES[tipo]
+        stmt = consulta()
+        if ids is not None:
+            ids = [i for i in ids if i is not None]
+            if not ids: continue
+            conexao.execute(text('DELETE FROM busca_global WHERE rowid IN :rowids').bindparams(bindparam('rowids', expanding=True)), {'rowids': [i * 8 + codigo for i in ids]})
+            stmt = stmt.where(stmt.selected_columns.id.in_(ids))
+        docs = []
+        for r in conexao.execute(stmt):
+            titulo, detalhe = formatar(r)
+            docs.append({'rowid': r.id * 8 + codigo, 'titulo': titulo or '', 'detalhe': detalhe or ''})
+        if docs: conexao.execute(text('INSERT INTO busca_global(rowid, titulo, detalhe) VALUES (:rowid, :titulo, :detalhe)'), docs)
+
+@event.listens_for(db.session, 'after_flush')
+def _atualizar_busca_no_flush(session, flush_context):
+    try:
+        pendentes = {}
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            tipo = type(obj).__name__
+            if tipo not in BUSCA_FONTES: continue
+            if obj in session.dirty and not session.is_modified(obj, include_collections=False): continue
+            pendentes.setdefault(tipo, set()).add(obj.id)
+            if tipo == 'Cliente' and obj not in session.new and sa_inspect(obj).attrs.nome.history.has_changes():
+                # Pedidos e contratos exibem o nome do cliente
+                conexao = session.connection()
+                pendentes.setdefault('PedidoSaida', set()).update(conexao.execute(select(PedidoSaida.id).where(PedidoSaida.cliente_id == obj.id)).scalars())
+                pendentes.setdefault('Contrato', set()).update(conexao.execute(select(Contrato.id).where(Contrato.cliente_id == obj.id)).scalars())
+        if pendentes: indexar_busca(session.connection(), pendentes)
+    except Exception as e: print(f"Erro indice de busca: {e}")
+
+def reconstruir_busca():
+    db.session.execute(text('DELETE FROM busca_global'))
+    indexar_busca(db.session.connection(), dict.fromkeys(BUSCA_FONTES))
+    db.session.execute(text("INSERT INTO busca_global(busca_global) VALUES ('optimize')"))
+    db.session.commit()
+
+def consulta_fts(termo):
+    # Cada palavra digitada vira um prefixo ("ab12"*); todas precisam casar. Aspas evitam a sintaxe do FTS5.
+    return ' '.join(f'"{t}"*' for t in re.findall(r'\w+', termo or '')[:8])
+
+def buscar(termo, tipos=None, limite=20):
+    consulta = consulta_fts(termo)
+    if not consulta: return []
+    sql = 'SELECT rowid, titulo, detalhe FROM busca_global WHERE busca_global MATCH :consulta'
+    params = {'consulta': consulta, 'limite': limite}
+    if tipos:
+        sql += ' AND (rowid % 8) IN :codigos'
+        params['codigos'] = [BUSCA_FONTES[t][0] for t in tipos]
+    # bm25: casar no título vale mais que no detalhe
+    stmt = text(sql + ' ORDER BY bm25(busca_global, 10.0, 1.0) LIMIT :limite')
+    if tipos: stmt = stmt.bindparams(bindparam('codigos', expanding=True))
+    return [{'tipo': BUSCA_TIPOS[rowid % 8], 'id': rowid // 8, 'titulo': titulo, 'detalhe': detalhe} for rowid, titulo, detalhe in db.session.execute(stmt, params)]
+
+def ids_busca(tipo, termo):
+    # Subconsulta sem limite para filtros `id IN (...)`: a listagem pagina sobre todos os registros que casam
+    consulta = consulta_fts(termo)
+    if not consulta: return []
+    return text('SELECT rowid / 8 AS id FROM busca_global WHERE busca_global MATCH :consulta AND rowid % 8 = :codigo') \
+        .bindparams(consulta=consulta, codigo=BUSCA_FONTES[tipo][0]).columns(id=db.Integer)
+
+# ==========================================
+#     ALERTAS DE ESTOQUE
+# ==========================================
+# Classificação feita no banco: 'Crítico' (quantidade <= mínimo) e 'Baixo' (até mínimo + margem de
+# atenção da Configuracao). Contagens e listas paginadas saem de consultas agregadas, sem carregar
+# o catálogo. A contagem de críticos também é mantida no snapshot de KPIs (badge e dashboard).
+
+NIVEIS_ALERTA = {'critico': 'Crítico', 'baixo': 'Baixo'}
+
+def margem_alerta():
+    margem = db.session.query(Configuracao.margem_atencao_pct).scalar()
+    return margem if margem is not None else 20
+
+def nivel_alerta(margem):
+    return case((Produto.quantidade <= Produto.minimo, 'Crítico'),
+                (Produto.quantidade <= Produto.minimo * (1 + margem / 100.0), 'Baixo'), else_=None)
+
+def _filtro_alerta(margem):
+    return and_(Produto.ativo == True, Produto.quantidade <= Produto.minimo * (1 + margem / 100.0))
+
+def resumo_alertas(margem=None):
+    margem = margem_alerta() if margem is None else margem
+    nivel = nivel_alerta(margem)
+    contagem = dict(db.session.query(nivel, func.count(Produto.id)).filter(_filtro_alerta(margem)).group_by(nivel).all())
+    critico, baixo = contagem.get('Crítico', 0), contagem.get('Baixo', 0)
+    return {'critico': critico, 'baixo': baixo, 'total': critico + baixo}
+
+def listar_alertas(nivel=None, pagina=1, por_pagina=50, margem=None):
+    # Críticos primeiro; dentro de cada nível, quem está mais abaixo do mínimo
+    margem = margem_alerta() if margem is None else margem
+    expr = nivel_alerta(margem)
+    query = db.session.query(Produto.id, Produto.nome, Produto.marca, Produto.quantidade, Produto.minimo, expr.label('nivel')).filter(_filtro_alerta(margem))
+    if nivel: query = query.filter(expr == NIVEIS_ALERTA[nivel])
+    query = query.order_by((Produto.quantidade > Produto.minimo), (Produto.quantidade - Produto.minimo), Produto.nome, Produto.id)
+    return [r._asdict() for r in query.limit(por_pagina).offset((pagina - 1) * por_pagina)]
+
+# ==========================================
+#     PREVISÃO DE DEMANDA E SUGESTÃO DE COMPRAS
+# ==========================================
+# Vetorizado sobre o catálogo inteiro (numpy/pandas): uma consulta agregada por semana no ledger,
+# uma nos rollups mensais (sazonalidade) e uma nos pedidos de compra (fornecedor, preço, prazo, em trânsito).
+# Consumo semanal = média com peso exponencial; ponto de pedido = consumo no prazo de entrega x sazonalidade
+# + estoque de segurança (z x desvio x raiz do prazo). Sugestão = repor até o ponto de pedido + N semanas de cobertura.
+
+PREVISAO_SEMANAS = 26       # janela do histórico semanal
+PREVISAO_MEIA_VIDA = 8      # semanas: o peso de uma semana cai pela metade a cada 8 semanas
+PREVISAO_Z = 1.65           # ~95% de nível de serviço
+PREVISAO_PRAZO_PADRAO = 7   # dias, para fornecedor sem histórico de entrega
+PREVISAO_COBERTURA = 4      # semanas de consumo compradas além do ponto de pedido
+
+def _fator_sazonal(ids, hoje):
+    # Média do mesmo mês do calendário / média mensal, nos últimos 24 meses (só com 12+ meses de histórico).
+    # Agregado no banco sobre os rollups: uma linha por produto.
+    inicio = add_months(hoje.date().replace(day=1), -24)
+    primeiro_mes, ultimo_mes = ano_mes(inicio), ano_mes(add_months(inicio, 23))
+    mes = f'{hoje.month:02d}'
+    c = ConsumoProdutoMensal
+    linhas = db.session.execute(select(c.produto_id, func.sum(c.quantidade), func.sum(case((func.substr(c.ano_mes, 6, 2) == mes, c.quantidade), else_=0)), func.min(c.ano_mes))
+                                .where(c.tipo.in_(TIPOS_SAIDA), c.ano_mes >= primeiro_mes, c.ano_mes <= ultimo_mes).group_by(c.produto_id)).all()
+    fator = np.ones(len(ids))
+    if not linhas: return fator
+    m = pd.DataFrame(linhas, columns=['produto_id', 'total', 'total_mes', 'primeiro'])
+    linha = ids.get_indexer(m['produto_id'])
+    # Meses efetivamente observados (do primeiro com consumo até o fim da janela) e quantas vezes o mês alvo cai neles
+    ano_ini, mes_ini = m['primeiro'].str[:4].astype(int).to_numpy(), m['primeiro'].str[5:7].astype(int).to_numpy()
+    meses_historico = (int(ultimo_mes[:4]) * 12 + int(ultimo_mes[5:7])) - (ano_ini * 12 + mes_ini) + 1
+    deslocamento = (hoje.month - mes_ini) % 12
+    ocorrencias = np.where(deslocamento < meses_historico, (meses_historico - 1 - deslocamento) // 12 + 1, 0)
+    ok = (linha >= 0) & (m['total'].to_numpy() > 0) & (meses_historico >= 12) & (ocorrencias > 0)
+    razao = (m['total_mes'].to_numpy() / np.maximum(ocorrencias, 1)) / (m['total'].to_numpy() / meses_historico)
+    fator[linha[ok]] = np.clip(razao[ok], 0.5, 2.0)
+    return fator
+
+def prever_demanda(hoje=None, cobertura=PREVISAO_COBERTURA):
+    hoje = hoje or datetime.now()
+    # Janela ancorada no próprio instante: semanas 0..PREVISAO_SEMANAS-1, a última termina em `hoje` (saídas de hoje entram nela)
+    inicio = hoje - timedelta(weeks=PREVISAO_SEMANAS)
+    produtos = pd.DataFrame(db.session.execute(select(Produto.id, Produto.nome, Produto.marca, Produto.quantidade, Produto.minimo, Produto.valor_pago).where(Produto.ativo == True)).all(),
+                            columns=['id', 'nome', 'marca', 'quantidade', 'minimo', 'valor_pago'])
+    if produtos.empty: return produtos
+    produtos[['quantidade', 'minimo', 'valor_pago']] = produtos[['quantidade', 'minimo', 'valor_pago']].fillna(0)
+    ids = pd.Index(produtos['id'])
+
+    # 1) Consumo semanal ponderado (semanas recentes pesam mais) e desvio ponderado.
+    # O banco soma as saídas por (produto, semana) e devolve só os momentos ponderados por produto:
+    # taxa = sum(p_k * x_k), variância = sum(p_k * x_k^2) - taxa^2 (semanas sem saída entram com x = 0).
+    idade = np.arange(PREVISAO_SEMANAS)[::-1]
+    peso = 0.5 ** (idade / PREVISAO_MEIA_VIDA)
+    peso /= peso.sum()
+    m = Movimentacao
+    semana = cast((func.julianday(m.data) - func.julianday(inicio)) / 7, db.Integer)
+    semanal = select(m.produto_id, semana.label('semana'), func.sum(m.quantidade).label('qtd')).where(
+        m.tipo.in_(TIPOS_SAIDA), or_(m.status != 'Cancelado', m.status == None), m.data >= inicio, m.data < hoje
+    ).group_by(m.produto_id, semana).subquery()
+    p_semana = case({k: float(p) for k, p in enumerate(peso)}, value=semanal.c.semana, else_=0.0)
+    linhas = db.session.execute(select(semanal.c.produto_id, func.sum(p_semana * semanal.c.qtd), func.sum(p_semana * semanal.c.qtd * semanal.c.qtd))
+                                .group_by(semanal.c.produto_id)).all()
+    taxa, segundo_momento = np.zeros(len(produtos)), np.zeros(len(produtos))
+    if linhas:
+        s = pd.DataFrame(linhas, columns=['produto_id', 'm1', 'm2'])
+        linha = ids.get_indexer(s['produto_id'])
+        ok = linha >= 0
+        taxa[linha[ok]], segundo_momento[linha[ok]] = s['m1'].to_numpy()[ok], s['m2'].to_numpy()[ok]
+    desvio = np.sqrt(np.clip(segundo_momento - taxa ** 2, 0, None))
+    taxa_ajustada = taxa * _fator_sazonal(ids, hoje)
+
+    # 3) Fornecedor e preço da última compra, prazo médio por fornecedor, quantidade em trânsito
+    compras = pd.DataFrame(db.session.execute(select(ItemPedidoCompra.produto_id, ItemPedidoCompra.quantidade, ItemPedidoCompra.valor_unitario, PedidoCompra.id,
+                                                     PedidoCompra.fornecedor_id, PedidoCompra.status, PedidoCompra.data_emissao, PedidoCompra.data_entrega_prevista)
+                                              .join_from(ItemPedidoCompra, PedidoCompra, ItemPedidoCompra.pedido_id == PedidoCompra.id)
+                                              .where(ItemPedidoCompra.produto_id != None, PedidoCompra.status.notin_(['Cancelado', 'Rascunho']))).all(),
+                           columns=['produto_id', 'quantidade', 'valor_unitario', 'pedido_id', 'fornecedor_id', 'status', 'emissao', 'entrega'])
+    fornecedor = pd.Series(np.nan, index=ids)
+    preco = pd.Series(np.nan, index=ids)
+    transito = pd.Series(0.0, index=ids)
+    prazo_fornecedor = pd.Series(dtype=float)
+    if not compras.empty:
+        ultima = compras.sort_values(['emissao', 'pedido_id']).drop_duplicates('produto_id', keep='last').set_index('produto_id')
+        fornecedor = ultima['fornecedor_id'].reindex(ids)
+        preco = ultima['valor_unitario'].reindex(ids)
+        transito = compras[compras['status'] == 'Pendente'].groupby('produto_id')['quantidade'].sum().reindex(ids).fillna(0)
+        pedidos = compras.drop_duplicates('pedido_id').dropna(subset=['entrega', 'emissao'])
+        if not pedidos.empty:
+            dias = (pd.to_datetime(pedidos['entrega']) - pd.to_datetime(pedidos['emissao'])).dt.days.clip(lower=1)
+            prazo_fornecedor = dias.groupby(pedidos['fornecedor_id']).mean()
+    prazo_dias = fornecedor.map(prazo_fornecedor).fillna(PREVISAO_PRAZO_PADRAO).to_numpy()
+    prazo_semanas = prazo_dias / 7
+
+    # 4) Ponto de pedido e quantidade sugerida
+    ponto_pedido = taxa_ajustada * prazo_semanas + PREVISAO_Z * desvio * np.sqrt(prazo_semanas)
+    alvo = ponto_pedido + taxa_ajustada * cobertura
+    posicao = produtos['quantidade'].to_numpy() + transito.to_numpy()
+    sugerido = np.where((taxa > 0) & (posicao <= ponto_pedido), np.ceil(alvo - posicao), 0).clip(min=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cobertura_atual = np.where(taxa_ajustada > 0, posicao / taxa_ajustada, np.inf)
+
+    produtos['fornecedor_id'] = fornecedor.to_numpy()
+    produtos['consumo_semanal'] = taxa_ajustada.round(2)
+    produtos['desvio_semanal'] = desvio.round(2)
+    produtos['prazo_dias'] = prazo_dias.round(1)
+    produtos['em_transito'] = transito.to_numpy().astype(int)
+    produtos['ponto_pedido'] = np.ceil(ponto_pedido).astype(int)
+    produtos['minimo_sugerido'] = np.ceil(ponto_pedido).astype(int)
+    produtos['cobertura_semanas'] = np.round(cobertura_atual, 1)
+    produtos['sugerido'] = sugerido.astype(int)
+    produtos['valor_unitario'] = preco.fillna(pd.Series(produtos['valor_pago'].to_numpy(), index=ids)).to_numpy()
+    produtos['valor_sugerido'] = produtos['sugerido'] * produtos['valor_unitario']
+    return produtos
+
+def gerar_rascunhos_compra(previsao):
+    # Um PedidoCompra 'Rascunho' por fornecedor; os rascunhos anteriores são substituídos
+    for antigo in PedidoCompra.query.filter_by(status='Rascunho'): db.session.delete(antigo)
+    comprar = previsao[(previsao['sugerido'] > 0) & previsao['fornecedor_id'].notna()]
+    hoje = datetime.now().date()
+    pedidos = []
+    for f_id, grupo in comprar.groupby('fornecedor_id'):
+        prazo = int(round(grupo['prazo_dias'].max()))
+        pedido = PedidoCompra(fornecedor_id=int(f_id), status='Rascunho', data_emissao=hoje, data_entrega_prevista=hoje + timedelta(days=prazo),
+                              prazo_pagamento='', frete=0.0, observacao='Rascunho gerado pela sugestão de compras.')
+        for r in grupo.itertuples():
+            pedido.itens.append(ItemPedidoCompra(produto_id=int(r.id), descricao=r.nome, quantidade=int(r.sugerido), valor_unitario=float(r.valor_unitario), valor_total=float(r.valor_sugerido)))
+        pedido.valor_itens = pedido.valor_total = float(grupo['valor_sugerido'].sum())
+        db.session.add(pedido)
+        pedidos.append(pedido)
+    registrar_log('Sugestão de Compras', f'{len(pedidos)} rascunhos de pedido de compra gerados.')
+    db.session.commit()
+    return pedidos
+
+# ==========================================
+#     VÍNCULO PEDIDO DE SAÍDA -> IMPRESSORA
+# ==========================================
+# PedidoSaida.impressora guarda o texto exibido ("Modelo | S/N: serial | MLT: mlt"); as consultas
+# usam impressora_id (índice (impressora_id, data)). Pedidos antigos, só com texto, são vinculados
+# extraindo o serial.
+
+RE_SERIAL_PEDIDO = re.compile(r'S/N:\s*([^|]+)')
+
+def texto_impressora(imp):
+    return f"{imp.modelo} | S/N: {imp.serial} | MLT: {imp.mlt or 'S/M'}"
+
+def _candidatos_serial(texto):
+    m = RE_SERIAL_PEDIDO.search(texto or '')
+    if m: return [m.group(1).strip().upper()]
+    return [t.upper() for t in re.split(r'[\s|()\[\],;]+', texto or '') if t]
+
+def _impressora_do_texto(texto, seriais):
+    # seriais: {SERIAL: id}. Só vincula quando o texto aponta para exatamente uma impressora.
+    achados = {seriais[s] for s in _candidatos_serial(texto) if s in seriais}
+    return achados.pop() if len(achados) == 1 else None
+
+def mapa_seriais(candidatos=None):
+    query = db.session.query(Impressora.serial, Impressora.id).filter(Impressora.serial != None, Impressora.serial != '')
+    if candidatos is not None: query = query.filter(func.upper(func.trim(Impressora.serial)).in_(candidatos))
+    return {serial.strip().upper(): imp_id for serial, imp_id in query}
+
+def resolver_impressora(impressora_id=None, texto=None):
+    # -> (impressora_id, texto). O id informado prevalece e define o texto; texto livre é resolvido pelo serial.
+    if impressora_id:
+        imp = db.session.get(Impressora, int(impressora_id))
+        if imp: return imp.id, texto_impressora(imp)
+    if not texto: return None, texto
+    return _impressora_do_texto(texto, mapa_seriais(_candidatos_serial(texto))), texto
+
+def vincular_pedidos_impressoras(apenas_pendentes=True):
+    # Backfill de impressora_id a partir do texto gravado. Retorna (vinculados, analisados).
+    seriais = mapa_seriais()
+    query = db.session.query(PedidoSaida.id, PedidoSaida.impressora).filter(PedidoSaida.impressora != None, PedidoSaida.impressora != '')
+    if apenas_pendentes: query = query.filter(PedidoSaida.impressora_id == None)
+    pedidos = query.all()
+    vinculos = [{'p_id': p_id, 'p_imp': imp_id} for p_id, texto in pedidos if (imp_id := _impressora_do_texto(texto, seriais))]
+    if vinculos:
+        t = PedidoSaida.__table__
+        db.session.execute(update(t).where(t.c.id == bindparam('p_id')).values(impressora_id=bindparam('p_imp')), vinculos)
+    db.session.commit()
+    return len(vinculos), len(pedidos)
+
+@app.cli.command('vincular_impressoras_pedidos')
+@click.option('--todos', is_flag=True, help='Reprocessa também os pedidos já vinculados.')
+def vincular_impressoras_pedidos_cmd(todos):
+    vinculados, total = vincular_pedidos_impressoras(apenas_pendentes=not todos)
+    print(f"Pedidos de saída vinculados a impressoras: {vinculados} de {total}.")
+
+def insumos_impressora(impressora_id, inicio=None, fim=None):
+    # Uma consulta: pedidos da impressora pelo índice (impressora_id, data) e suas movimentações pelo índice de pedido_id
+    query = db.session.query(Movimentacao.data, Movimentacao.produto_id, Produto.nome, Produto.marca, Movimentacao.quantidade, Movimentacao.numero_documento, PedidoSaida.id) \
+        .join(PedidoSaida, Movimentacao.pedido_id == PedidoSaida.id).join(Produto, Movimentacao.produto_id == Produto.id) \
+        .filter(PedidoSaida.impressora_id == impressora_id, PedidoSaida.status != 'Cancelado', Movimentacao.tipo == 'Saida_Locacao',
+                or_(Movimentacao.status != 'Cancelado', Movimentacao.status == None))
+    if inicio: query = query.filter(Movimentacao.data >= inicio)
+    if fim: query = query.filter(Movimentacao.data < fim)
+    return query.order_by(Movimentacao.data.desc(), Movimentacao.id.desc()).all()
+
+@app.route('/api/impressoras/<int:id>/insumos')
+def api_insumos_impressora(id):
+    # Histórico de suprimentos enviados para a impressora (?data_inicio=AAAA-MM-DD&data_fim=AAAA-MM-DD), com totais por produto
+    impressora = db.session.get(Impressora, id)
+    if not impressora: return jsonify({'erro': 'Impressora não encontrada.'}), 404
+    try:
+        inicio = datetime.strptime(request.args['data_inicio'], '%Y-%m-%d') if request.args.get('data_inicio') else None
+        fim = datetime.strptime(request.args['data_fim'], '%Y-%m-%d') + timedelta(days=1) if request.args.get('data_fim') else None
+    except ValueError as e:
+        return jsonify({'erro': f'Parâmetro inválido: {e}'}), 400
+    linhas = insumos_impressora(id, inicio, fim)
+    totais = {}
+    for _, p_id, nome, marca, qtd, _, _ in linhas:
+        totais.setdefault(p_id, {'produto_id': p_id, 'produto': nome, 'marca': marca, 'quantidade': 0})['quantidade'] += qtd
+    return jsonify({
+        'impressora': {'id': impressora.id, 'modelo': impressora.modelo, 'serial': impressora.serial},
+        'itens': [{'data': d.strftime('%d/%m/%Y %H:%M'), 'produto_id': p_id, 'produto': nome, 'marca': marca, 'qtd': qtd, 'pedido': doc, 'pedido_id': ped_id}
+                  for d, p_id, nome, marca, qtd, doc, ped_id in linhas],
+        'totais': sorted(totais.values(), key=lambda t: -t['quantidade']),
+    })
+
+# ==========================================
+#     LOCAL DAS IMPRESSORAS (CLIENTE_ID)
+# ==========================================
+# O local da impressora é Impressora.cliente_id (None = estoque/assistência); localizacao fica só
+# como texto exibido. As movimentações guardam origem/destino também por id. Bases antigas são
+# migradas casando o nome gravado com o cadastro de clientes.
+
+def mover_impressora_local(imp, cliente=None, local='Estoque'):
+    # Aplica o novo local (FK + nome exibido) e devolve o cliente_id anterior, para a movimentação
+    anterior = imp.cliente_id
+    imp.cliente_id = cliente.id if cliente else None
+    imp.localizacao = cliente.nome if cliente else local
+    return anterior
+
+def vincular_locais_impressoras():
+    # Backfill por nome. Nomes repetidos no cadastro são ambíguos: para a impressora, desempata pelo contrato ativo; senão fica sem vínculo.
+    por_nome = {}
+    for c_id, nome in db.session.query(Cliente.id, Cliente.nome): por_nome.setdefault((nome or '').strip().upper(), []).append(c_id)
+    unico = {nome: ids[0] for nome, ids in por_nome.items() if len(ids) == 1}
+    contrato_ativo = dict(db.session.query(ContratoItem.impressora_id, Contrato.cliente_id).join(Contrato, Contrato.id == ContratoItem.contrato_id).filter(Contrato.status == 'Ativo'))
+    impressoras = []
+    for imp_id, local in db.session.query(Impressora.id, Impressora.localizacao).filter(Impressora.cliente_id == None):
+        chave = (local or '').strip().upper()
+        c_id = contrato_ativo.get(imp_id) if contrato_ativo.get(imp_id) in por_nome.get(chave, []) else unico.get(chave)
+        if c_id: impressoras.append({'p_id': imp_id, 'p_cliente': c_id})
+    t = Impressora.__table__
+    if impressoras: db.session.execute(update(t).where(t.c.id == bindparam('p_id')).values(cliente_id=bindparam('p_cliente')), impressoras)
+    m = MovimentacaoImpressora.__table__
+    movs = [{'p_id': m_id, 'p_origem': unico.get((origem or '').strip().upper()), 'p_destino': unico.get((destino or '').strip().upper())}
+            for m_id, origem, destino in db.session.execute(select(m.c.id, m.c.origem, m.c.destino).where(m.c.origem_cliente_id == None, m.c.destino_cliente_id == None))]
+    movs = [r for r in movs if r['p_origem'] or r['p_destino']]
+    if movs: db.session.execute(update(m).where(m.c.id == bindparam('p_id')).values(origem_cliente_id=bindparam('p_origem'), destino_cliente_id=bindparam('p_destino')), movs)
+    db.session.commit()
+    return len(impressoras), len(movs)
+
+@app.cli.command('vincular_locais_impressoras')
+def vincular_locais_impressoras_cmd():
+    impressoras, movs = vincular_locais_impressoras()
+    print(f"Locais vinculados por cliente_id: {impressoras} impressoras, {movs} movimentações.")
+
+# ==========================================
+#     CUSTO POR PÁGINA
+# ==========================================
+# Páginas impressas entre leituras de contador (MovimentacaoImpressora.contador_momento + o
+# Impressora.contador atual) e custo dos insumos enviados à impressora (pedidos de saída vinculados
+# por impressora_id x Produto.valor_pago), calculados para a frota inteira de uma vez com pandas.
+# O resultado por impressora fica em CustoPaginaImpressora até chegar uma nova leitura ou envio
+# (o flush apaga a tabela); modelo e contrato são agregados por SQL sobre ela.
+
+class CustoPaginaImpressora(db.Model):
+    impressora_id = db.Column(db.Integer, db.ForeignKey('impressora.id'), primary_key=True)
+    leituras = db.Column(db.Integer, default=0)
+    primeira_leitura = db.Column(db.DateTime)
+    ultima_leitura = db.Column(db.DateTime)
+    paginas = db.Column(db.Integer, default=0)
+    paginas_mes = db.Column(db.Float, default=0.0)
+    reinicios = db.Column(db.Integer, default=0)
+    custo_insumos = db.Column(db.Float, default=0.0)
+    custo_por_pagina = db.Column(db.Float)
+    calculado_em = db.Column(db.DateTime, default=datetime.now)
+
+def invalidar_custo_pagina(conexao):
+    conexao.execute(CustoPaginaImpressora.__table__.delete())
+
+CUSTO_PAGINA_CAMPOS = {
+    MovimentacaoImpressora: None, Movimentacao: None, LeituraContador: None,
+    PedidoSaida: ('impressora_id', 'status'), Impressora: ('contador',), Produto: ('valor_pago',),
+}
+
+@event.listens_for(db.session, 'after_flush')
+def _invalidar_custo_pagina_no_flush(session, flush_context):
+    try:
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if type(obj) not in CUSTO_PAGINA_CAMPOS: continue
+            if obj in session.dirty:
+                campos = CUSTO_PAGINA_CAMPOS[type(obj)]
+                if not session.is_modified(obj, include_collections=False): continue
+                if campos and not any(sa_inspect(obj).attrs[c].history.has_changes() for c in campos): continue
+            invalidar_custo_pagina(session.connection())
+            return
+    except Exception as e: print(f"Erro invalidar custo por pagina: {e}")
+
+def _leituras_contador(agora):
+    # Leituras registradas nas movimentações e em LeituraContador (P&B + cor, com a marca de reinício) + o contador atual de cada impressora
+    # (datado no momento do cálculo)
+    m, l = MovimentacaoImpressora, LeituraContador
+    colunas = ['impressora_id', 'data', 'contador', 'reinicio']
+    leituras = pd.DataFrame(db.session.execute(select(m.impressora_id, m.data, m.contador_momento.label('contador'), literal(False))
+                                               .where(m.contador_momento > 0, m.data != None)).all(), columns=colunas)
+    serie = pd.DataFrame(db.session.execute(select(l.impressora_id, l.data, (l.contador_pb + l.contador_cor).label('contador'), func.coalesce(l.reinicio, False))).all(),
+                         columns=colunas)
+    atuais = pd.DataFrame(db.session.execute(select(Impressora.id, Impressora.contador).where(Impressora.contador > 0)).all(), columns=['impressora_id', 'contador'])
+    atuais['data'], atuais['reinicio'] = agora, False
+    return pd.concat([leituras, serie, atuais[colunas]], ignore_index=True)
+
+def _insumos_impressoras():
+    m, p = Movimentacao.__table__, PedidoSaida.__table__
+    return pd.DataFrame(db.session.execute(
+        select(p.c.impressora_id, m.c.data, (m.c.quantidade * func.coalesce(Produto.valor_pago, 0)).label('custo'))
+        .select_from(m.join(p, m.c.pedido_id == p.c.id).join(Produto.__table__, m.c.produto_id == Produto.id))
+        .where(p.c.impressora_id != None, p.c.status != 'Cancelado', m.c.tipo == 'Saida_Locacao', or_(m.c.status != 'Cancelado', m.c.status == None))).all(),
+        columns=['impressora_id', 'data', 'custo'])
+
+def calcular_custo_pagina(leituras, insumos):
+    # leituras[impressora_id, data, contador, reinicio (opcional)], insumos[impressora_id, data, custo] -> DataFrame por impressora.
+    # Páginas = soma das diferenças positivas entre leituras consecutivas (queda sem marca = troca não registrada, não conta).
+    # Leitura marcada como reinício conta o próprio contador (recomeçou do zero), como em volumes_contador.
+    # Custo = insumos enviados dentro da janela [primeira leitura, última leitura].
+    # Datas convertidas explicitamente: frames vazios (frota sem contador) chegam com dtype object
+    leituras = leituras.assign(data=pd.to_datetime(leituras['data'])).sort_values(['impressora_id', 'data', 'contador'])
+    insumos = insumos.assign(data=pd.to_datetime(insumos['data']))
+    dif = leituras.groupby('impressora_id')['contador'].diff()
+    marcado = (leituras['reinicio'].fillna(False).astype(bool) if 'reinicio' in leituras else pd.Series(False, index=leituras.index)) & dif.notna()
+    leituras = leituras.assign(paginas=dif.clip(lower=0).fillna(0).where(~marcado, leituras['contador']), reinicio=(dif < 0) | marcado)
+    por_imp = leituras.groupby('impressora_id').agg(leituras=('contador', 'size'), primeira_leitura=('data', 'min'), ultima_leitura=('data', 'max'),
+                                                    paginas=('paginas', 'sum'), reinicios=('reinicio', 'sum'))
+    janela = insumos.join(por_imp[['primeira_leitura', 'ultima_leitura']], on='impressora_id', how='inner').reset_index(drop=True)
+    janela = janela[(janela['data'] >= janela['primeira_leitura']) & (janela['data'] <= janela['ultima_leitura'])]
+    por_imp['custo_insumos'] = janela.groupby('impressora_id')['custo'].sum().reindex(por_imp.index, fill_value=0.0)
+    dias = (por_imp['ultima_leitura'] - por_imp['primeira_leitura']).dt.total_seconds() / 86400
+    por_imp['paginas_mes'] = np.where(dias >= 1, por_imp['paginas'] / dias.clip(lower=1) * 30.44, 0.0)
+    por_imp['custo_por_pagina'] = np.where(por_imp['paginas'] > 0, por_imp['custo_insumos'] / por_imp['paginas'].where(por_imp['paginas'] > 0, 1), np.nan)
+    return por_imp.reset_index()
+
+def atualizar_custo_pagina(forcar=False):
+    # Recalcula a frota inteira se a tabela estiver vazia (invalidada) ou se forçado
+    if not forcar and db.session.execute(select(CustoPaginaImpressora.impressora_id).limit(1)).first(): return False
+    agora = datetime.now()
+    df = calcular_custo_pagina(_leituras_contador(agora), _insumos_impressoras())
+    linhas = [{'impressora_id': int(r.impressora_id), 'leituras': int(r.leituras), 'primeira_leitura': r.primeira_leitura.to_pydatetime(),
+               'ultima_leitura': r.ultima_leitura.to_pydatetime(), 'paginas': int(r.paginas), 'paginas_mes': round(float(r.paginas_mes), 1),
+               'reinicios': int(r.reinicios), 'custo_insumos': round(float(r.custo_insumos), 2),
+               'custo_por_pagina': None if pd.isna(r.custo_por_pagina) else round(float(r.custo_por_pagina), 6), 'calculado_em': agora}
+              for r in df.itertuples(index=False)]
+    t = CustoPaginaImpressora.__table__
+    db.session.execute(t.delete())
+    if linhas: db.session.execute(insert(t).prefix_with('OR REPLACE'), linhas)
+    db.session.commit()
+    return True
+
+def _cpp(custo, paginas):
+    return round(custo / paginas, 6) if paginas else None
+
+def custo_pagina_por_impressora():
+    c, i = CustoPaginaImpressora, Impressora
+    linhas = db.session.query(c, i.marca, i.modelo, i.serial, i.localizacao).join(i, i.id == c.impressora_id).order_by(i.modelo, i.serial).all()
+    return [{'impressora_id': r.impressora_id, 'marca': marca, 'modelo': modelo, 'serial': serial, 'localizacao': local, 'leituras': r.leituras,
+             'primeira_leitura': r.primeira_leitura.strftime('%d/%m/%Y'), 'ultima_leitura': r.ultima_leitura.strftime('%d/%m/%Y'),
+             'paginas': r.paginas, 'paginas_mes': r.paginas_mes, 'reinicios': r.reinicios, 'custo_insumos': r.custo_insumos, 'custo_por_pagina': r.custo_por_pagina}
+            for r, marca, modelo, serial, local in linhas]
+
+def custo_pagina_por_modelo():
+    c, i = CustoPaginaImpressora, Impressora
+    linhas = db.session.query(i.marca, i.modelo, func.count(c.impressora_id), func.sum(c.paginas), func.sum(c.paginas_mes), func.sum(c.custo_insumos)) \
+        .join(i, i.id == c.impressora_id).group_by(i.marca, i.modelo).order_by(i.marca, i.modelo).all()
+    return [{'marca': marca, 'modelo': modelo, 'impressoras': n, 'paginas': paginas or 0, 'paginas_mes': round(pag_mes or 0, 1),
+             'custo_insumos': round(custo or 0, 2), 'custo_por_pagina': _cpp(custo or 0, paginas)} for marca, modelo, n, paginas, pag_mes, custo in linhas]
+
+def custo_pagina_por_contrato(apenas_ativos=True):
+    # Custo mensal estimado = páginas/mês x custo por página do contrato; margem = valor mensal - custo estimado
+    c, ci = CustoPaginaImpressora, ContratoItem
+    query = db.session.query(Contrato.id, Contrato.numero_contrato, Contrato.status, Contrato.valor_mensal_total, Cliente.nome,
+                             func.count(c.impressora_id), func.sum(c.paginas), func.sum(c.paginas_mes), func.sum(c.custo_insumos)) \
+        .join(ci, ci.contrato_id == Contrato.id).join(c, c.impressora_id == ci.impressora_id).join(Cliente, Cliente.id == Contrato.cliente_id) \
+        .group_by(Contrato.id)
+    if apenas_ativos: query = query.filter(Contrato.status == 'Ativo')
+    resultado = []
+    for c_id, numero, status, valor, cliente, n, paginas, pag_mes, custo in query.order_by(Cliente.nome):
+        cpp = _cpp(custo or 0, paginas)
+        custo_mes = round((pag_mes or 0) * cpp, 2) if cpp is not None else None
+        resultado.append({'contrato_id': c_id, 'numero_contrato': numero, 'status': status, 'cliente': cliente, 'impressoras': n,
+                          'paginas': paginas or 0, 'paginas_mes': round(pag_mes or 0, 1), 'custo_insumos': round(custo or 0, 2), 'custo_por_pagina': cpp,
+                          'valor_mensal': valor or 0.0, 'receita_por_pagina': _cpp(valor or 0.0, pag_mes), 'custo_mensal_estimado': custo_mes,
+                          'margem_mensal_estimada': round((valor or 0.0) - custo_mes, 2) if custo_mes is not None else None})
+    return resultado
+
+CUSTO_PAGINA_AGRUPAMENTOS = {'impressora': custo_pagina_por_impressora, 'modelo': custo_pagina_por_modelo, 'contrato': custo_pagina_por_contrato}
+
+@app.route('/api/custo_pagina')
+def api_custo_pagina():
+    # ?agrupar=impressora|modelo|contrato (padrão: modelo)
+    agrupar = request.args.get('agrupar', 'modelo')
+    if agrupar not in CUSTO_PAGINA_AGRUPAMENTOS: return jsonify({'erro': f"Parâmetro inválido: agrupar deve ser um de {', '.join(CUSTO_PAGINA_AGRUPAMENTOS)}"}), 400
+    try: atualizar_custo_pagina()
+    except Exception as e:
+        db.session.rollback(); print(f"Erro custo por pagina: {e}")
+        return jsonify({'erro': 'Falha ao calcular o custo por página.'}), 500
+    calculado_em = db.session.query(func.max(CustoPaginaImpressora.calculado_em)).scalar()
+    return jsonify({'agrupar': agrupar, 'calculado_em': calculado_em.strftime('%d/%m/%Y %H:%M') if calculado_em else None, 'itens': CUSTO_PAGINA_AGRUPAMENTOS[agrupar]()})
+
+@app.cli.command('calcular_custo_pagina')
+def calcular_custo_pagina_cmd():
+    atualizar_custo_pagina(forcar=True)
+    print(f"Custo por página calculado para {CustoPaginaImpressora.query.count()} impressoras.")
+
+# ==========================================
+#     RESUMO DO CLIENTE (360)
+# ==========================================
+# Tudo o que o atendimento precisa de um cliente em um número fixo de consultas (agregados e listas
+# curtas com limite, pelos índices de cliente_id), independente do tamanho do histórico.
+
+RESUMO_CLIENTE_TTL = CacheTTL(30)
+
+def resumo_cliente(cliente_id, limite=10):
+    cliente = db.session.get(Cliente, cliente_id)
+    if not cliente: return None
+    hoje = datetime.now().date()
+    # Em aberto: mesmo predicado do índice parcial ix_venda_aberta (só percorre as vendas não pagas)
+    vencida = Venda.data_vencimento < hoje
+    receber = db.session.query(func.count(), func.coalesce(func.sum(Venda.valor_total), 0), func.count(case((vencida, 1))),
+                               func.coalesce(func.sum(case((vencida, Venda.valor_total))), 0), func.min(Venda.data_vencimento)) \
+        .filter(Venda.cliente_id == cliente_id, Venda.status_pagamento != 'Pago', Venda.status_geral != 'Cancelada').one()
+    faturado = db.session.query(func.coalesce(func.sum(Venda.valor_total), 0)) \
+        .filter(Venda.cliente_id == cliente_id, Venda.data >= add_months(datetime.now(), -12), Venda.status_geral != 'Cancelada').scalar()
+    ultima_compra = db.session.query(Venda.data).filter(Venda.cliente_id == cliente_id, Venda.status_geral != 'Cancelada').order_by(Venda.data.desc()).limit(1).scalar()
+    qtd_itens = select(func.count(ItemVenda.id)).where(ItemVenda.venda_id == Venda.id).correlate(Venda).scalar_subquery()
+    vendas = db.session.query(Venda.id, Venda.data, Venda.valor_total, Venda.status_pagamento, Venda.status_geral, Venda.data_vencimento, qtd_itens) \
+        .filter(Venda.cliente_id == cliente_id).order_by(Venda.data.desc(), Venda.id.desc()).limit(limite).all()
+    pedidos = PedidoSaida.query.options(selectinload(PedidoSaida.itens).joinedload(ItemPedido.produto)).filter(PedidoSaida.cliente_id == cliente_id) \
+        .order_by(PedidoSaida.data.desc(), PedidoSaida.id.desc()).limit(limite).all()
+    contratos = db.session.query(Contrato.id, Contrato.numero_contrato, Contrato.data_inicio, Contrato.data_fim, Contrato.valor_mensal_total, func.count(ContratoItem.id)) \
+        .outerjoin(ContratoItem, ContratoItem.contrato_id == Contrato.id).filter(Contrato.cliente_id == cliente_id, Contrato.status == 'Ativo').group_by(Contrato.id).all()
+    impressoras = db.session.query(Impressora.id, Impressora.modelo, Impressora.serial, Impressora.mlt, Impressora.status, Impressora.contador) \
+        .filter(Impressora.cliente_id == cliente_id).order_by(Impressora.modelo).all()
+    data_br = lambda d: d.strftime('%d/%m/%Y') if d else None
+    return {
+        'cliente': {'id': cliente.id, 'nome': cliente.nome, 'documento': cliente.documento, 'telefone': cliente.telefone, 'email': cliente.email},
+        'a_receber': {'vendas_abertas': receber[0], 'valor_aberto': round(receber[1], 2), 'vendas_vencidas': receber[2], 'valor_vencido': round(receber[3], 2),
+                      'proximo_vencimento': data_br(receber[4]), 'faturado_12_meses': round(faturado, 2), 'ultima_compra': data_br(ultima_compra)},
+        'vendas_recentes': [{'id': v_id, 'data': data_br(data), 'valor_total': valor, 'status_pagamento': pgto, 'status_geral': geral, 'vencimento': data_br(venc), 'itens': itens}
+                            for v_id, data, valor, pgto, geral, venc, itens in vendas],
+        'saidas_recentes': [{'id': p.id, 'numero_pedido': p.numero_pedido, 'data': data_br(p.data), 'status': p.status, 'impressora': p.impressora,
+                             'itens': [{'produto': i.produto.nome if i.produto else None, 'quantidade': i.quantidade} for i in p.itens]} for p in pedidos],
+        'contratos_ativos': [{'id': c_id, 'numero': numero, 'inicio': data_br(inicio), 'fim': data_br(fim), 'valor_mensal': valor or 0.0, 'impressoras': n}
+                             for c_id, numero, inicio, fim, valor, n in contratos],
+        'valor_mensal_contratos': round(sum(c[4] or 0.0 for c in contratos), 2),
+        'impressoras': [{'id': i_id, 'modelo': modelo, 'serial': serial, 'mlt': mlt, 'status': status, 'contador': contador}
+                        for i_id, modelo, serial, mlt, status, contador in impressoras],
+    }
+
+@app.route('/api/cliente/<int:id>/resumo')
+def api_resumo_cliente(id):
+    # ?atualizar=1 ignora o cache (30 s)
+    dados = RESUMO_CLIENTE_TTL.obter(id, lambda: resumo_cliente(id), atualizar=bool(request.args.get('atualizar')))
+    if dados is None: return jsonify({'erro': 'Cliente não encontrado.'}), 404
+    return jsonify(dados)
+
+# ==========================================
+#     CONTAS A RECEBER (AGING)
+# ==========================================
+# Carteira em aberto por cliente e faixa de atraso (a vencer, 1-30, 31-60, 61-90, 90+ dias) em uma única
+# consulta agrupada: vendas em aberto (índice parcial ix_venda_aberta) unidas às receitas avulsas em aberto
+# (ix_lancamento_receita_aberta). A receita automática de uma venda tem venda_id e não entra duas vezes.
+
+AGING_TTL = CacheTTL(60)
+AGING_FAIXAS = [('a_vencer', 'A vencer'), ('ate_30', '1-30 dias'), ('ate_60', '31-60 dias'), ('ate_90', '61-90 dias'), ('acima_90', '90+ dias')]
+RE_LANCAMENTO_VENDA = re.compile(r'^Venda #(\d+)\b')
+
+def vincular_lancamentos_vendas():
+    # Backfill: receitas automáticas antigas só têm o número da venda na descrição
+    vendas = {v_id for (v_id,) in db.session.query(Venda.id)}
+    t = LancamentoFinanceiro.__table__
+    vinculos = []
+    for l_id, descricao in db.session.execute(select(t.c.id, t.c.descricao).where(t.c.venda_id == None, t.c.tipo == 'Receita', t.c.descricao.like('Venda #%'))):
+        m = RE_LANCAMENTO_VENDA.match(descricao or '')
+        if m and int(m.group(1)) in vendas: vinculos.append({'p_id': l_id, 'p_venda': int(m.group(1))})
+    if vinculos: db.session.execute(update(t).where(t.c.id == bindparam('p_id')).values(venda_id=bindparam('p_venda')), vinculos)
+    db.session.commit()
+    return len(vinculos)
+
+def consulta_aging(hoje):
+    abertos = select(Venda.cliente_id.label('cliente_id'), Venda.data_vencimento.label('vencimento'), Venda.valor_total.label('valor')) \
+        .where(Venda.status_pagamento != 'Pago', Venda.status_geral != 'Cancelada') \
+        .union_all(select(literal(None).label('cliente_id'), LancamentoFinanceiro.data_vencimento, LancamentoFinanceiro.valor)
+                   .where(LancamentoFinanceiro.tipo == 'Receita', LancamentoFinanceiro.pago == False, LancamentoFinanceiro.venda_id == None)).subquery()
+    venc = abertos.c.vencimento
+    limites = [hoje - timedelta(days=d) for d in (30, 60, 90)]
+    condicoes = [or_(venc == None, venc >= hoje), and_(venc < hoje, venc >= limites[0]), and_(venc < limites[0], venc >= limites[1]),
+                 and_(venc < limites[1], venc >= limites[2]), venc < limites[2]]
+    faixas = [func.coalesce(func.sum(case((cond, abertos.c.valor))), 0.0) for cond in condicoes]
+    total = func.coalesce(func.sum(abertos.c.valor), 0.0)
+    return db.session.query(abertos.c.cliente_id, func.coalesce(Cliente.nome, 'Lançamentos avulsos'), Cliente.documento, *faixas, total, func.count(),
+                            func.min(venc)) \
+        .outerjoin(Cliente, Cliente.id == abertos.c.cliente_id).group_by(abertos.c.cliente_id).order_by(total.desc())
+
+def aging_receber(hoje=None):
+    hoje = hoje or datetime.now().date()
+    chaves = [k for k, _ in AGING_FAIXAS]
+    clientes = []
+    for c_id, nome, documento, *valores, total, titulos, mais_antigo in consulta_aging(hoje):
+        linha = {'cliente_id': c_id, 'cliente': nome, 'documento': documento, 'total': round(total, 2), 'titulos': titulos,
+                 'vencimento_mais_antigo': mais_antigo.strftime('%d/%m/%Y') if mais_antigo else None}
+        linha.update({k: round(v, 2) for k, v in zip(chaves, valores)})
+        linha['vencido'] = round(linha['total'] - linha['a_vencer'], 2)
+        clientes.append(linha)
+    totais = {k: round(sum(c[k] for c in clientes), 2) for k in chaves + ['vencido', 'total', 'titulos']}
+    return {'referencia': hoje.strftime('%d/%m/%Y'), 'faixas': [{'chave': k, 'rotulo': r} for k, r in AGING_FAIXAS], 'totais': totais, 'clientes': clientes}
+
+@app.route('/contas_receber')
+def contas_receber():
+    dados = AGING_TTL.obter(datetime.now().date(), aging_receber, atualizar=bool(request.args.get('atualizar')))
+    return render_template('contas_receber.html', **dados)
+
+@app.route('/api/contas_receber/aging')
+def api_aging_receber():
+    # ?atualizar=1 ignora o cache (60 s)
+    return jsonify(AGING_TTL.obter(datetime.now().date(), aging_receber, atualizar=bool(request.args.get('atualizar'))))
+
+@app.cli.command('vincular_lancamentos_vendas')
+def vincular_lancamentos_vendas_cmd():
+    print(f"{vincular_lancamentos_vendas()} lançamentos vinculados às suas vendas.")
+
+# ==========================================
+#     LINHA DO TEMPO DA IMPRESSORA
+# ==========================================
+# Movimentações e diário técnico (LogManutencao) lidos já em ordem pelos índices (impressora_id, data, id) e
+# intercalados com heapq.merge, sem ordenar o histórico em Python: cada fonte traz no máximo uma página.
+# Empates de data são desempatados por (fonte, id), o que dá ao cursor uma ordem total entre as duas fontes.
+
+FONTES_LINHA_DO_TEMPO = {'manutencao': 0, 'movimentacao': 1}
+
+def _fonte_linha_do_tempo(query, col_data, col_id, ordem, posicao, limite):
+    # Tudo o que vem depois de `posicao` (data, ordem, id) na ordem decrescente da linha do tempo
+    if posicao:
+        data_c, ordem_c, id_c = posicao
+        if ordem < ordem_c: query = query.filter(col_data <= data_c)
+        elif ordem > ordem_c: query = query.filter(col_data < data_c)
+        else: query = query.filter(tuple_(col_data, col_id) < (data_c, id_c))
+    query = query.order_by(col_data.desc(), col_id.desc())
+    if limite: query = query.limit(limite + 1)
+    for linha in query.yield_per(200): yield (linha.data, ordem, linha.id), linha
+
+def linha_do_tempo(impressora_id, cursor=None, limite=50, fontes=FONTES_LINHA_DO_TEMPO):
+    # limite=None percorre o histórico inteiro (ainda intercalado pelo banco, sem sort)
+    posicao = None
+    if cursor:
+        data_str, ordem_str, id_str = decodificar_cursor(cursor)
+        posicao = (datetime.fromisoformat(data_str), int(ordem_str), int(id_str))
+    fluxos = []
+    if 'movimentacao' in fontes:
+        m = MovimentacaoImpressora
+        fluxos.append(_fonte_linha_do_tempo(db.session.query(m.id, m.data, m.tipo, m.origem, m.destino, m.contador_momento, m.usuario, m.observacao)
+                                            .filter(m.impressora_id == impressora_id, m.data != None), m.data, m.id, FONTES_LINHA_DO_TEMPO['movimentacao'], posicao, limite))
+    if 'manutencao' in fontes:
+        l = LogManutencao
+        fluxos.append(_fonte_linha_do_tempo(db.session.query(l.id, l.data, l.titulo, l.observacao, l.usuario, l.manutencao_id)
+                                            .filter(l.impressora_id == impressora_id, l.data != None), l.data, l.id, FONTES_LINHA_DO_TEMPO['manutencao'], posicao, limite))
+    intercalado = heapq.merge(*fluxos, key=lambda x: x[0], reverse=True)
+    linhas = list(islice(intercalado, limite + 1) if limite else intercalado)
+    proximo = None
+    if limite and len(linhas) > limite:
+        linhas = linhas[:limite]
+        proximo = codificar_cursor(*linhas[-1][0])
+    # O.S. dos registros técnicos da página em uma consulta IN
+    os_ids = {r.manutencao_id for (_, ordem, _), r in linhas if ordem == FONTES_LINHA_DO_TEMPO['manutencao'] and r.manutencao_id}
+    ordens = {o_id: (numero, status) for o_id, numero, status in
+              db.session.query(Manutencao.id, Manutencao.numero_ordem, Manutencao.status_atual).filter(Manutencao.id.in_(os_ids))} if os_ids else {}
+    itens = []
+    for (data, ordem, _), r in linhas:
+        if ordem == FONTES_LINHA_DO_TEMPO['movimentacao']:
+            itens.append({'categoria': 'movimentacao', 'id': r.id, 'data': data.strftime('%d/%m/%Y %H:%M'), 'tipo': r.tipo, 'origem': r.origem, 'destino': r.destino,
+                          'contador': r.contador_momento, 'usuario': r.usuario, 'observacao': r.observacao})
+        else:
+            numero, status = ordens.get(r.manutencao_id, (None, None))
+            itens.append({'categoria': 'manutencao', 'id': r.id, 'data': data.strftime('%d/%m/%Y %H:%M'), 'titulo': r.titulo, 'observacao': r.observacao,
+                          'usuario': r.usuario, 'os': numero, 'os_status': status})
+    return itens, proximo
+
+@app.route('/api/impressoras/<int:id>/linha_do_tempo')
+def api_linha_do_tempo(id):
+    # ?cursor=&limite=50&fontes=movimentacao,manutencao
+    if not db.session.get(Impressora, id): return jsonify({'erro': 'Impressora não encontrada.'}), 404
+    fontes = {f for f in request.args.get('fontes', '').split(',') if f} or set(FONTES_LINHA_DO_TEMPO)
+    if fontes - set(FONTES_LINHA_DO_TEMPO): return jsonify({'erro': f"Parâmetro inválido: fontes deve conter {', '.join(FONTES_LINHA_DO_TEMPO)}"}), 400
+    limite = min(max(limpar_int(request.args.get('limite')) or 50, 1), 200)
+    try: itens, proximo = linha_do_tempo(id, request.args.get('cursor'), limite, fontes)
+    except (ValueError, TypeError) as e: return jsonify({'erro': f'Cursor inválido: {e}'}), 400
+    return jsonify({'itens': itens, 'proximo_cursor': proximo})
+
+# ==========================================
+#     LEITURAS DE CONTADOR (SÉRIE TEMPORAL)
+# ==========================================
+# Uma linha por leitura (impressora, instante, P&B, cor) no índice único (impressora_id, data). A importação
+# recebe lotes de milhares de leituras (planilha do cliente ou JSON), carrega só a vizinhança já gravada das
+# impressoras do lote e valida a monotonicidade contra ela antes de um único insert em lote. O volume entre
+# duas datas é a soma das diferenças entre leituras consecutivas, a partir da última leitura até o início.
+
+COLUNAS_LEITURAS = {
+    'impressora_id': 'impressora_id', 'id_impressora': 'impressora_id',
+    'serial': 'serial', 'numero_serie': 'serial', 'n_serie': 'serial', 'mlt': 'serial', 'patrimonio': 'serial', 'impressora': 'serial',
+    'data': 'data', 'data_leitura': 'data', 'leitura': 'data',
+    'contador_pb': 'contador_pb', 'pb': 'contador_pb', 'mono': 'contador_pb', 'contador_mono': 'contador_pb', 'contador': 'contador_pb',
+    'contador_total': 'contador_total', 'total': 'contador_total',
+    'contador_cor': 'contador_cor', 'cor': 'contador_cor', 'color': 'contador_cor', 'colorido': 'contador_cor',
+    'reinicio': 'reinicio', 'troca_placa': 'reinicio', 'zerado': 'reinicio',
+}
+
+def _data_leitura(valor):
+    if isinstance(valor, datetime): return valor
+    if isinstance(valor, date): return datetime(valor.year, valor.month, valor.day)
+    texto = str(valor or '').strip()
+    for formato in ('%d/%m/%Y %H:%M', '%d/%m/%Y', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try: return datetime.strptime(texto, formato)
+        except ValueError: pass
+    try: return datetime.fromisoformat(texto)
+    except ValueError: raise ValueError(f'Data inválida: {valor}')
+
+def _leituras_vizinhas(impressora_ids, inicio, fim=None):
+    # Leituras de (inicio, fim) mais a última até `inicio` de cada impressora (uma busca no índice por impressora),
+    # em ordem (impressora_id, data). impressora_ids=None: frota inteira.
+    l = LeituraContador
+    anterior = select(func.max(l.data)).where(l.impressora_id == Impressora.id, l.data <= inicio).correlate(Impressora).scalar_subquery()
+    marcos = select(Impressora.id.label('impressora_id'), anterior.label('data'))
+    periodo = [l.data > inicio] + ([l.data < fim] if fim else [])
+    if impressora_ids is not None:
+        marcos = marcos.where(Impressora.id.in_(impressora_ids))
+        periodo.append(l.impressora_id.in_(impressora_ids))
+    marcos = marcos.subquery()
+    colunas = (l.impressora_id, l.data, l.contador_pb, l.contador_cor, l.reinicio, l.somente_total)
+    anteriores = select(*colunas).join(marcos, and_(l.impressora_id == marcos.c.impressora_id, l.data == marcos.c.data))
+    return db.session.execute(anteriores.union_all(select(*colunas).where(*periodo)).order_by('impressora_id', 'data')).all()
+
+def _contador_ate(a, b):
+    # a <= b para pontos (data, pb, cor, reinicio, somente_total): por canal, ou pelo total quando um dos lados não divide P&B/cor
+    if a[4] or b[4]: return a[1] + a[2] <= b[1] + b[2]
+    return a[1] <= b[1] and a[2] <= b[2]
+
+def _texto_contador(p):
+    return f'total {p[1]}' if p[4] else f'{p[1]}/{p[2]}'
+
+def importar_leituras(registros, origem):
+    # registros: (referência, dict) com impressora_id ou serial/MLT, data, contador_pb, contador_cor (ou só contador_total), reinicio.
+    # Cada leitura precisa ficar entre a anterior e a seguinte da mesma impressora (salvo reinício); repetidas idênticas são ignoradas.
+    relatorio = {'linhas': 0, 'gravadas': 0, 'duplicadas': 0, 'total_erros': 0, 'erros': []}
+    def erro(ref, msg):
+        relatorio['total_erros'] += 1
+        if len(relatorio['erros']) < 500: relatorio['erros'].append({'linha': ref, 'erro': msg})
+
+    agora, validas = datetime.now(), []
+    for ref, bruto in registros:
+        relatorio['linhas'] += 1
+        try:
+            if not isinstance(bruto, dict): raise ValueError('Leitura deve ser um objeto.')
+            d = {'impressora_id': _numero_planilha(bruto.get('impressora_id'), inteiro=True), 'serial': _texto_planilha(bruto.get('serial')),
+                 'data': _data_leitura(bruto.get('data')), 'pb': _numero_planilha(bruto.get('contador_pb'), inteiro=True),
+                 'cor': _numero_planilha(bruto.get('contador_cor'), inteiro=True) or 0,
+                 'reinicio': str(bruto.get('reinicio') or '').strip().lower() in ('1', 'true', 'sim', 's', 'x'), 'somente_total': False}
+            if d['pb'] is None and bruto.get('contador_pb') is None and bruto.get('contador_cor') is None:
+                total = _numero_planilha(bruto.get('contador_total'), inteiro=True)
+                if total is not None: d.update(pb=total, somente_total=True)
+        except (ValueError, TypeError) as e: erro(ref, str(e)); continue
+        if not d['impressora_id'] and not d['serial']: erro(ref, 'Informe impressora_id ou serial.'); continue
+        if d['pb'] is None: erro(ref, 'Contador P&B (ou contador_total) obrigatório.'); continue
+        if d['pb'] < 0 or d['cor'] < 0: erro(ref, 'Contador negativo.'); continue
+        if d['data'] > agora + timedelta(days=1): erro(ref, 'Data de leitura no futuro.'); continue
+        validas.append((ref, d))
+
+    # Impressoras do lote por id e por serial/MLT (sem diferenciar maiúsculas), uma consulta IN cada
+    ids = {d['impressora_id'] for _, d in validas if d['impressora_id']}
+    existentes = {i for (i,) in db.session.query(Impressora.id).filter(Impressora.id.in_(ids))} if ids else set()
+    seriais = {d['serial'].upper() for _, d in validas if not d['impressora_id']}
+    por_serial = {}
+    if seriais:
+        for i, serial, mlt in db.session.query(Impressora.id, Impressora.serial, Impressora.mlt).filter(or_(func.upper(Impressora.serial).in_(seriais), func.upper(Impressora.mlt).in_(seriais))):
+            if mlt: por_serial.setdefault(mlt.strip().upper(), i)
+            if serial: por_serial[serial.strip().upper()] = i
+    por_impressora = {}
+    for ref, d in validas:
+        i = (d['impressora_id'] if d['impressora_id'] in existentes else None) if d['impressora_id'] else por_serial.get(d['serial'].upper())
+        if not i: erro(ref, f"Impressora não encontrada: {d['impressora_id'] or d['serial']}"); continue
+        por_impressora.setdefault(i, []).append((ref, d))
+
+    # Vizinhança já gravada: a partir da última leitura até a mais antiga do lote
+    serie = {}
+    if por_impressora:
+        inicio = min(d['data'] for lista in por_impressora.values() for _, d in lista)
+        for i, data, pb, cor, reinicio, somente_total in _leituras_vizinhas(list(por_impressora), inicio):
+            serie.setdefault(i, []).append((data, pb, cor, bool(reinicio), bool(somente_total)))
+
+    novas, ultimas = [], {}
+    for i, lista in por_impressora.items():
+        pontos = serie.get(i, [])
+        datas = [p[0] for p in pontos]
+        for ref, d in sorted(lista, key=lambda x: x[1]['data']):
+            pos = bisect.bisect_left(datas, d['data'])
+            if pos < len(datas) and datas[pos] == d['data']:
+                if pontos[pos][1:3] == (d['pb'], d['cor']) and pontos[pos][4] == d['somente_total']: relatorio['duplicadas'] += 1
+                else: erro(ref, f"Já existe leitura em {d['data'].strftime('%d/%m/%Y %H:%M')} com outros valores.")
+                continue
+            ponto = (d['data'], d['pb'], d['cor'], d['reinicio'], d['somente_total'])
+            anterior = pontos[pos - 1] if pos > 0 else None
+            seguinte = pontos[pos] if pos < len(pontos) else None
+            if anterior and not d['reinicio'] and not _contador_ate(anterior, ponto):
+                erro(ref, f"Contador menor que a leitura de {anterior[0].strftime('%d/%m/%Y')} ({_texto_contador(anterior)}); marque reinício se houve troca de placa."); continue
+            if seguinte and not seguinte[3] and not _contador_ate(ponto, seguinte):
+                erro(ref, f"Contador maior que a leitura seguinte de {seguinte[0].strftime('%d/%m/%Y')} ({_texto_contador(seguinte)})."); continue
+            pontos.insert(pos, ponto); datas.insert(pos, d['data'])
+            novas.append({'impressora_id': i, 'data': d['data'], 'contador_pb': d['pb'], 'contador_cor': d['cor'], 'reinicio': d['reinicio'],
+                          'somente_total': d['somente_total'], 'origem': origem})
+            if pos == len(pontos) - 1: ultimas[i] = d['pb'] + d['cor']
+        if i in ultimas:
+            reinicios = [p[0] for p in pontos if p[3]]
+            ultimas[i] = (ultimas[i], max(reinicios) if reinicios else None)
+
+    if novas:
+        db.session.execute(insert(LeituraContador.__table__), novas)
+        # A leitura mais recente vira o contador atual da impressora só se não for menor que ele (planilhas antigas não
+        # rebaixam o contador), salvo reinício registrado depois da última movimentação com contador
+        if ultimas:
+            t, m = Impressora.__table__, MovimentacaoImpressora.__table__
+            mov_depois = select(m.c.id).where(m.c.impressora_id == t.c.id, m.c.contador_momento > 0, m.c.data > bindparam('p_reinicio')).exists()
+            db.session.execute(update(t).where(t.c.id == bindparam('p_id'), or_(t.c.contador == None, t.c.contador <= bindparam('p_contador'),
+                                                                                and_(bindparam('p_reinicio') != None, ~mov_depois)))
+                               .values(contador=bindparam('p_contador')),
+                               [{'p_id': i, 'p_contador': c, 'p_reinicio': r} for i, (c, r) in ultimas.items()])
+        # Inserts em lote não passam pelo flush
+        invalidar_custo_pagina(db.session.connection())
+    relatorio['gravadas'] = len(novas)
+    registrar_log('Importação Leituras', f"{relatorio['gravadas']} leituras gravadas ({origem}), {relatorio['duplicadas']} repetidas, {relatorio['total_erros']} erros.")
+    db.session.commit()
+    return relatorio
+
+def volumes_contador(inicio, fim, impressora_ids=None):
+    # Páginas impressas em [inicio, fim) por impressora: da última leitura até `inicio` (ou da primeira depois dele,
+    # com cobertura parcial) até a última leitura antes de `fim`. Leituras com reinício recomeçam a contagem.
+    # Trechos com uma ponta só de total (SNMP) vão para paginas_sem_divisao: não dá para separar P&B de cor.
+    volumes = {}
+    for i, data, pb, cor, reinicio, somente_total in _leituras_vizinhas(impressora_ids, inicio, fim):
+        v = volumes.get(i)
+        if v is None:
+            volumes[i] = {'impressora_id': i, 'primeira_leitura': data, 'ultima_leitura': data, 'leituras': 1, 'paginas_pb': 0, 'paginas_cor': 0,
+                          'paginas_sem_divisao': 0, 'cobertura_parcial': data > inicio, '_ultimo': (pb, cor, somente_total)}
+            continue
+        # Reinício: o contador recomeçou do zero, então tudo o que ele marca foi impresso desde a troca
+        if somente_total or v['_ultimo'][2]:
+            v['paginas_sem_divisao'] += (pb + cor) if reinicio else max(pb + cor - v['_ultimo'][0] - v['_ultimo'][1], 0)
+        else:
+            v['paginas_pb'] += pb if reinicio else max(pb - v['_ultimo'][0], 0)
+            v['paginas_cor'] += cor if reinicio else max(cor - v['_ultimo'][1], 0)
+        v['ultima_leitura'], v['_ultimo'] = data, (pb, cor, somente_total)
+        v['leituras'] += 1
+    rotulos = {i: (modelo, serial, cliente) for i, modelo, serial, cliente in
+               db.session.query(Impressora.id, Impressora.modelo, Impressora.serial, Cliente.nome).outerjoin(Cliente, Cliente.id == Impressora.cliente_id)
+               .filter(Impressora.id.in_(list(volumes)))} if volumes else {}
+    resultado = []
+    for i, v in volumes.items():
+        v.pop('_ultimo')
+        modelo, serial, cliente = rotulos.get(i, (None, None, None))
+        v.update({'modelo': modelo, 'serial': serial, 'cliente': cliente, 'paginas_total': v['paginas_pb'] + v['paginas_cor'] + v['paginas_sem_divisao'],
+                  'primeira_leitura': v['primeira_leitura'].strftime('%d/%m/%Y %H:%M'), 'ultima_leitura': v['ultima_leitura'].strftime('%d/%m/%Y %H:%M')})
+        resultado.append(v)
+    return sorted(resultado, key=lambda v: -v['paginas_total'])
+
+@app.route('/api/leituras_contador', methods=['POST'])
+def api_importar_leituras():
+    # Planilha (campo "arquivo", .xlsx/.csv: serial ou impressora_id; data; contador_pb; contador_cor; reinicio)
+    # ou JSON {"leituras": [{"impressora_id" ou "serial", "data", "contador_pb", "contador_cor" (ou só "contador_total"), "reinicio"}], "origem": "API"}
+    try:
+        arquivo = request.files.get('arquivo')
+        if arquivo and arquivo.filename:
+            return jsonify(importar_leituras(linhas_planilha(arquivo, COLUNAS_LEITURAS), 'Planilha'))
+        dados = request.get_json(silent=True)
+        leituras = dados.get('leituras') if isinstance(dados, dict) else None
+        if not isinstance(leituras, list) or not leituras: return jsonify({'erro': 'Envie um arquivo ou uma lista "leituras".'}), 400
+        if len(leituras) > 20000: return jsonify({'erro': 'Máximo de 20000 leituras por requisição.'}), 400
+        return jsonify(importar_leituras(enumerate(leituras), str(dados.get('origem') or 'API')[:20]))
+    except ValueError as e: db.session.rollback(); return jsonify({'erro': str(e)}), 400
+    except Exception as e: db.session.rollback(); print(f"Erro importacao leituras: {e}"); return jsonify({'erro': str(e)}), 500
+
+@app.route('/api/leituras_contador/volume')
+def api_volume_contador():
+    # ?data_inicio=AAAA-MM-DD&data_fim=AAAA-MM-DD (inclusivo)&impressora_id=
+    try:
+        inicio = datetime.strptime(request.args['data_inicio'], '%Y-%m-%d')
+        fim = datetime.strptime(request.args['data_fim'], '%Y-%m-%d') + timedelta(days=1)
+        impressora_ids = [int(request.args['impressora_id'])] if request.args.get('impressora_id') else None
+    except (KeyError, ValueError): return jsonify({'erro': 'Informe data_inicio e data_fim (AAAA-MM-DD) e, opcionalmente, impressora_id.'}), 400
+    if fim <= inicio: return jsonify({'erro': 'data_fim deve ser posterior a data_inicio.'}), 400
+    itens = volumes_contador(inicio, fim, impressora_ids)
+    return jsonify({'data_inicio': inicio.strftime('%d/%m/%Y'), 'data_fim': (fim - timedelta(days=1)).strftime('%d/%m/%Y'),
+                    'paginas_total': sum(v['paginas_total'] for v in itens), 'itens': itens})
+
+# ==========================================
+#     COLETA SNMP (CONTADORES E TONER)
+# ==========================================
+# Consulta a frota em paralelo com asyncio: um único socket UDP, requisições casadas pelo request-id,
+# concorrência limitada por semáforo e nova tentativa após o tempo limite. Codificação BER mínima do
+# SNMPv2c (só GET), suficiente para a Printer-MIB (RFC 3805): serial, contador total e suprimentos.
+# AgenteSNMPSimulado responde como uma impressora, para testes e desenvolvimento sem equipamentos.
+
+OID_SERIAL = '1.3.6.1.2.1.43.5.1.1.17.1'         # prtGeneralSerialNumber
+OID_CONTADOR = '1.3.6.1.2.1.43.10.2.1.4.1.1'     # prtMarkerLifeCount (páginas, total)
+OID_SUPRIMENTO = '1.3.6.1.2.1.43.11.1.1.{campo}.1.{indice}'  # prtMarkerSupplies: 6 descrição, 8 capacidade, 9 nível
+SUPRIMENTOS_SNMP = 4
+SNMP_GET, SNMP_RESPOSTA = 0xA0, 0xA2
+TIPOS_SEM_SINAL = (0x41, 0x42, 0x43, 0x46)      # Counter32, Gauge32, TimeTicks, Counter64
+
+def _ber(tag, conteudo):
+    n = len(conteudo)
+    tamanho = bytes([n]) if n < 0x80 else bytes([0x80 | ((n.bit_length() + 7) // 8)]) + n.to_bytes((n.bit_length() + 7) // 8, 'big')
+    return bytes([tag]) + tamanho + conteudo
+
+def _ber_int(valor, tag=0x02):
+    return _ber(tag, valor.to_bytes(max(1, (valor.bit_length() + 8) // 8), 'big', signed=True))
+
+def _ber_oid(oid):
+    partes = [int(p) for p in oid.strip('.').split('.')]
+    corpo = bytearray([partes[0] * 40 + partes[1]])
+    for p in partes[2:]:
+        grupo = [p & 0x7F]
+        while p > 0x7F:
+            p >>= 7
+            grupo.append(0x80 | (p & 0x7F))
+        corpo.extend(reversed(grupo))
+    return _ber(0x06, bytes(corpo))
+
+def _oid_texto(conteudo):
+    partes, v = [conteudo[0] // 40, conteudo[0] % 40], 0
+    for b in conteudo[1:]:
+        v = (v << 7) | (b & 0x7F)
+        if not b & 0x80: partes.append(v); v = 0
+    return '.'.join(map(str, partes))
+
+def _ber_itens(dados):
+    # Conteúdo de uma SEQUENCE -> [(tag, conteúdo)]
+    itens, pos = [], 0
+    while pos < len(dados):
+        tag, n = dados[pos], dados[pos + 1]
+        pos += 2
+        if n & 0x80:
+            bytes_tamanho = n & 0x7F
+            n = int.from_bytes(dados[pos:pos + bytes_tamanho], 'big')
+            pos += bytes_tamanho
+        if pos + n > len(dados): raise ValueError('mensagem SNMP truncada')
+        itens.append((tag, dados[pos:pos + n]))
+        pos += n
+    return itens
+
+def _ber_valor(tag, conteudo):
+    if tag == 0x02: return int.from_bytes(conteudo, 'big', signed=True)
+    if tag in TIPOS_SEM_SINAL: return int.from_bytes(conteudo, 'big')
+    if tag == 0x04: return conteudo.decode('utf-8', 'replace').strip('\x00 ')
+    if tag == 0x06: return _oid_texto(conteudo)
+    return None # NULL, noSuchObject, noSuchInstance, endOfMibView
+
+def _ber_varbind(valor, resposta):
+    if valor is None: return _ber(0x81, b'') if resposta else _ber(0x05, b'') # noSuchInstance / NULL
+    if isinstance(valor, str): return _ber(0x04, valor.encode())
+    tag, numero = valor if isinstance(valor, tuple) else (0x02, valor)
+    return _ber_int(numero, tag)
+
+def montar_pdu_snmp(comunidade, tipo, request_id, varbinds, erro=0):
+    # varbinds: [(oid, valor)]; valor None = NULL na requisição / noSuchInstance na resposta, (tag, int) para Counter32 etc.
+    lista = b''.join(_ber(0x30, _ber_oid(oid) + _ber_varbind(valor, tipo == SNMP_RESPOSTA)) for oid, valor in varbinds)
+    pdu = _ber(tipo, _ber_int(request_id) + _ber_int(erro) + _ber_int(0) + _ber(0x30, lista))
+    return _ber(0x30, _ber_int(1) + _ber(0x04, comunidade.encode()) + pdu) # versão 1 = SNMPv2c
+
+def ler_pdu_snmp(dados):
+    # -> (comunidade, tipo, request_id, erro, [(oid, valor)]); ValueError se não for SNMPv2c
+    try:
+        (tag, mensagem), = _ber_itens(dados)
+        (_, versao), (_, comunidade), (tipo, pdu) = _ber_itens(mensagem)
+        (_, request_id), (_, erro), _, (_, lista) = _ber_itens(pdu)
+        varbinds = []
+        for _, vb in _ber_itens(lista):
+            (_, oid), (t, valor) = _ber_itens(vb)
+            varbinds.append((_oid_texto(oid), _ber_valor(t, valor)))
+    except (ValueError, IndexError) as e: raise ValueError(f'mensagem SNMP inválida: {e}')
+    if tag != 0x30 or _ber_valor(0x02, versao) != 1: raise ValueError('apenas SNMPv2c é suportado')
+    return comunidade.decode('utf-8', 'replace'), tipo, _ber_valor(0x02, request_id), _ber_valor(0x02, erro), varbinds
+
+def oids_printer_mib():
+    return [OID_SERIAL, OID_CONTADOR] + [OID_SUPRIMENTO.format(campo=c, indice=i) for i in range(1, SUPRIMENTOS_SNMP + 1) for c in (6, 8, 9)]
+
+def interpretar_printer_mib(valores):
+    toners = []
+    for i in range(1, SUPRIMENTOS_SNMP + 1):
+        descricao, capacidade, nivel = (valores.get(OID_SUPRIMENTO.format(campo=c, indice=i)) for c in (6, 8, 9))
+        if descricao is None and nivel is None: continue
+        percentual = round(nivel * 100 / capacidade, 1) if isinstance(nivel, int) and isinstance(capacidade, int) and nivel >= 0 and capacidade > 0 else None
+        toners.append({'indice': i, 'descricao': descricao, 'capacidade': capacidade, 'nivel': nivel, 'percentual': percentual})
+    contador = valores.get(OID_CONTADOR)
+    return {'serial': valores.get(OID_SERIAL), 'contador': contador if isinstance(contador, int) else None, 'toners': toners}
+
+class _ClienteSNMP(asyncio.DatagramProtocol):
+    def __init__(self): self.pendentes = {}
+    def datagram_received(self, dados, endereco):
+        try: _, tipo, request_id, erro, varbinds = ler_pdu_snmp(dados)
+        except ValueError: return
+        futuro = self.pendentes.pop(request_id, None)
+        if futuro and not futuro.done() and tipo == SNMP_RESPOSTA: futuro.set_result((erro, varbinds))
+    def error_received(self, exc): pass # ICMP "porta inalcançável" etc.: a requisição expira e é repetida
+
+async def consultar_snmp(cliente, transporte, endereco, oids, comunidade='public', tempo_limite=1.5, tentativas=2):
+    # GET com `tentativas` repetições; cada envio tem request-id novo, então respostas atrasadas da tentativa anterior são descartadas
+    loop = asyncio.get_running_loop()
+    for tentativa in range(1, tentativas + 2):
+        request_id = random.randint(1, 2**31 - 1)
+        futuro = cliente.pendentes[request_id] = loop.create_future()
+        try:
+            transporte.sendto(montar_pdu_snmp(comunidade, SNMP_GET, request_id, [(oid, None) for oid in oids]), endereco)
+            erro, varbinds = await asyncio.wait_for(futuro, tempo_limite)
+            return tentativa, erro, dict(varbinds)
+        except asyncio.TimeoutError: pass
+        finally: cliente.pendentes.pop(request_id, None)
+    raise TimeoutError(f'sem resposta após {tentativas + 1} tentativas')
+
+async def coletar_frota(alvos, comunidade='public', concorrencia=100, tempo_limite=1.5, tentativas=2):
+    # alvos: [(impressora_id, host, porta)] -> {impressora_id: {'serial', 'contador', 'toners', 'tentativas'} ou {'erro'}}
+    loop = asyncio.get_running_loop()
+    transporte, cliente = await loop.create_datagram_endpoint(_ClienteSNMP, local_addr=('0.0.0.0', 0))
+    limite = asyncio.Semaphore(concorrencia)
+    oids = oids_printer_mib()
+    async def consultar(impressora_id, host, porta):
+        async with limite:
+            try: tentativa, erro, valores = await consultar_snmp(cliente, transporte, (host, porta), oids, comunidade, tempo_limite, tentativas)
+            except (TimeoutError, OSError) as e: return impressora_id, {'erro': str(e) or 'sem resposta'}
+        if erro: return impressora_id, {'erro': f'agente SNMP respondeu com erro {erro}'}
+        return impressora_id, {**interpretar_printer_mib(valores), 'tentativas': tentativa}
+    try: return dict(await asyncio.gather(*(consultar(*alvo) for alvo in alvos)))
+    finally: transporte.close()
+
+class AgenteSNMPSimulado(asyncio.DatagramProtocol):
+    # Impressora falsa: responde GET com `valores` {oid: valor}; `atraso` (s) e `perda` (0-1) exercitam tempo limite e repetição,
+    # `incremento` soma até N páginas ao contador a cada consulta
+    def __init__(self, valores, comunidade='public', atraso=0.0, perda=0.0, incremento=0):
+        self.valores, self.comunidade, self.atraso, self.perda, self.incremento = dict(valores), comunidade, atraso, perda, incremento
+    def connection_made(self, transporte): self.transporte = transporte
+    def datagram_received(self, dados, endereco):
+        try: comunidade, tipo, request_id, _, varbinds = ler_pdu_snmp(dados)
+        except ValueError: return
+        if comunidade != self.comunidade or tipo != SNMP_GET or random.random() < self.perda: return
+        if self.incremento and OID_CONTADOR in self.valores:
+            tag, contador = self.valores[OID_CONTADOR]
+            self.valores[OID_CONTADOR] = (tag, contador + random.randint(0, self.incremento))
+        resposta = montar_pdu_snmp(comunidade, SNMP_RESPOSTA, request_id, [(oid, self.valores.get(oid)) for oid, _ in varbinds])
+        if self.atraso: asyncio.get_running_loop().call_later(self.atraso, self.transporte.sendto, resposta, endereco)
+        else: self.transporte.sendto(resposta, endereco)
+
+def valores_simulados(serial, contador, niveis=(80, 55, 30, 10)):
+    valores = {OID_SERIAL: serial or '', OID_CONTADOR: (0x41, contador or 0)}
+    for i, (nome, nivel) in enumerate(zip(('Black Toner', 'Cyan Toner', 'Magenta Toner', 'Yellow Toner'), niveis), start=1):
+        valores.update({OID_SUPRIMENTO.format(campo=6, indice=i): nome, OID_SUPRIMENTO.format(campo=8, indice=i): 100, OID_SUPRIMENTO.format(campo=9, indice=i): nivel})
+    return valores
+
+async def iniciar_simuladores(agentes, host='127.0.0.1', **opcoes):
+    # agentes: {porta: valores} -> transportes abertos (fechar com .close())
+    loop = asyncio.get_running_loop()
+    transportes = []
+    for porta, valores in agentes.items():
+        transporte, _ = await loop.create_datagram_endpoint(lambda v=valores: AgenteSNMPSimulado(v, **opcoes), local_addr=(host, porta))
+        transportes.append(transporte)
+    return transportes
+
+def _endereco_snmp(texto):
+    host, separador, porta = texto.strip().partition(':')
+    return host, int(porta) if separador and porta.isdigit() else 161
+
+def coletar_snmp(impressora_ids=None, **opcoes):
+    # Consulta as impressoras com endereco_ip, grava contadores (LeituraContador, validação de monotonicidade) e níveis de toner
+    query = db.session.query(Impressora.id, Impressora.serial, Impressora.endereco_ip).filter(Impressora.endereco_ip != None, Impressora.endereco_ip != '')
+    if impressora_ids: query = query.filter(Impressora.id.in_(impressora_ids))
+    impressoras = query.all()
+    seriais = {i: (serial or '').strip().upper() for i, serial, _ in impressoras}
+    inicio = time.monotonic()
+    resultados = asyncio.run(coletar_frota([(i, *_endereco_snmp(ip)) for i, _, ip in impressoras], **opcoes)) if impressoras else {}
+    segundos = round(time.monotonic() - inicio, 2)
+
+    agora = datetime.now().replace(microsecond=0)
+    leituras, toners, falhas = [], [], []
+    for i, r in resultados.items():
+        if 'erro' in r: falhas.append({'impressora_id': i, 'erro': r['erro']}); continue
+        if r['serial'] and seriais[i] and r['serial'].strip().upper() != seriais[i]:
+            falhas.append({'impressora_id': i, 'erro': f"Serial do equipamento ({r['serial']}) diferente do cadastro: verifique o endereço."}); continue
+        # prtMarkerLifeCount é o total de páginas: gravado como leitura só de total, sem inventar a divisão P&B/cor
+        if r['contador'] is not None: leituras.append((i, {'impressora_id': i, 'data': agora, 'contador_total': r['contador']}))
+        toners.extend({'impressora_id': i, 'indice': t['indice'], 'descricao': t['descricao'], 'capacidade': t['capacidade'], 'nivel': t['nivel'],
+                       'percentual': t['percentual'], 'atualizado_em': agora} for t in r['toners'])
+    if toners: db.session.execute(insert(NivelToner.__table__).prefix_with('OR REPLACE'), toners)
+    relatorio = importar_leituras(leituras, 'SNMP') # grava as leituras, atualiza Impressora.contador e faz o commit
+    return {'impressoras': len(impressoras), 'respondidas': sum('erro' not in r for r in resultados.values()), 'segundos': segundos,
+            'leituras_gravadas': relatorio['gravadas'], 'leituras_repetidas': relatorio['duplicadas'], 'suprimentos': len(toners),
+            'falhas': falhas, 'erros_leitura': relatorio['erros']}
+
+@app.route('/api/snmp/coletar', methods=['POST'])
+def api_coletar_snmp():
+    # {"impressora_ids": [...]} opcional (padrão: todas com endereco_ip)
+    dados = request.get_json(silent=True) or {}
+    try: ids = [int(i) for i in dados.get('impressora_ids') or []]
+    except (TypeError, ValueError): return jsonify({'erro': 'impressora_ids deve ser uma lista de ids.'}), 400
+    try: return jsonify(coletar_snmp(ids))
+    except Exception as e:
+        db.session.rollback(); print(f"Erro coleta snmp: {e}")
+        return jsonify({'erro': f'Falha na coleta: {e}'}), 500
+
+@app.route('/api/toner')
+def api_niveis_toner():
+    # ?percentual_max=20: suprimentos abaixo do limite (padrão: todos), do menor para o maior
+    limite = request.args.get('percentual_max', type=float)
+    query = db.session.query(NivelToner, Impressora.modelo, Impressora.serial, Cliente.nome).join(Impressora, Impressora.id == NivelToner.impressora_id) \
+        .outerjoin(Cliente, Cliente.id == Impressora.cliente_id)
+    if limite is not None: query = query.filter(NivelToner.percentual <= limite)
+    return jsonify([{'impressora_id': t.impressora_id, 'modelo': modelo, 'serial': serial, 'cliente': cliente, 'suprimento': t.descricao, 'nivel': t.nivel,
+                     'capacidade': t.capacidade, 'percentual': t.percentual, 'atualizado_em': t.atualizado_em.strftime('%d/%m/%Y %H:%M') if t.atualizado_em else None}
+                    for t, modelo, serial, cliente in query.order_by(NivelToner.percentual.is_(None), NivelToner.percentual)])
+
+@app.cli.command('coletar_snmp')
+@click.option('--concorrencia', default=100, help='Consultas simultâneas.')
+@click.option('--tempo-limite', default=1.5, help='Segundos de espera por resposta.')
+@click.option('--tentativas', default=2, help='Repetições após o tempo limite.')
+@click.option('--comunidade', default='public')
+def coletar_snmp_cmd(concorrencia, tempo_limite, tentativas, comunidade):
+    r = coletar_snmp(concorrencia=concorrencia, tempo_limite=tempo_limite, tentativas=tentativas, comunidade=comunidade)
+    print(f"{r['respondidas']} de {r['impressoras']} impressoras responderam em {r['segundos']} s: {r['leituras_gravadas']} leituras, {r['suprimentos']} suprimentos.")
+    for f in r['falhas']: print(f"  impressora {f['impressora_id']}: {f['erro']}")
+
+@app.cli.command('simular_snmp')
+@click.option('--quantidade', default=500, help='Agentes simulados (um por porta UDP).')
+@click.option('--porta', default=16100, help='Primeira porta.')
+@click.option('--configurar', is_flag=True, help='Aponta o endereco_ip das primeiras impressoras para os agentes simulados.')
+@click.option('--perda', default=0.0, help='Fração de requisições ignoradas (0-1).')
+def simular_snmp_cmd(quantidade, porta, configurar, perda):
+    # Só para desenvolvimento: mantém os agentes no ar até Ctrl+C
+    impressoras = Impressora.query.order_by(Impressora.id).limit(quantidade).all()
+    agentes = {}
+    for n in range(quantidade):
+        imp = impressoras[n] if n < len(impressoras) else None
+        agentes[porta + n] = valores_simulados(imp.serial if imp else f'SIM{n:04d}', imp.contador if imp else 0, [random.randint(0, 100) for _ in range(4)])
+        if configurar and imp: imp.endereco_ip = f'127.0.0.1:{porta + n}'
+    if configurar: db.session.commit()
+    async def servir():
+        transportes = await iniciar_simuladores(agentes, perda=perda, incremento=50)
+        print(f"{len(transportes)} agentes SNMP simulados em 127.0.0.1:{porta}-{porta + quantidade - 1} (Ctrl+C para encerrar)")
+        try: await asyncio.Event().wait()
+        finally:
+            for t in transportes: t.close()
+    try: asyncio.run(servir())
+    except KeyboardInterrupt: pass
 
 # --- CONTEXTO ---
 @app.template_filter('currency')
@@ -357,113 +2149,122 @@ def utility_processor():
             config = Configuracao()
             db.session.add(config)
             db.session.commit()
-        return dict(hoje=datetime.now(), config=config)
+        # Badge do menu: críticos + vendas atrasadas, lidos do snapshot de KPIs como estiver (sem varrer produtos nem gravar;
+        # a reconstrução fica com o dashboard e a API)
+        kpi = DashboardKPI.query.order_by(DashboardKPI.id).first()
+        total_alertas = ((kpi.itens_alerta or 0) + (kpi.vendas_atrasadas or 0)) if kpi else 0
+        return dict(hoje=datetime.now(), config=config, total_alertas=total_alertas)
     except: return dict(hoje=datetime.now(), config=None)
 
+# --- CONSULTAS DO DASHBOARD ---
+def dados_grafico_financeiro(hoje, meses=6):
+    # Receitas/Despesas pagas por mês em uma única consulta agrupada.
+    # Filtra por intervalo de datas (usa o índice de data_pagamento) em vez de extract() por mês.
+    mes_atual = hoje.date().replace(day=1) if isinstance(hoje, datetime) else hoje.replace(day=1)
+    inicio = add_months(mes_atual, -(meses - 1))
+    fim = add_months(mes_atual, 1)
+    ano_mes = func.strftime('%Y-%m', LancamentoFinanceiro.data_pagamento).label('ano_mes')
+    linhas = db.session.query(ano_mes, LancamentoFinanceiro.tipo, func.sum(LancamentoFinanceiro.valor)).filter(
+        LancamentoFinanceiro.pago == True,
+        LancamentoFinanceiro.data_pagamento >= inicio,
+        LancamentoFinanceiro.data_pagamento < fim,
+        LancamentoFinanceiro.tipo.in_(['Receita', 'Despesa'])
+    ).group_by(ano_mes, LancamentoFinanceiro.tipo).all()
+    totais = {(am, tipo): valor or 0 for am, tipo, valor in linhas}
+
+    labels, receitas, despesas = [], [], []
+    for i in range(meses):
+        ref = add_months(inicio, i)
+        chave = ref.strftime('%Y-%m')
+        labels.append(ref.strftime('%b'))
+        receitas.append(totais.get((chave, 'Receita'), 0))
+        despesas.append(totais.get((chave, 'Despesa'), 0))
+    return labels, receitas, despesas
+
 # --- ROTAS ---
 
 # Certifique-se de ter importado isso no topo: 
 # from sqlalchemy import extract, func
 
-@app.route('/')
-@app.route('/index')
-def index():
-    hoje = datetime.now()
-    primeiro_dia_mes = hoje.replace(day=1)
-    
-    # 1. KPIs Gerais (Mantidos)
-    vendas_mes = Venda.query.filter(Venda.data >= primeiro_dia_mes).all()
-    total_vendas_mes = sum(v.valor_total for v in vendas_mes)
-    
-    contratos_ativos = Contrato.query.filter_by(status='Ativo').all()
-    total_contratos_ativos = len(contratos_ativos)
-    total_contratos_valor = sum(c.valor_mensal_total for c in contratos_ativos)
-    
-    itens_alerta = Produto.query.filter(Produto.quantidade <= Produto.minimo).all()
-    total_itens_alerta = len(itens_alerta)
-    
-    # Pendências (Vendas vencidas pendentes)
-    vendas_atrasadas = Venda.query.filter(
-        Venda.status_pagamento == 'Pendente',
-        Venda.data_vencimento < hoje.date()
-    ).count()
-    total_alertas = total_itens_alerta + vendas_atrasadas
-
-    # 2. Dados para Gráfico Financeiro (Últimos 6 meses)
-    grafico_labels = []
-    grafico_receitas = []
-    grafico_despesas = []
-
-    for i in range(5, -1, -1):
-        data_ref = hoje - timedelta(days=i*30) 
-        mes = data_ref.month
-        ano = data_ref.year
-        grafico_labels.append(data_ref.strftime('%b'))
-
-        # Tenta pegar do financeiro real, fallback para zero
-        try:
-            rec = db.session.query(func.sum(LancamentoFinanceiro.valor)).filter(
-                extract('month', LancamentoFinanceiro.data_pagamento) == mes,
-                extract('year', LancamentoFinanceiro.data_pagamento) == ano,
-                LancamentoFinanceiro.tipo == 'Receita',
-                LancamentoFinanceiro.pago == True
-            ).scalar() or 0
-            
-            desp = db.session.query(func.sum(LancamentoFinanceiro.valor)).filter(
-                extract('month', LancamentoFinanceiro.data_pagamento) == mes,
-                extract('year', LancamentoFinanceiro.data_pagamento) == ano,
-                LancamentoFinanceiro.tipo == 'Despesa',
-                LancamentoFinanceiro.pago == True
-            ).scalar() or 0
-        except:
-            rec = 0
-            desp = 0
-        
-        grafico_receitas.append(rec)
-        grafico_despesas.append(desp)
-
-    # 3. Dados para Gráfico Pizza (Status Impressoras)
-    # Contagem por status
-    imp_disp = Impressora.query.filter_by(status='Disponível').count()
-    imp_loc = Impressora.query.filter(or_(Impressora.status=='Locada', Impressora.status=='Em Cliente')).count()
-    imp_manut = Impressora.query.filter_by(status='Manutenção').count()
-    
-    status_impressoras = {
-        'Disponivel': imp_disp,
-        'Locada': imp_loc,
-        'Manutencao': imp_manut
+def widget_kpis():
+    kpi = obter_kpis()
+    return {
+        'total_vendas_mes': kpi.vendas_mes, 'total_vendas_mes_fmt': currency_filter(kpi.vendas_mes),
+        'total_contratos_ativos': kpi.contratos_ativos,
+        'total_contratos_valor': kpi.contratos_valor, 'total_contratos_valor_fmt': currency_filter(kpi.contratos_valor),
+        'total_itens_alerta': kpi.itens_alerta,
+        'total_alertas': kpi.itens_alerta + kpi.vendas_atrasadas
     }
 
-    # 4. TABELA 1: Vencimentos Próximos (Financeiro)
-    # Pega vendas pendentes que vencem nos próximos 15 dias ou já venceram
-    data_limite = hoje.date() + timedelta(days=15)
-    lista_vencimentos = Venda.query.filter(
+def widget_grafico():
+    labels, receitas, despesas = dados_grafico_financeiro(datetime.now())
+    return {'labels': labels, 'receitas': receitas, 'despesas': despesas}
+
+def widget_status_impressoras():
+    kpi = obter_kpis()
+    return {'Disponivel': kpi.impressoras_disponiveis, 'Locada': kpi.impressoras_locadas, 'Manutencao': kpi.impressoras_manutencao}
+
+def widget_vencimentos():
+    # Vendas pendentes que vencem nos próximos 15 dias ou já venceram
+    hoje = datetime.now().date()
+    vendas = Venda.query.options(joinedload(Venda.cliente)).filter(
         Venda.status_pagamento == 'Pendente',
-        Venda.data_vencimento <= data_limite
+        Venda.data_vencimento <= hoje + timedelta(days=15)
     ).order_by(Venda.data_vencimento).limit(5).all()
+    return [{'cliente': v.cliente.nome if v.cliente else '', 'vencimento': v.data_vencimento.strftime('%d/%m'), 'atrasado': v.data_vencimento < hoje, 'valor_fmt': currency_filter(v.valor_total)} for v in vendas]
+
+def widget_mov_estoque():
+    movs = Movimentacao.query.options(joinedload(Movimentacao.produto)).order_by(Movimentacao.data.desc()).limit(7).all()
+    return [{'produto': m.produto.nome if m.produto else '', 'tipo': m.tipo, 'quantidade': m.quantidade} for m in movs]
+
+def widget_mov_impressoras():
+    movs = MovimentacaoImpressora.query.options(joinedload(MovimentacaoImpressora.impressora)).order_by(MovimentacaoImpressora.data.desc()).limit(7).all()
+    return [{'modelo': m.impressora.modelo if m.impressora else '', 'origem': m.origem, 'destino': m.destino, 'data': m.data.strftime('%d/%m')} for m in movs]
 
-    # 5. TABELA 2: Movimentações Estoque (Entrada/Saída Itens)
-    # Pega da tabela Movimentacao (Produtos)
-    lista_mov_estoque = Movimentacao.query.order_by(Movimentacao.data.desc()).limit(7).all()
-
-    # 6. TABELA 3: Movimentações Impressoras
-    # Pega da tabela MovimentacaoImpressora
-    lista_mov_impressoras = MovimentacaoImpressora.query.order_by(MovimentacaoImpressora.data.desc()).limit(7).all()
-
-    return render_template('dashboard.html', 
-                           hoje=hoje.strftime('%d/%m/%Y'),
-                           total_vendas_mes=total_vendas_mes,
-                           total_contratos_ativos=total_contratos_ativos,
-                           total_contratos_valor=total_contratos_valor,
-                           total_itens_alerta=total_itens_alerta,
-                           total_alertas=total_alertas,
-                           grafico_labels=grafico_labels,
-                           grafico_receitas=grafico_receitas,
-                           grafico_despesas=grafico_despesas,
-                           status_impressoras=status_impressoras,
-                           lista_vencimentos=lista_vencimentos,
-                           lista_mov_estoque=lista_mov_estoque,
-                           lista_mov_impressoras=lista_mov_impressoras)
+WIDGETS_DASHBOARD = {
+    'kpis': widget_kpis,
+    'grafico': widget_grafico,
+    'status_impressoras': widget_status_impressoras,
+    'vencimentos': widget_vencimentos,
+    'mov_estoque': widget_mov_estoque,
+    'mov_impressoras': widget_mov_impressoras,
+}
+
+# Cada widget roda em sua própria thread com app context (e portanto sessão) independente
+pool_dashboard = ThreadPoolExecutor(max_workers=4)
+
+def _executar_widget(nome):
+    with app.app_context():
+        return WIDGETS_DASHBOARD[nome]()
+
+def calcular_widgets(nomes):
+    futuros = {nome: pool_dashboard.submit(_executar_widget, nome) for nome in nomes}
+    resultado = {}
+    for nome, futuro in futuros.items():
+        try: resultado[nome] = futuro.result()
+        except Exception as e:
+            print(f"Erro widget {nome}: {e}")
+            resultado[nome] = None
+    return resultado
+
+@app.route('/')
+@app.route('/index')
+def index():
+    # Página esqueleto: os widgets são buscados em paralelo pelo navegador via /api/dashboard/<widget>
+    return render_template('dashboard.html', hoje=datetime.now().strftime('%d/%m/%Y'))
+
+@app.route('/api/dashboard/<widget>')
+def api_dashboard_widget(widget):
+    if widget not in WIDGETS_DASHBOARD: return jsonify({'erro': 'Widget desconhecido'}), 404
+    try: return jsonify(WIDGETS_DASHBOARD[widget]())
+    except Exception as e: print(f"Erro widget {widget}: {e}"); return jsonify({'erro': str(e)}), 500
+
+@app.route('/api/dashboard')
+def api_dashboard():
+    # Pacote com vários widgets calculados simultaneamente (?widgets=kpis,grafico,...)
+    pedidos = request.args.get('widgets')
+    nomes = [n for n in pedidos.split(',') if n in WIDGETS_DASHBOARD] if pedidos else list(WIDGETS_DASHBOARD)
+    return jsonify(calcular_widgets(nomes))
 
 
 @app.route('/notificacoes')
@@ -471,16 +2272,29 @@ def notificacoes():
     config = Configuracao.query.first()
     margem = config.margem_atencao_pct if config else 20
     dias_vencimento = config.dias_alerta_vencimento if config else 7
-    todos_produtos = Produto.query.all()
-    itens_atencao = []
-    for p in todos_produtos:
-        if p.ativo:
-            limite = p.minimo * (1 + margem / 100)
-            if p.quantidade <= p.minimo: itens_atencao.append({'produto': p, 'status': 'Crítico', 'classe': 'bg-danger', 'row_class': 'row-alert-red'})
-            elif p.quantidade <= limite: itens_atencao.append({'produto': p, 'status': 'Baixo', 'classe': 'bg-warning text-dark', 'row_class': 'row-alert-orange'})
+    nivel = request.args.get('nivel') if request.args.get('nivel') in NIVEIS_ALERTA else None
+    pagina = max(limpar_int(request.args.get('pagina')) or 1, 1)
+    resumo = resumo_alertas(margem)
+    itens_atencao = listar_alertas(nivel, pagina, 50, margem)
+    total_filtrado = resumo[nivel] if nivel else resumo['total']
+    total_paginas = max((total_filtrado + 49) // 50, 1)
     data_limite = datetime.now().date() + timedelta(days=dias_vencimento)
-    vendas_vencendo = Venda.query.filter(Venda.status_pagamento != 'Pago', Venda.status_geral != 'Cancelada', Venda.data_vencimento <= data_limite).order_by(Venda.data_vencimento).all()
-    return render_template('notificacoes.html', itens_atencao=itens_atencao, vendas_vencendo=vendas_vencendo)
+    vendas_vencendo = Venda.query.options(joinedload(Venda.cliente)).filter(Venda.status_pagamento != 'Pago', Venda.status_geral != 'Cancelada', Venda.data_vencimento <= data_limite).order_by(Venda.data_vencimento).all()
+    return render_template('notificacoes.html', itens_atencao=itens_atencao, resumo_alertas=resumo, nivel=nivel, pagina=pagina, total_paginas=total_paginas, vendas_vencendo=vendas_vencendo)
+
+@app.route('/api/alertas_estoque')
+def api_alertas_estoque():
+    # Contagens por nível + página da lista (?nivel=critico|baixo&pagina=1&por_pagina=50)
+    nivel = request.args.get('nivel')
+    if nivel and nivel not in NIVEIS_ALERTA: return jsonify({'erro': 'nivel deve ser critico ou baixo'}), 400
+    pagina = max(limpar_int(request.args.get('pagina')) or 1, 1)
+    por_pagina = min(max(limpar_int(request.args.get('por_pagina')) or 50, 1), 200)
+    margem = margem_alerta()
+    return jsonify({'resumo': resumo_alertas(margem), 'pagina': pagina, 'itens': listar_alertas(nivel, pagina, por_pagina, margem)})
+
+@app.route('/api/alertas_estoque/resumo')
+def api_alertas_estoque_resumo():
+    return jsonify(resumo_alertas())
 
 @app.route('/estoque')
 def estoque():
@@ -490,36 +2304,107 @@ def estoque():
     if marca_filtro and marca_filtro != 'Todas': query = query.filter(Produto.marca.ilike(f'%{marca_filtro}%'))
     if apenas_disponiveis: query = query.filter(Produto.quantidade > 0)
     produtos = query.all()
-    historico = Movimentacao.query.order_by(Movimentacao.data.desc()).limit(30).all()
+    historico, cursor_historico = paginar_keyset(Movimentacao.query.options(joinedload(Movimentacao.produto)), Movimentacao.data, Movimentacao.id, limite=30)
     valor_total_estoque = sum([p.quantidade * p.valor_pago for p in produtos])
     total_itens_estoque = sum([p.quantidade for p in produtos])
-    top_saidas = db.session.query(Produto.nome, Produto.marca, func.sum(Movimentacao.quantidade).label('total')).join(Movimentacao).filter(Movimentacao.tipo.in_(['Saida_Locacao', 'Venda', 'Ajuste_Saida']), Movimentacao.status != 'Cancelado').group_by(Produto.id).order_by(desc('total')).limit(30).all()
+    top_saidas = db.session.query(Produto.nome, Produto.marca, func.sum(ConsumoProdutoMensal.quantidade).label('total')).join(ConsumoProdutoMensal, ConsumoProdutoMensal.produto_id == Produto.id).filter(ConsumoProdutoMensal.tipo.in_(TIPOS_SAIDA)).group_by(Produto.id).order_by(desc('total')).limit(30).all()
     marcas = db.session.query(Produto.marca).distinct().all()
     lista_marcas = [m[0] for m in marcas if m[0]]
-    return render_template('estoque.html', produtos=produtos, historico=historico, marcas=lista_marcas, valor_total_estoque=valor_total_estoque, total_itens_estoque=total_itens_estoque, top_saidas=top_saidas)
+    return render_template('estoque.html', produtos=produtos, historico=historico, cursor_historico=cursor_historico, marcas=lista_marcas, valor_total_estoque=valor_total_estoque, total_itens_estoque=total_itens_estoque, top_saidas=top_saidas)
+
+def serializar_movimentacao(m):
+    return {'id': m.id, 'data': m.data.strftime('%d/%m/%Y %H:%M'), 'tipo': m.tipo, 'status': m.status, 'produto_id': m.produto_id, 'produto': m.produto.nome,
+            'quantidade': m.quantidade, 'categoria_movimento': m.categoria_movimento, 'numero_documento': m.numero_documento, 'destino_origem': m.destino_origem,
+            'observacao': m.observacao, 'valor_unitario_entrada': m.valor_unitario_entrada, 'valor_unitario_entrada_fmt': currency_filter(m.valor_unitario_entrada),
+            'justificativa_cancelamento': m.justificativa_cancelamento}
+
+@app.route('/api/movimentacoes')
+def api_movimentacoes():
+    try:
+        query = Movimentacao.query.options(joinedload(Movimentacao.produto))
+        if request.args.get('produto_id'): query = query.filter(Movimentacao.produto_id == int(request.args.get('produto_id')))
+        if request.args.get('tipo'): query = query.filter(Movimentacao.tipo == request.args.get('tipo'))
+        if request.args.get('status'): query = query.filter(Movimentacao.status == request.args.get('status'))
+        if request.args.get('documento'): query = query.filter(Movimentacao.numero_documento == request.args.get('documento'))
+        if request.args.get('data_inicio'): query = query.filter(Movimentacao.data >= datetime.strptime(request.args.get('data_inicio'), '%Y-%m-%d'))
+        if request.args.get('data_fim'): query = query.filter(Movimentacao.data < datetime.strptime(request.args.get('data_fim'), '%Y-%m-%d') + timedelta(days=1))
+        limite = min(max(limpar_int(request.args.get('limite')) or 50, 1), 200)
+        movs, proximo = paginar_keyset(query, Movimentacao.data, Movimentacao.id, request.args.get('cursor'), limite)
+    except (ValueError, TypeError) as e:
+        return jsonify({'erro': f'Parâmetro inválido: {e}'}), 400
+    return jsonify({'itens': [serializar_movimentacao(m) for m in movs], 'proximo_cursor': proximo})
+
+BUSCA_LINKS = {
+    'Cliente': lambda r: url_for('clientes'),
+    'Impressora': lambda r: url_for('impressoras', busca=r['titulo'].split(' · ')[-1]),
+    'Produto': lambda r: url_for('estoque'),
+    'PedidoSaida': lambda r: url_for('imprimir_pedido', id=r['id']),
+    'Contrato': lambda r: url_for('imprimir_contrato_view', id=r['id']),
+}
+
+@app.route('/api/busca')
+def api_busca():
+    # Omnibox: prefixo por palavra, resultados ordenados por relevância (bm25)
+    tipos = [t for t in (request.args.get('tipos') or '').split(',') if t]
+    if any(t not in BUSCA_FONTES for t in tipos): return jsonify({'erro': f'Tipos válidos: {", ".join(BUSCA_FONTES)}'}), 400
+    limite = min(max(limpar_int(request.args.get('limite')) or 20, 1), 100)
+    resultados = buscar(request.args.get('q'), tipos, limite)
+    for r in resultados: r['url'] = BUSCA_LINKS[r['tipo']](r)
+    return jsonify({'resultados': resultados})
+
+@app.route('/api/consumo_mensal')
+def api_consumo_mensal():
+    # Série mensal para gráficos de tendência (lida dos rollups): por produto, por cliente ou geral
+    try:
+        meses = min(max(limpar_int(request.args.get('meses')) or 12, 1), 60)
+        produto_id = int(request.args['produto_id']) if request.args.get('produto_id') else None
+        cliente_id = int(request.args['cliente_id']) if request.args.get('cliente_id') else None
+    except (ValueError, TypeError) as e:
+        return jsonify({'erro': f'Parâmetro inválido: {e}'}), 400
+    inicio = datetime.now().date().replace(day=1)
+    rotulos = [ano_mes(add_months(inicio, -n)) for n in range(meses - 1, -1, -1)]
+    if cliente_id:
+        linhas = db.session.query(ConsumoClienteMensal.ano_mes, ConsumoClienteMensal.total_itens, ConsumoClienteMensal.total_pedidos).filter(
+            ConsumoClienteMensal.cliente_id == cliente_id, ConsumoClienteMensal.ano_mes >= rotulos[0]).all()
+        por_mes = {am: (itens, pedidos) for am, itens, pedidos in linhas}
+        return jsonify({'meses': rotulos, 'itens': [por_mes.get(am, (0, 0))[0] for am in rotulos], 'pedidos': [por_mes.get(am, (0, 0))[1] for am in rotulos]})
+    query = db.session.query(ConsumoProdutoMensal.ano_mes, ConsumoProdutoMensal.tipo, func.sum(ConsumoProdutoMensal.quantidade)).filter(ConsumoProdutoMensal.ano_mes >= rotulos[0])
+    if produto_id: query = query.filter(ConsumoProdutoMensal.produto_id == produto_id)
+    entradas, saidas = dict.fromkeys(rotulos, 0), dict.fromkeys(rotulos, 0)
+    for am, tipo, total in query.group_by(ConsumoProdutoMensal.ano_mes, ConsumoProdutoMensal.tipo):
+        if am not in entradas: continue
+        if tipo == 'Entrada': entradas[am] += total or 0
+        elif tipo in TIPOS_SAIDA: saidas[am] += total or 0
+    return jsonify({'meses': rotulos, 'entradas': list(entradas.values()), 'saidas': list(saidas.values())})
 
 @app.route('/saida_locacao')
 def saida_locacao():
     busca = request.args.get('busca')
     periodo = request.args.get('periodo')
     cliente_id = request.args.get('cliente_id')
-    query = PedidoSaida.query
-    if busca:
-        term = f"%{busca}%"
-        query = query.join(Cliente).filter((cast(PedidoSaida.numero_pedido, String).like(term)) | (Cliente.nome.like(term)) | (PedidoSaida.impressora.like(term)))
+    data_inicio, data_fim = request.args.get('data_inicio'), request.args.get('data_fim')
+    query = PedidoSaida.query.options(joinedload(PedidoSaida.cliente), selectinload(PedidoSaida.itens).joinedload(ItemPedido.produto))
+    if busca: query = query.filter(PedidoSaida.id.in_(ids_busca('PedidoSaida', busca)))
     if cliente_id and cliente_id != 'Todos': query = query.filter(PedidoSaida.cliente_id == int(cliente_id))
-    if periodo == 'mes_passado':
-        mes_passado = datetime.now().month - 1
-        query = query.filter(extract('month', PedidoSaida.data) == mes_passado)
-    elif periodo != 'todos': 
-        mes_atual = datetime.now().month
-        query = query.filter(extract('month', PedidoSaida.data) == mes_atual)
-    pedidos = query.order_by(PedidoSaida.data.desc()).all()
+    # Faixa explícita (data_inicio/data_fim) tem prioridade sobre o período pré-definido
+    inicio, fim = intervalo_periodo(periodo)
+    try:
+        if data_inicio or data_fim:
+            inicio = datetime.strptime(data_inicio, '%Y-%m-%d') if data_inicio else None
+            fim = datetime.strptime(data_fim, '%Y-%m-%d') + timedelta(days=1) if data_fim else None
+    except ValueError: flash('Data inválida no filtro.', 'warning')
+    if inicio: query = query.filter(PedidoSaida.data >= inicio)
+    if fim: query = query.filter(PedidoSaida.data < fim)
+    try: pedidos, proximo = paginar_keyset(query, PedidoSaida.data, PedidoSaida.id, request.args.get('cursor'), 50)
+    except (ValueError, TypeError):
+        flash('Página inválida.', 'warning')
+        pedidos, proximo = paginar_keyset(query, PedidoSaida.data, PedidoSaida.id, None, 50)
+    url_proxima = url_for('saida_locacao', **{**request.args.to_dict(), 'cursor': proximo}) if proximo else None
+    url_inicio = url_for('saida_locacao', **{k: v for k, v in request.args.items() if k != 'cursor'}) if request.args.get('cursor') else None
     produtos = Produto.query.filter(Produto.quantidade > 0).all()
     clientes = Cliente.query.order_by(Cliente.nome).all()
-    mes_atual = datetime.now().month
-    top_clientes = db.session.query(Cliente.nome, func.sum(ItemPedido.quantidade).label('total_itens')).join(PedidoSaida, Cliente.pedidos).join(ItemPedido).filter(extract('month', PedidoSaida.data) == mes_atual, PedidoSaida.status == 'Ativo').group_by(Cliente.id).order_by(desc('total_itens')).limit(30).all()
-    return render_template('saida_locacao.html', produtos=produtos, clientes=clientes, pedidos=pedidos, top_clientes=top_clientes, hoje=datetime.now())
+    top_clientes = db.session.query(Cliente.nome, ConsumoClienteMensal.total_itens).join(ConsumoClienteMensal, ConsumoClienteMensal.cliente_id == Cliente.id).filter(ConsumoClienteMensal.ano_mes == ano_mes(datetime.now())).order_by(ConsumoClienteMensal.total_itens.desc()).limit(30).all()
+    return render_template('saida_locacao.html', produtos=produtos, clientes=clientes, pedidos=pedidos, url_proxima=url_proxima, url_inicio=url_inicio, top_clientes=top_clientes, hoje=datetime.now())
 
 @app.route('/clientes')
 def clientes():
@@ -530,7 +2415,7 @@ def clientes():
 def vendas():
     clientes = Cliente.query.order_by(Cliente.nome).all()
     produtos = Produto.query.filter(Produto.quantidade > 0).all()
-    query = Venda.query.filter(Venda.status_geral != 'Cancelada')
+    query = Venda.query.options(joinedload(Venda.cliente)).filter(Venda.status_geral != 'Cancelada')
     data_inicio = request.args.get('data_inicio')
     data_fim = request.args.get('data_fim')
     if data_inicio and data_fim:
@@ -539,6 +2424,8 @@ def vendas():
             fim = datetime.strptime(data_fim, '%Y-%m-%d').replace(hour=23, minute=59)
             query = query.filter(Venda.data.between(inicio, fim))
         except: pass
+    busca_cliente = request.args.get('cliente')
+    if busca_cliente: query = query.filter(Venda.cliente_id.in_(ids_busca('Cliente', busca_cliente)))
     status_filtro = request.args.get('status_filtro')
     hoje_date = datetime.now().date()
     if status_filtro == 'Pendentes': query = query.filter(Venda.status_pagamento != 'Pago')
@@ -546,10 +2433,34 @@ def vendas():
     elif status_filtro == 'Vencidas': query = query.filter(Venda.status_pagamento != 'Pago', Venda.data_vencimento < hoje_date)
     status_pagamento = request.args.get('status_pagamento')
     if status_pagamento and status_pagamento != 'Todos': query = query.filter(Venda.status_pagamento == status_pagamento)
-    todas_vendas = query.order_by(Venda.data.desc()).all()
-    vencimentos = Venda.query.filter(Venda.status_geral != 'Cancelada', Venda.status_pagamento != 'Pago', Venda.data_vencimento != None).order_by(Venda.data_vencimento).all()
-    canceladas = Venda.query.filter(Venda.status_geral == 'Cancelada').order_by(Venda.data.desc()).all()
-    return render_template('vendas.html', vendas=todas_vendas, vencimentos=vencimentos, canceladas=canceladas, clientes=clientes, produtos=produtos, hoje=datetime.now())
+    # Página de 50 vendas por cursor (data, id); detalhes e itens vêm de /api/vendas/<id> ao abrir o modal
+    try: todas_vendas, proximo = paginar_keyset(query, Venda.data, Venda.id, request.args.get('cursor'), 50)
+    except (ValueError, TypeError):
+        flash('Página inválida.', 'warning')
+        todas_vendas, proximo = paginar_keyset(query, Venda.data, Venda.id, None, 50)
+    url_proxima = url_for('vendas', **{**request.args.to_dict(), 'cursor': proximo}) if proximo else None
+    url_inicio = url_for('vendas', **{k: v for k, v in request.args.items() if k != 'cursor'}) if request.args.get('cursor') else None
+    # Vencimentos e canceladas: só os mais próximos/recentes (a carteira completa fica no relatório de contas a receber)
+    vencimentos = Venda.query.options(joinedload(Venda.cliente)).filter(Venda.status_geral != 'Cancelada', Venda.status_pagamento != 'Pago', Venda.data_vencimento != None) \
+        .order_by(Venda.data_vencimento).limit(100).all()
+    canceladas = Venda.query.options(joinedload(Venda.cliente)).filter(Venda.status_geral == 'Cancelada').order_by(Venda.data.desc()).limit(50).all()
+    return render_template('vendas.html', vendas=todas_vendas, url_proxima=url_proxima, url_inicio=url_inicio, vencimentos=vencimentos, canceladas=canceladas,
+                           clientes=clientes, produtos=produtos, hoje=datetime.now())
+
+def serializar_venda(v):
+    return {'id': v.id, 'cliente_id': v.cliente_id, 'cliente_nome': v.cliente.nome if v.cliente else '', 'data': v.data.strftime('%d/%m/%Y'),
+            'forma_pagamento': v.forma_pagamento, 'status_pgto': v.status_pagamento, 'status_nf': v.status_nf, 'num_nf': v.numero_nf or '',
+            'status_boleto': v.status_boleto or '', 'num_boleto': v.numero_boleto or '', 'status_envio': v.status_envio, 'status_geral': v.status_geral,
+            'data_vencimento': v.data_vencimento.strftime('%Y-%m-%d') if v.data_vencimento else '', 'valor_total': v.valor_total,
+            'total_formatado': currency_filter(v.valor_total), 'observacao': v.observacao or '',
+            'itens': [{'produto_id': i.produto_id, 'nome': i.produto.nome if i.produto else '', 'qtd': i.quantidade, 'valor_unitario': i.valor_unitario,
+                       'total': currency_filter(i.valor_total)} for i in v.itens]}
+
+@app.route('/api/vendas/<int:id>')
+def api_venda(id):
+    v = Venda.query.options(joinedload(Venda.cliente), selectinload(Venda.itens).joinedload(ItemVenda.produto)).filter(Venda.id == id).first()
+    if not v: return jsonify({'erro': 'Venda não encontrada.'}), 404
+    return jsonify(serializar_venda(v))
 
 # ... [Bloco de rotas CRUD vendas/estoque/pedidos mantido igual] ...
 @app.route('/cancelar_venda', methods=['POST'])
@@ -557,10 +2468,8 @@ def cancelar_venda():
     venda_id = request.form.get('venda_id')
     justificativa = request.form.get('justificativa')
     venda = Venda.query.get(venda_id)
-    if not venda: return redirect(url_for('vendas'))
-    for item in venda.itens:
-        produto = Produto.query.get(item.produto_id)
-        produto.quantidade += item.quantidade
+    if not venda or venda.status_geral == 'Cancelada': return redirect(url_for('vendas'))
+    alterar_estoque(somar_itens((i.produto_id, i.quantidade) for i in venda.itens), exigir_saldo=False)
     movs = Movimentacao.query.filter_by(numero_documento=f"V-{venda.id}").all()
     for m in movs:
         m.status = 'Cancelado'
@@ -569,7 +2478,9 @@ def cancelar_venda():
     venda.status_geral = 'Cancelada'
     venda.justificativa_cancelamento = justificativa
     registrar_log('Cancelamento Venda', f'Venda #{venda.id} cancelada.')
+    produtos = [i.produto_id for i in venda.itens]
     db.session.commit()
+    refazer_custo_produtos(produtos) # a movimentação alterada pode não ser a última: refaz o custo dos produtos afetados
     flash('Venda cancelada com sucesso.')
     return redirect(url_for('vendas'))
 
@@ -579,9 +2490,7 @@ def cancelar_pedido_saida():
     justificativa = request.form.get('justificativa')
     pedido = PedidoSaida.query.get(pedido_id)
     if not pedido or pedido.status == 'Cancelado': return redirect(url_for('saida_locacao'))
-    for item in pedido.itens:
-        produto = Produto.query.get(item.produto_id)
-        produto.quantidade += item.quantidade
+    alterar_estoque(somar_itens((i.produto_id, i.quantidade) for i in pedido.itens), exigir_saldo=False)
     pedido.status = 'Cancelado'
     pedido.justificativa_cancelamento = justificativa
     movs = Movimentacao.query.filter_by(pedido_id=pedido.id).all()
@@ -590,7 +2499,9 @@ def cancelar_pedido_saida():
         m.justificativa_cancelamento = justificativa
         m.observacao = (m.observacao or '') + f" [CANCELADO: {justificativa}]"
     registrar_log('Cancelamento Pedido', f'Pedido #{pedido.numero_pedido} cancelado.')
+    produtos = [i.produto_id for i in pedido.itens]
     db.session.commit()
+    refazer_custo_produtos(produtos) # a movimentação alterada pode não ser a última: refaz o custo dos produtos afetados
     flash('Pedido cancelado e estoque estornado.')
     return redirect(url_for('saida_locacao'))
 
@@ -600,17 +2511,18 @@ def cancelar_movimentacao():
     justificativa = request.form.get('justificativa')
     mov = Movimentacao.query.get(mov_id)
     if not mov or mov.status == 'Cancelado': return redirect(url_for('estoque'))
-    produto = Produto.query.get(mov.produto_id)
     if mov.tipo == 'Entrada':
-        if produto.quantidade < mov.quantidade:
+        if alterar_estoque({mov.produto_id: -mov.quantidade}):
+            db.session.rollback()
             flash(f'Erro: Estoque insuficiente para cancelar entrada.')
             return redirect(url_for('estoque'))
-        produto.quantidade -= mov.quantidade
-    else: produto.quantidade += mov.quantidade
+    else: alterar_estoque({mov.produto_id: mov.quantidade}, exigir_saldo=False)
     mov.status = 'Cancelado'
     mov.justificativa_cancelamento = justificativa
     mov.observacao = (mov.observacao or '') + " [CANCELADO]"
+    produto_id = mov.produto_id
     db.session.commit()
+    refazer_custo_produtos([produto_id]) # a movimentação alterada pode não ser a última: refaz o custo dos produtos afetados
     return redirect(url_for('estoque'))
 
 @app.route('/nova_venda', methods=['POST'])
@@ -626,20 +2538,24 @@ def nova_venda():
             observacao=request.form.get('observacao')
         )
         db.session.add(v)
-        db.session.commit() # Commita para gerar o ID da venda
+        db.session.flush() # Gera o ID da venda (tudo na mesma transação)
+        
+        itens = [(int(p_id), int(q), limpar_float(val)) for p_id, q, val in zip(request.form.getlist('produtos[]'), request.form.getlist('quantidades[]'), request.form.getlist('valores[]')) if p_id]
+        # Baixa atômica de todos os itens; se algum não tiver saldo, a venda inteira é desfeita
+        sem_saldo = alterar_estoque({p_id: -q for p_id, q in somar_itens((p_id, q) for p_id, q, _ in itens).items()})
+        if sem_saldo:
+            db.session.rollback()
+            flash(f'Estoque insuficiente: {nomes_produtos(sem_saldo)}', 'danger')
+            return redirect(url_for('vendas'))
         
         tot = 0
         # Processa os Itens
-        for p_id, q, val in zip(request.form.getlist('produtos[]'), request.form.getlist('quantidades[]'), request.form.getlist('valores[]')):
-            if p_id:
-                prod = Produto.query.get(int(p_id))
-                if prod.quantidade >= int(q):
-                    prod.quantidade -= int(q)
-                    vt = int(q) * limpar_float(val)
-                    tot += vt
-                    db.session.add(ItemVenda(venda_id=v.id, produto_id=int(p_id), quantidade=int(q), valor_unitario=limpar_float(val), valor_total=vt))
-                    # Movimentação de Estoque
-                    db.session.add(Movimentacao(produto_id=int(p_id), tipo='Venda', quantidade=int(q), destino_origem=v.cliente.nome, numero_documento=f"V-{v.id}"))
+        for p_id, q, val in itens:
+            vt = q * val
+            tot += vt
+            db.session.add(ItemVenda(venda_id=v.id, produto_id=p_id, quantidade=q, valor_unitario=val, valor_total=vt))
+            # Movimentação de Estoque
+            db.session.add(Movimentacao(produto_id=p_id, tipo='Venda', quantidade=q, destino_origem=v.cliente.nome, numero_documento=f"V-{v.id}"))
         
         v.valor_total = tot
         
@@ -657,6 +2573,7 @@ def nova_venda():
             banco_id=banco.id if banco else None, 
             data_vencimento=v.data_vencimento or datetime.now().date(),
             pago=False, # Entra como pendente
+            venda_id=v.id,
             observacao="Lançamento automático via Módulo de Vendas"
         )
         db.session.add(lanc)
@@ -702,9 +2619,129 @@ def atualizar_venda():
         if status_boleto == 'Boleto Feito': venda.numero_boleto = numero_boleto
     status_envio = request.form.get('status_envio')
     if status_envio: venda.status_envio = status_envio
+    sincronizar_lancamentos_vendas([(venda.id, venda.status_pagamento, venda.data_vencimento)])
     db.session.commit()
     return redirect(url_for('vendas'))
 
+VENDA_CAMPOS_LOTE = ('data_vencimento', 'forma_pagamento', 'status_pagamento', 'status_nf', 'numero_nf', 'status_boleto', 'numero_boleto', 'status_envio')
+VENDA_OPCOES = {
+    'forma_pagamento': ('PIX', 'BOLETO', 'LOCACAO', 'CARTAO', 'DINHEIRO'), 'status_pagamento': ('Pendente', 'Pago'),
+    'status_nf': ('Falta NF', 'NF Feita', 'Recibo Simples'), 'status_boleto': ('Falta Boleto', 'Boleto Feito'), 'status_envio': ('Falta Enviar', 'Enviado'),
+}
+
+def aplicar_alteracao_venda(atual, alt):
+    # Mesmas regras do modal de atualizar_venda sobre um dicionário com as colunas de VENDA_CAMPOS_LOTE; ValueError se a alteração for inválida
+    desconhecidos = set(alt) - set(VENDA_CAMPOS_LOTE)
+    if desconhecidos: raise ValueError(f"campo(s) não permitido(s): {', '.join(sorted(desconhecidos))}")
+    for campo, opcoes in VENDA_OPCOES.items():
+        if alt.get(campo) and alt[campo] not in opcoes: raise ValueError(f"{campo} inválido: {alt[campo]}")
+    novo = dict(atual)
+    if alt.get('data_vencimento'): novo['data_vencimento'] = datetime.strptime(alt['data_vencimento'], '%Y-%m-%d').date()
+    forma = alt.get('forma_pagamento')
+    if forma and forma != novo['forma_pagamento']:
+        novo['forma_pagamento'] = forma
+        if forma != 'BOLETO': novo['status_boleto'] = novo['numero_boleto'] = None
+        elif not novo['status_boleto']: novo['status_boleto'] = 'Falta Boleto'
+    if alt.get('status_pagamento'): novo['status_pagamento'] = alt['status_pagamento']
+    if alt.get('numero_nf'): novo['numero_nf'] = str(alt['numero_nf']).strip()
+    if alt.get('status_nf'):
+        if alt['status_nf'] == 'NF Feita' and not novo['numero_nf']: raise ValueError('NF Feita exige numero_nf')
+        novo['status_nf'] = alt['status_nf']
+    if alt.get('status_boleto') or alt.get('numero_boleto'):
+        if novo['forma_pagamento'] != 'BOLETO': raise ValueError('boleto só se aplica a vendas com forma de pagamento BOLETO')
+        if alt.get('numero_boleto'): novo['numero_boleto'] = str(alt['numero_boleto']).strip()
+        if alt.get('status_boleto'): novo['status_boleto'] = alt['status_boleto']
+        if novo['status_boleto'] == 'Boleto Feito' and not novo['numero_boleto']: raise ValueError('Boleto Feito exige numero_boleto')
+    if alt.get('status_envio'): novo['status_envio'] = alt['status_envio']
+    return novo
+
+def sincronizar_lancamentos_vendas(vendas, pagamentos=None):
+    # vendas: (venda_id, status_pagamento, data_vencimento). A receita automática (venda_id) acompanha pagamento e vencimento;
+    # pagamentos: {venda_id: data} com a data da baixa informada (padrão: hoje, sem sobrescrever uma baixa já registrada)
+    hoje, pagamentos = datetime.now().date(), pagamentos or {}
+    linhas = [{'p_venda': v_id, 'p_pago': pgto == 'Pago', 'p_vencimento': venc, 'p_data': pagamentos.get(v_id, hoje)} for v_id, pgto, venc in vendas]
+    if not linhas: return
+    t = LancamentoFinanceiro.__table__
+    pago = bindparam('p_pago', type_=db.Boolean)
+    db.session.execute(update(t).where(t.c.venda_id == bindparam('p_venda')).values(
+        pago=pago, data_vencimento=func.coalesce(bindparam('p_vencimento', type_=db.Date), t.c.data_vencimento),
+        data_pagamento=case((pago, func.coalesce(t.c.data_pagamento, bindparam('p_data', type_=db.Date))), else_=None)), linhas)
+
+@app.route('/api/vendas/lote', methods=['POST'])
+def api_vendas_lote():
+    # Fechamento do mês em uma requisição: {"alteracoes": {"status_nf": "NF Feita", ...}, "vendas": [{"id", "numero_nf", "numero_boleto", "data_pagamento", ...}],
+    # "tudo_ou_nada": false}. "alteracoes" vale para todas as vendas e os campos de cada linha têm precedência; vendas inválidas voltam em "erros".
+    dados = request.get_json(silent=True)
+    if not isinstance(dados, dict): return jsonify({'erro': 'Envie um objeto JSON.'}), 400
+    linhas, comum = dados.get('vendas'), dados.get('alteracoes') or {}
+    if not isinstance(linhas, list) or not linhas or not isinstance(comum, dict): return jsonify({'erro': 'Envie uma lista "vendas" e, opcionalmente, um objeto "alteracoes".'}), 400
+    if len(linhas) > 1000: return jsonify({'erro': 'Máximo de 1000 vendas por requisição.'}), 400
+
+    erros, validas, vistos = [], [], set()
+    for n, linha in enumerate(linhas):
+        try:
+            alt = {**comum, **(linha if isinstance(linha, dict) else {'id': linha})}
+            venda_id = int(alt.pop('id'))
+            if venda_id in vistos: raise ValueError(f'venda {venda_id} repetida no lote')
+            vistos.add(venda_id)
+            data_pagamento = alt.pop('data_pagamento', None)
+            validas.append((n, venda_id, alt, datetime.strptime(data_pagamento, '%Y-%m-%d').date() if data_pagamento else None))
+        except (KeyError, TypeError, ValueError) as e:
+            erros.append({'indice': n, 'erro': f'Linha inválida: {e}'})
+
+    # Estado atual de todas as vendas do lote em uma consulta IN
+    atuais = {r[0]: r for r in db.session.execute(select(Venda.id, Venda.status_geral, *[getattr(Venda, c) for c in VENDA_CAMPOS_LOTE])
+                                                   .where(Venda.id.in_([v_id for _, v_id, _, _ in validas])))}
+    aceitas = []
+    for n, venda_id, alt, data_pagamento in validas:
+        atual = atuais.get(venda_id)
+        if not atual: erros.append({'indice': n, 'erro': f'Venda {venda_id} não encontrada'}); continue
+        if atual[1] == 'Cancelada': erros.append({'indice': n, 'erro': f'Venda {venda_id} está cancelada'}); continue
+        antes = dict(zip(VENDA_CAMPOS_LOTE, atual[2:]))
+        try: novo = aplicar_alteracao_venda(antes, alt)
+        except (TypeError, ValueError) as e: erros.append({'indice': n, 'erro': f'Venda {venda_id}: {e}'}); continue
+        aceitas.append((venda_id, novo, novo != antes, data_pagamento, antes))
+    erros.sort(key=lambda e: e['indice'])
+    if not aceitas or (erros and dados.get('tudo_ou_nada')):
+        return jsonify({'atualizadas': [], 'sem_alteracao': [], 'erros': erros}), 422
+
+    try:
+        # Um UPDATE por chave primária (executemany), condicionado aos valores lidos acima (controle otimista): uma alteração
+        # gravada por outra tela entre a leitura e a escrita não é sobrescrita e a venda volta como conflito em "erros".
+        # Vendas sem alteração passam pelo mesmo UPDATE (grava os mesmos valores) só para confirmar que ainda estão como lidas.
+        t = Venda.__table__
+        db.session.execute(update(t).where(t.c.id == bindparam('p_id'), t.c.status_geral != 'Cancelada',
+                                           *[t.c[c].is_not_distinct_from(bindparam(f'a_{c}')) for c in VENDA_CAMPOS_LOTE])
+                           .values(**{c: bindparam(f'p_{c}') for c in VENDA_CAMPOS_LOTE}),
+                           [{'p_id': v_id, **{f'p_{c}': novo[c] for c in VENDA_CAMPOS_LOTE}, **{f'a_{c}': antes[c] for c in VENDA_CAMPOS_LOTE}}
+                            for v_id, novo, _, _, antes in aceitas])
+        # Quem não ficou com os valores novos teve a linha alterada no meio do caminho
+        gravadas = {r[0]: dict(zip(VENDA_CAMPOS_LOTE, r[1:])) for r in db.session.execute(select(Venda.id, *[getattr(Venda, c) for c in VENDA_CAMPOS_LOTE])
+                                                                                          .where(Venda.id.in_([a[0] for a in aceitas])))}
+        conflitos = {v_id for v_id, novo, _, _, _ in aceitas if gravadas.get(v_id) != novo}
+        if conflitos:
+            indices = {v_id: n for n, v_id, _, _ in validas}
+            erros.extend({'indice': indices[v_id], 'erro': f'Venda {v_id} foi alterada por outro usuário durante a atualização; recarregue e tente de novo'}
+                         for v_id in sorted(conflitos))
+            erros.sort(key=lambda e: e['indice'])
+            if dados.get('tudo_ou_nada'):
+                db.session.rollback()
+                return jsonify({'atualizadas': [], 'sem_alteracao': [], 'erros': erros}), 409
+            aceitas = [a for a in aceitas if a[0] not in conflitos]
+        alteradas = [(v_id, novo) for v_id, novo, mudou, _, _ in aceitas if mudou]
+        sincronizar_lancamentos_vendas([(v_id, novo['status_pagamento'], novo['data_vencimento']) for v_id, novo, _, _, _ in aceitas],
+                                       {v_id: data for v_id, _, _, data, _ in aceitas if data})
+        # O UPDATE em lote não passa pelo flush: o snapshot de KPIs (pagamento/vencimento) é refeito na próxima leitura
+        invalidar_kpis()
+        registrar_log('Vendas em Lote', f'{len(alteradas)} vendas atualizadas, {len(aceitas) - len(alteradas)} sem alteração, {len(erros)} rejeitadas.')
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Erro atualizacao de vendas em lote: {e}")
+        return jsonify({'erro': f'Falha ao gravar o lote: {e}', 'atualizadas': [], 'sem_alteracao': [], 'erros': erros}), 500
+    AGING_TTL.limpar(); RESUMO_CLIENTE_TTL.limpar()
+    return jsonify({'atualizadas': [v_id for v_id, _ in alteradas], 'sem_alteracao': [v_id for v_id, _, mudou, _, _ in aceitas if not mudou], 'erros': erros})
+
 @app.route('/receber_pedido_compra/<int:id>')
 def receber_pedido_compra(id):
     p = PedidoCompra.query.get(id)
@@ -712,12 +2749,11 @@ def receber_pedido_compra(id):
         p.status = 'Entregue'
         
         # Atualiza Estoque (Entrada dos itens)
+        alterar_estoque(somar_itens((i.produto_id, i.quantidade) for i in p.itens if i.produto_id), exigir_saldo=False)
         for i in p.itens:
             if i.produto_id:
-                prod = Produto.query.get(i.produto_id)
-                prod.quantidade += i.quantidade
                 db.session.add(Movimentacao(
-                    produto_id=prod.id, 
+                    produto_id=i.produto_id, 
                     tipo='Entrada', 
                     quantidade=i.quantidade, 
                     destino_origem=p.fornecedor.nome, 
@@ -788,6 +2824,9 @@ def excluir_produto(id):
     p = Produto.query.get(id)
     if p and p.quantidade == 0:
         Movimentacao.query.filter_by(produto_id=id).delete()
+        FechamentoEstoque.query.filter_by(produto_id=id).delete()
+        ConsumoProdutoMensal.query.filter_by(produto_id=id).delete()
+        CustoPendente.query.filter_by(produto_id=id).delete()
         db.session.delete(p)
         db.session.commit()
     return redirect(url_for('estoque'))
@@ -798,21 +2837,18 @@ def ajustar_estoque():
     tipo = request.form['tipo_ajuste']
     qtd = int(request.form['quantidade'])
     obs = request.form.get('observacao_ajuste')
-    produto = Produto.query.get(produto_id)
     if tipo == 'Entrada':
         custo = limpar_float(request.form.get('valor_pago'))
         if custo <= 0:
             flash('ERRO: Para entrada de estoque, o Valor Unitário é obrigatório e deve ser maior que zero.')
             return redirect(url_for('estoque'))
-        total = produto.quantidade * produto.valor_pago + qtd * custo
-        produto.quantidade += qtd
-        if produto.quantidade > 0: produto.valor_pago = total / produto.quantidade
-        db.session.add(Movimentacao(produto_id=produto.id, tipo='Entrada', categoria_movimento=request.form.get('origem_tipo'), numero_documento=request.form.get('numero_documento'), quantidade=qtd, valor_unitario_entrada=custo, destino_origem=request.form.get('fornecedor'), observacao=obs))
+        if not entrada_estoque(produto_id, qtd, custo): return redirect(url_for('estoque'))
+        db.session.add(Movimentacao(produto_id=produto_id, tipo='Entrada', categoria_movimento=request.form.get('origem_tipo'), numero_documento=request.form.get('numero_documento'), quantidade=qtd, valor_unitario_entrada=custo, destino_origem=request.form.get('fornecedor'), observacao=obs))
     elif tipo == 'Saida':
-        if produto.quantidade >= qtd:
-            produto.quantidade -= qtd
-            db.session.add(Movimentacao(produto_id=produto.id, tipo='Ajuste_Saida', categoria_movimento='Ajuste Manual', quantidade=qtd, destino_origem='Ajuste', observacao=obs))
+        if not alterar_estoque({produto_id: -qtd}):
+            db.session.add(Movimentacao(produto_id=produto_id, tipo='Ajuste_Saida', categoria_movimento='Ajuste Manual', quantidade=qtd, destino_origem='Ajuste', observacao=obs))
         else:
+            db.session.rollback()
             flash('Erro: Estoque insuficiente.')
             return redirect(url_for('estoque'))
     db.session.commit()
@@ -825,47 +2861,293 @@ def editar_entrada():
     nova_qtd = int(request.form.get('nova_qtd'))
     mov = Movimentacao.query.get(mov_id)
     if not mov or mov.tipo != 'Entrada': return redirect(url_for('estoque'))
-    produto = Produto.query.get(mov.produto_id)
-    custo_total_atual = produto.quantidade * produto.valor_pago
-    custo_total_sem_mov = custo_total_atual - (mov.quantidade * mov.valor_unitario_entrada)
-    qtd_sem_mov = produto.quantidade - mov.quantidade
-    nova_qtd_estoque = qtd_sem_mov + nova_qtd
-    novo_custo_total = custo_total_sem_mov + (nova_qtd * novo_valor)
-    if nova_qtd_estoque > 0: produto.valor_pago = novo_custo_total / nova_qtd_estoque
-    else: produto.valor_pago = 0.0
-    produto.quantidade = nova_qtd_estoque
+    # Troca a entrada antiga pela nova no custo médio, em um único UPDATE condicional
+    t = Produto.__table__
+    delta = nova_qtd - mov.quantidade
+    nova_qtd_estoque = t.c.quantidade + delta
+    novo_custo_total = t.c.quantidade * t.c.valor_pago - mov.quantidade * (mov.valor_unitario_entrada or 0) + nova_qtd * novo_valor
+    linha = db.session.execute(update(t).where(t.c.id == mov.produto_id, nova_qtd_estoque >= 0).values(
+        quantidade=nova_qtd_estoque,
+        valor_pago=case((nova_qtd_estoque > 0, novo_custo_total / nova_qtd_estoque), else_=0.0)
+    ).returning(t.c.quantidade, t.c.minimo, t.c.ativo)).first()
+    if not linha:
+        db.session.rollback()
+        flash('Erro: Estoque insuficiente para reduzir a entrada.')
+        return redirect(url_for('estoque'))
+    _kpi_alertas_estoque([(*linha, delta)])
     mov.quantidade = nova_qtd
     mov.valor_unitario_entrada = novo_valor
+    produto_id = mov.produto_id
     db.session.commit()
+    refazer_custo_produtos([produto_id]) # a movimentação alterada pode não ser a última: refaz o custo dos produtos afetados
     return redirect(url_for('estoque'))
 
+# ==========================================
+#     IMPORTAÇÃO EM LOTE (XLSX / CSV)
+# ==========================================
+# Lê a planilha em streaming (openpyxl read-only / csv), valida linha a linha, deduplica pelo
+# nome contra um índice em memória e grava Produto + Movimentacao (Entrada) com inserts em lote,
+# um commit por bloco de linhas.
+
+COLUNAS_IMPORTACAO = {
+    'nome': 'nome', 'produto': 'nome', 'descricao': 'nome',
+    'categoria': 'categoria', 'marca': 'marca', 'compatibilidade': 'compatibilidade',
+    'minimo': 'minimo', 'estoque_minimo': 'minimo',
+    'valor_venda': 'valor_venda', 'preco_venda': 'valor_venda',
+    'observacao': 'observacao', 'obs': 'observacao',
+    'quantidade': 'quantidade', 'qtd': 'quantidade',
+    'valor_unitario': 'valor_unitario', 'valor_pago': 'valor_unitario', 'custo': 'valor_unitario', 'custo_unitario': 'valor_unitario',
+    'documento': 'documento', 'numero_documento': 'documento', 'nf': 'documento',
+    'fornecedor': 'fornecedor', 'origem': 'fornecedor',
+}
+
+def _normalizar_cabecalho(nome, colunas=COLUNAS_IMPORTACAO):
+    nome = unicodedata.normalize('NFKD', str(nome or '')).encode('ascii', 'ignore').decode().strip().lower()
+    return colunas.get(re.sub(r'[^a-z0-9]+', '_', nome).strip('_'))
+
+def _numero_planilha(valor, inteiro=False):
+    # Células XLSX já vêm numéricas; textos (CSV) seguem o formato brasileiro (1.234,56). Sem vírgula, o ponto só é
+    # separador de milhar em grupos de 3 dígitos (1.234); nos demais casos (3.5) é a casa decimal.
+    if isinstance(valor, (int, float)): numero = float(valor)
+    elif valor is None or str(valor).strip() == '': return None
+    else:
+        texto = str(valor).replace('R$', '').replace(' ', '')
+        if ',' in texto or re.fullmatch(r'-?\d{1,3}(\.\d{3})+', texto): texto = texto.replace('.', '').replace(',', '.')
+        try: numero = float(texto)
+        except ValueError: raise ValueError(f'Número inválido: {valor}')
+    if not inteiro: return numero
+    if not numero.is_integer(): raise ValueError(f'Número inteiro esperado: {valor}')
+    return int(numero)
+
+def _texto_planilha(valor):
+    return str(valor).strip() if valor is not None and str(valor).strip() != '' else None
+
+def linhas_planilha(arquivo, colunas=COLUNAS_IMPORTACAO):
+    # Gera (numero_linha, dict) a partir de um arquivo .xlsx ou .csv sem carregar tudo em memória
+    nome = (arquivo.filename or '').lower()
+    if nome.endswith('.xlsx'):
+        wb = load_workbook(arquivo.stream, read_only=True, data_only=True)
+        try:
+            linhas = wb.worksheets[0].iter_rows(values_only=True)
+            cabecalho = [_normalizar_cabecalho(c, colunas) for c in next(linhas, [])]
+            for n, valores in enumerate(linhas, start=2):
+                if valores and any(v is not None and str(v).strip() != '' for v in valores):
+                    yield n, {c: v for c, v in zip(cabecalho, valores) if c}
+        finally: wb.close()
+    elif nome.endswith('.csv'):
+        texto = io.TextIOWrapper(arquivo.stream, encoding='utf-8-sig', newline='')
+        amostra = texto.read(4096); texto.seek(0)
+        try: dialeto = csv.Sniffer().sniff(amostra, delimiters=';,\t')
+        except csv.Error: dialeto = csv.excel
+        leitor = csv.reader(texto, dialeto)
+        cabecalho = [_normalizar_cabecalho(c, colunas) for c in next(leitor, [])]
+        for n, valores in enumerate(leitor, start=2):
+            if any(v.strip() for v in valores):
+                yield n, {c: v for c, v in zip(cabecalho, valores) if c}
+    else:
+        raise ValueError('Formato não suportado. Envie um arquivo .xlsx ou .csv.')
+
+def importar_estoque(arquivo, tamanho_lote=1000):
+    relatorio = {'linhas': 0, 'produtos_criados': 0, 'entradas': 0, 'ignoradas': 0, 'total_erros': 0, 'erros': []}
+    def erro(linha, msg):
+        relatorio['total_erros'] += 1
+        if len(relatorio['erros']) < 500: relatorio['erros'].append({'linha': linha, 'erro': msg})
+
+    # Índice em memória: nome normalizado -> id (saldo e custo ficam no banco e são atualizados no próprio UPDATE)
+    indice = {nome.strip().lower(): p_id for p_id, nome in db.session.query(Produto.id, Produto.nome)}
+
+    def gravar_lote(lote):
+        novos, entradas = {}, []
+        for n, d in lote:
+            chave = d['nome'].lower()
+            if chave not in indice and chave not in novos:
+                novos[chave] = {'nome': d['nome'], 'categoria': d['categoria'], 'marca': d['marca'], 'compatibilidade': d['compatibilidade'], 'quantidade': 0,
+                                'minimo': d['minimo'], 'valor_pago': 0.0, 'valor_venda': d['valor_venda'], 'observacao': d['observacao'], 'ativo': True}
+            elif not d['quantidade']:
+                relatorio['ignoradas'] += 1; erro(n, f"Produto já existe: {d['nome']}")
+            if d['quantidade']: entradas.append(d)
+        try:
+            if novos:
+                tp = Produto.__table__
+                for p_id, nome in db.session.execute(insert(tp).returning(tp.c.id, tp.c.nome), list(novos.values())):
+                    indice[nome.strip().lower()] = p_id
+                indexar_busca(db.session.connection(), {'Produto': [indice[chave] for chave in novos]})
+            movs, totais, agora = [], {}, datetime.now()
+            for d in entradas:
+                p_id = indice[d['nome'].lower()]
+                total = totais.setdefault(p_id, [0, 0.0]) # [Σqtd, Σqtd*custo] do bloco
+                total[0] += d['quantidade']; total[1] += d['quantidade'] * d['valor_unitario']
+                movs.append({'produto_id': p_id, 'tipo': 'Entrada', 'categoria_movimento': 'Importação', 'numero_documento': d['documento'], 'quantidade': d['quantidade'],
+                             'valor_unitario_entrada': d['valor_unitario'], 'destino_origem': d['fornecedor'], 'observacao': d['observacao'], 'data': agora, 'status': 'Ativo'})
+            if movs:
+                db.session.execute(insert(Movimentacao.__table__), movs)
+                atualizar_consumo_produtos(db.session.connection(), {(m['produto_id'], ano_mes(agora)) for m in movs})
+                marcar_custo_pendente(db.session.connection(), {m['produto_id'] for m in movs})
+                invalidar_custo_pagina(db.session.connection())
+                # Custo médio calculado contra a linha atual (como entrada_estoque): vendas e entradas gravadas durante a importação não se perdem
+                t = Produto.__table__
+                qtd_atual, custo_atual = func.coalesce(t.c.quantidade, 0), func.coalesce(t.c.valor_pago, 0.0)
+                nova_qtd = qtd_atual + bindparam('p_qtd')
+                db.session.execute(update(t).where(t.c.id == bindparam('p_id')).values(
+                    quantidade=nova_qtd,
+                    valor_pago=case((nova_qtd > 0, (qtd_atual * custo_atual + bindparam('p_valor')) / nova_qtd), else_=t.c.valor_pago)),
+                    [{'p_id': p_id, 'p_qtd': q, 'p_valor': v} for p_id, (q, v) in totais.items()])
+            db.session.commit()
+            relatorio['produtos_criados'] += len(novos)
+            relatorio['entradas'] += len(movs)
+        except Exception as e:
+            db.session.rollback()
+            for chave in novos: indice.pop(chave, None)
+            for n, _ in lote: erro(n, f'Falha ao gravar bloco: {e}')
+
+    lote = []
+    for n, bruto in linhas_planilha(arquivo):
+        relatorio['linhas'] += 1
+        try:
+            d = {'nome': _texto_planilha(bruto.get('nome')), 'categoria': _texto_planilha(bruto.get('categoria')), 'marca': _texto_planilha(bruto.get('marca')),
+                 'compatibilidade': _texto_planilha(bruto.get('compatibilidade')), 'observacao': _texto_planilha(bruto.get('observacao')),
+                 'documento': _texto_planilha(bruto.get('documento')), 'fornecedor': _texto_planilha(bruto.get('fornecedor')),
+                 'minimo': _numero_planilha(bruto.get('minimo'), inteiro=True), 'valor_venda': _numero_planilha(bruto.get('valor_venda')) or 0.0,
+                 'quantidade': _numero_planilha(bruto.get('quantidade'), inteiro=True) or 0, 'valor_unitario': _numero_planilha(bruto.get('valor_unitario')) or 0.0}
+        except ValueError as e: erro(n, str(e)); continue
+        if not d['nome']: erro(n, 'Nome do produto obrigatório.'); continue
+        if d['minimo'] is None: d['minimo'] = 5
+        if d['quantidade'] < 0: erro(n, 'Quantidade negativa.'); continue
+        if d['quantidade'] > 0 and d['valor_unitario'] <= 0: erro(n, 'Para entrada de estoque, o Valor Unitário é obrigatório e deve ser maior que zero.'); continue
+        lote.append((n, d))
+        if len(lote) >= tamanho_lote: gravar_lote(lote); lote = []
+    if lote: gravar_lote(lote)
+
+    # Inserts/updates em lote não passam pelo flush do ORM: o snapshot do dashboard é recalculado na próxima leitura
+    invalidar_kpis()
+    registrar_log('Importação Estoque', f"{relatorio['produtos_criados']} produtos criados, {relatorio['entradas']} entradas, {relatorio['total_erros']} erros.")
+    db.session.commit()
+    return relatorio
+
+@app.route('/api/importar_estoque', methods=['POST'])
+def api_importar_estoque():
+    arquivo = request.files.get('arquivo')
+    if not arquivo or arquivo.filename == '': return jsonify({'erro': 'Nenhum arquivo enviado.'}), 400
+    try: return jsonify(importar_estoque(arquivo))
+    except ValueError as e: return jsonify({'erro': str(e)}), 400
+    except Exception as e: db.session.rollback(); print(f"Erro importacao: {e}"); return jsonify({'erro': str(e)}), 500
+
 @app.route('/gerar_pedido_saida', methods=['POST'])
 def gerar_pedido_saida():
     cliente_id = int(request.form['cliente_id'])
     observacao = request.form.get('observacao')
-    impressora = request.form.get('impressora')
+    impressora_id, impressora = resolver_impressora(request.form.get('impressora_id'), request.form.get('impressora'))
     config = Configuracao.query.first()
     novo_numero = config.ultimo_pedido_id + 1
     config.ultimo_pedido_id = novo_numero
-    pedido = PedidoSaida(numero_pedido=novo_numero, cliente_id=cliente_id, observacao=observacao, impressora=impressora, status='Ativo')
+    pedido = PedidoSaida(numero_pedido=novo_numero, cliente_id=cliente_id, observacao=observacao, impressora=impressora, impressora_id=impressora_id, status='Ativo')
     db.session.add(pedido)
-    produtos_ids = request.form.getlist('produtos[]')
-    quantidades = request.form.getlist('quantidades[]')
-    for p_id, qtd in zip(produtos_ids, quantidades):
-        if not p_id: continue
-        qtd = int(qtd)
-        produto = Produto.query.get(int(p_id))
-        if produto and produto.quantidade >= qtd:
-            produto.quantidade -= qtd
-            db.session.add(ItemPedido(pedido=pedido, produto=produto, quantidade=qtd))
-            db.session.add(Movimentacao(produto_id=produto.id, tipo='Saida_Locacao', categoria_movimento='Pedido Saída', numero_documento=str(novo_numero), quantidade=qtd, destino_origem=pedido.cliente.nome, observacao=f'Pedido #{novo_numero} - {impressora}', pedido_id=pedido.id))
-        else:
-            db.session.rollback()
-            flash(f'Estoque insuficiente: {produto.nome}')
-            return redirect(url_for('saida_locacao'))
+    db.session.flush()
+    itens = [(int(p_id), int(qtd)) for p_id, qtd in zip(request.form.getlist('produtos[]'), request.form.getlist('quantidades[]')) if p_id]
+    sem_saldo = alterar_estoque({p_id: -qtd for p_id, qtd in somar_itens(itens).items()})
+    if sem_saldo:
+        db.session.rollback()
+        flash(f'Estoque insuficiente: {nomes_produtos(sem_saldo)}')
+        return redirect(url_for('saida_locacao'))
+    for p_id, qtd in itens:
+        db.session.add(ItemPedido(pedido=pedido, produto_id=p_id, quantidade=qtd))
+        db.session.add(Movimentacao(produto_id=p_id, tipo='Saida_Locacao', categoria_movimento='Pedido Saída', numero_documento=str(novo_numero), quantidade=qtd, destino_origem=pedido.cliente.nome, observacao=f'Pedido #{novo_numero} - {impressora}', pedido_id=pedido.id))
     db.session.commit()
     return redirect(url_for('saida_locacao'))
 
+@app.route('/api/pedidos_saida/lote', methods=['POST'])
+def api_pedidos_saida_lote():
+    # Despacho em lote: {"pedidos": [{"cliente_id", "impressora_id" ou "impressora", "observacao", "itens": [{"produto_id", "quantidade"}]}], "tudo_ou_nada": false}
+    # Pedidos inválidos ou sem saldo são devolvidos em "erros" (pelo índice); os demais são gravados numa única transação.
+    dados = request.get_json(silent=True)
+    pedidos = dados.get('pedidos') if isinstance(dados, dict) else None
+    if not isinstance(pedidos, list) or not pedidos: return jsonify({'erro': 'Envie uma lista "pedidos".'}), 400
+    if len(pedidos) > 1000: return jsonify({'erro': 'Máximo de 1000 pedidos por requisição.'}), 400
+
+    erros, validos = [], []
+    for n, p in enumerate(pedidos):
+        try:
+            itens = somar_itens((int(i['produto_id']), int(i['quantidade'])) for i in p.get('itens') or [])
+            if not itens: raise ValueError('pedido sem itens')
+            if any(q <= 0 for q in itens.values()): raise ValueError('quantidade deve ser maior que zero')
+            validos.append((n, {'cliente_id': int(p['cliente_id']), 'impressora_id': int(p['impressora_id']) if p.get('impressora_id') else None,
+                                'impressora': p.get('impressora'), 'observacao': p.get('observacao'), 'itens': itens}))
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            erros.append({'indice': n, 'erro': f'Pedido inválido: {e}'})
+
+    # Pré-carga: todos os clientes e produtos referenciados em uma consulta IN cada
+    clientes = dict(db.session.execute(select(Cliente.id, Cliente.nome).where(Cliente.id.in_({p['cliente_id'] for _, p in validos}))).all())
+    produtos = {p_id: [nome, qtd or 0] for p_id, nome, qtd in db.session.execute(
+        select(Produto.id, Produto.nome, Produto.quantidade).where(Produto.id.in_({p_id for _, p in validos for p_id in p['itens']}))).all()}
+
+    impressoras = {imp.id: imp for imp in Impressora.query.filter(Impressora.id.in_({p['impressora_id'] for _, p in validos if p['impressora_id']}))}
+    seriais = mapa_seriais() if any(p['impressora'] and not p['impressora_id'] for _, p in validos) else {}
+
+    # Reserva em memória, na ordem recebida: um pedido sem saldo não consome o estoque dos seguintes
+    aceitos = []
+    for n, p in validos:
+        if p['cliente_id'] not in clientes: erros.append({'indice': n, 'erro': f"Cliente {p['cliente_id']} não encontrado"}); continue
+        if p['impressora_id']:
+            if p['impressora_id'] not in impressoras: erros.append({'indice': n, 'erro': f"Impressora {p['impressora_id']} não encontrada"}); continue
+            p['impressora'] = texto_impressora(impressoras[p['impressora_id']])
+        elif p['impressora']: p['impressora_id'] = _impressora_do_texto(p['impressora'], seriais)
+        faltando = [p_id for p_id in p['itens'] if p_id not in produtos]
+        if faltando: erros.append({'indice': n, 'erro': f'Produto(s) não encontrado(s): {faltando}'}); continue
+        sem_saldo = [produtos[p_id][0] for p_id, q in p['itens'].items() if produtos[p_id][1] < q]
+        if sem_saldo: erros.append({'indice': n, 'erro': f"Estoque insuficiente: {', '.join(sem_saldo)}"}); continue
+        for p_id, q in p['itens'].items(): produtos[p_id][1] -= q
+        aceitos.append((n, p))
+    erros.sort(key=lambda e: e['indice'])
+    if not aceitos or (erros and dados.get('tudo_ou_nada')):
+        return jsonify({'criados': [], 'erros': erros}), 422
+
+    try:
+        # Baixa de estoque condicional (um UPDATE); se outro usuário consumiu o saldo nesse meio tempo, nada é gravado
+        total = {}
+        for _, p in aceitos:
+            for p_id, q in p['itens'].items(): total[p_id] = total.get(p_id, 0) - q
+        sem_saldo = alterar_estoque(total)
+        if sem_saldo:
+            db.session.rollback()
+            return jsonify({'erro': f'Estoque alterado durante o despacho ({nomes_produtos(sem_saldo)}). Reenvie o lote.', 'criados': [], 'erros': erros}), 409
+
+        # Números de pedido reservados em bloco
+        t_cfg = Configuracao.__table__
+        ultimo = db.session.execute(update(t_cfg).where(t_cfg.c.id == db.session.execute(select(func.min(t_cfg.c.id))).scalar())
+                                    .values(ultimo_pedido_id=func.coalesce(t_cfg.c.ultimo_pedido_id, 0) + len(aceitos)).returning(t_cfg.c.ultimo_pedido_id)).scalar()
+        if ultimo is None: raise ValueError('Configuração não encontrada')
+        agora = datetime.now()
+        numeros = range(ultimo - len(aceitos) + 1, ultimo + 1)
+        t_ped = PedidoSaida.__table__
+        linhas = db.session.execute(insert(t_ped).returning(t_ped.c.id, t_ped.c.numero_pedido, sort_by_parameter_order=True), [
+            {'numero_pedido': num, 'cliente_id': p['cliente_id'], 'data': agora, 'impressora': p['impressora'], 'impressora_id': p['impressora_id'], 'observacao': p['observacao'], 'status': 'Ativo'}
+            for num, (_, p) in zip(numeros, aceitos)]).all()
+
+        itens, movs, criados = [], [], []
+        for (pedido_id, num), (n, p) in zip(linhas, aceitos):
+            for p_id, q in p['itens'].items():
+                itens.append({'pedido_id': pedido_id, 'produto_id': p_id, 'quantidade': q})
+                movs.append({'produto_id': p_id, 'tipo': 'Saida_Locacao', 'categoria_movimento': 'Pedido Saída', 'numero_documento': str(num), 'quantidade': q, 'data': agora,
+                             'destino_origem': clientes[p['cliente_id']], 'observacao': f"Pedido #{num} - {p['impressora']}", 'pedido_id': pedido_id, 'status': 'Ativo', 'valor_unitario_entrada': 0.0})
+            criados.append({'indice': n, 'pedido_id': pedido_id, 'numero_pedido': num})
+        db.session.execute(insert(ItemPedido.__table__), itens)
+        db.session.execute(insert(Movimentacao.__table__), movs)
+
+        # Inserts em lote não passam pelo flush: rollups, índice de busca, custo pendente e custo por página são atualizados aqui
+        conexao = db.session.connection()
+        atualizar_consumo_produtos(conexao, {(p_id, ano_mes(agora)) for p_id in total})
+        atualizar_consumo_clientes(conexao, {(p['cliente_id'], ano_mes(agora)) for _, p in aceitos})
+        indexar_busca(conexao, {'PedidoSaida': [c['pedido_id'] for c in criados]})
+        marcar_custo_pendente(conexao, total)
+        invalidar_custo_pagina(conexao)
+        registrar_log('Despacho em Lote', f'{len(criados)} pedidos de saída gerados (#{numeros[0]} a #{numeros[-1]}), {len(erros)} rejeitados.')
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Erro despacho em lote: {e}")
+        return jsonify({'erro': f'Falha ao gravar o lote: {e}', 'criados': [], 'erros': erros}), 500
+    return jsonify({'criados': criados, 'erros': erros})
+
 @app.route('/get_pedido_json/<int:id>')
 def get_pedido_json(id):
     pedido = PedidoSaida.query.get_or_404(id)
@@ -878,28 +3160,26 @@ def salvar_edicao_pedido():
         pedido_id = request.form.get('pedido_id')
         pedido = PedidoSaida.query.get(pedido_id)
         if not pedido: return redirect(url_for('saida_locacao'))
-        for item in pedido.itens:
-            prod = Produto.query.get(item.produto_id)
-            prod.quantidade += item.quantidade
-        ItemPedido.query.filter_by(pedido_id=pedido.id).delete()
-        Movimentacao.query.filter_by(pedido_id=pedido.id).delete()
+        devolvidos = somar_itens((item.produto_id, item.quantidade) for item in pedido.itens)
+        # Exclusões pelo ORM (não em lote) para o flush atualizar o consumo mensal dos meses/produtos antigos
+        pedido.itens.clear()
+        for mov in Movimentacao.query.filter_by(pedido_id=pedido.id): db.session.delete(mov)
         pedido.cliente_id = int(request.form['cliente_id'])
-        pedido.impressora = request.form['impressora']
+        pedido.impressora_id, pedido.impressora = resolver_impressora(request.form.get('impressora_id'), request.form.get('impressora'))
         pedido.observacao = request.form['observacao']
         pedido.data = datetime.strptime(request.form['data'], '%Y-%m-%d')
-        p_ids = request.form.getlist('produtos[]')
-        qtds = request.form.getlist('quantidades[]')
-        for p_id, qtd in zip(p_ids, qtds):
-            if not p_id: continue
-            qtd = int(qtd)
-            prod = Produto.query.get(int(p_id))
-            if prod.quantidade >= qtd:
-                prod.quantidade -= qtd
-                db.session.add(ItemPedido(pedido=pedido, produto=prod, quantidade=qtd))
-                db.session.add(Movimentacao(produto_id=prod.id, tipo='Saida_Locacao', categoria_movimento='Pedido Editado', numero_documento=str(pedido.numero_pedido), quantidade=qtd, destino_origem=pedido.cliente.nome, observacao=f"Edição Pedido #{pedido.numero_pedido}", pedido_id=pedido.id))
-            else:
-                db.session.rollback()
-                return redirect(url_for('saida_locacao'))
+        itens = [(int(p_id), int(qtd)) for p_id, qtd in zip(request.form.getlist('produtos[]'), request.form.getlist('quantidades[]')) if p_id]
+        # Saldo líquido por produto (devolução dos itens antigos - novos itens) em um único UPDATE condicional
+        variacoes = dict(devolvidos)
+        for p_id, qtd in somar_itens(itens).items(): variacoes[p_id] = variacoes.get(p_id, 0) - qtd
+        sem_saldo = alterar_estoque(variacoes)
+        if sem_saldo:
+            db.session.rollback()
+            flash(f'Estoque insuficiente: {nomes_produtos(sem_saldo)}')
+            return redirect(url_for('saida_locacao'))
+        for p_id, qtd in itens:
+            db.session.add(ItemPedido(pedido=pedido, produto_id=p_id, quantidade=qtd))
+            db.session.add(Movimentacao(produto_id=p_id, tipo='Saida_Locacao', categoria_movimento='Pedido Editado', numero_documento=str(pedido.numero_pedido), quantidade=qtd, destino_origem=pedido.cliente.nome, observacao=f"Edição Pedido #{pedido.numero_pedido}", pedido_id=pedido.id))
         db.session.commit()
     except Exception as e: db.session.rollback()
     return redirect(url_for('saida_locacao'))
@@ -911,6 +3191,8 @@ def salvar_cliente():
     if c_id:
         c = Cliente.query.get(int(c_id))
         for k, v in dados.items(): setattr(c, k, v)
+        # O nome exibido nas impressoras acompanha o cadastro (o vínculo é pelo id)
+        for imp in Impressora.query.filter_by(cliente_id=c.id): imp.localizacao = c.nome
     else: db.session.add(Cliente(**dados))
     db.session.commit()
     return redirect(url_for('clientes'))
@@ -918,7 +3200,7 @@ def salvar_cliente():
 @app.route('/excluir_cliente/<int:id>')
 def excluir_cliente(id):
     c = Cliente.query.get(id)
-    if c and not c.pedidos: db.session.delete(c); db.session.commit()
+    if c and not c.pedidos and not Impressora.query.filter_by(cliente_id=id).first(): db.session.delete(c); db.session.commit()
     return redirect(url_for('clientes'))
 
 @app.route('/imprimir_pedido/<int:id>')
@@ -932,13 +3214,9 @@ def impressoras():
     status = request.args.get('status')
     cliente_id = request.args.get('cliente_id')
     query = Impressora.query
-    if busca:
-        term = f"%{busca}%"
-        query = query.filter((Impressora.marca.like(term)) | (Impressora.modelo.like(term)) | (Impressora.serial.like(term)) | (Impressora.mlt.like(term)) | (Impressora.localizacao.like(term)))
+    if busca: query = query.filter(Impressora.id.in_(ids_busca('Impressora', busca)))
     if status and status != 'Todas': query = query.filter(Impressora.status == status)
-    if cliente_id and cliente_id != 'Todos':
-        cliente = Cliente.query.get(int(cliente_id))
-        if cliente: query = query.filter(Impressora.localizacao == cliente.nome)
+    if cliente_id and cliente_id != 'Todos': query = query.filter(Impressora.cliente_id == int(cliente_id))
     impressoras = query.order_by(Impressora.modelo).all()
     clientes = Cliente.query.order_by(Cliente.nome).all()
     ultimas_movimentacoes = MovimentacaoImpressora.query.order_by(MovimentacaoImpressora.data.desc()).limit(20).all()
@@ -985,6 +3263,7 @@ def movimentar_impressora():
 
         status_novo = 'Disponível'
         local_novo = 'Estoque'
+        cliente = None
         if tipo_movimentacao == 'Locação':
             status_novo = 'Locada'
             if cliente_id:
@@ -994,9 +3273,11 @@ def movimentar_impressora():
             status_novo = 'Manutenção'
             local_novo = 'Assistência Técnica'
             
-        nova_mov = MovimentacaoImpressora(impressora_id=imp.id, tipo=tipo_movimentacao, data=datetime.now(), origem=imp.localizacao, destino=local_novo, contador_momento=contador_atual, observacao=observacao)
+        origem = imp.localizacao
+        origem_cliente_id = mover_impressora_local(imp, cliente, local_novo)
+        nova_mov = MovimentacaoImpressora(impressora_id=imp.id, tipo=tipo_movimentacao, data=datetime.now(), origem=origem, destino=local_novo, origem_cliente_id=origem_cliente_id,
+                                          destino_cliente_id=imp.cliente_id, contador_momento=contador_atual, observacao=observacao)
         imp.status = status_novo
-        imp.localizacao = local_novo
         imp.contador = contador_atual
         db.session.add(nova_mov)
         db.session.commit()
@@ -1032,13 +3313,10 @@ def adicionar_log_manutencao():
 
 @app.route('/api/impressoras_cliente/<int:cliente_id>')
 def api_impressoras_cliente(cliente_id):
-    cliente = Cliente.query.get(cliente_id)
-    if not cliente: return jsonify([])
-    impressoras = Impressora.query.filter_by(status='Locada', localizacao=cliente.nome).all()
+    impressoras = Impressora.query.filter_by(cliente_id=cliente_id, status='Locada').all()
     lista = []
     for imp in impressoras:
-        mlt_texto = imp.mlt if imp.mlt else "S/M"
-        display = f"{imp.modelo} | S/N: {imp.serial} | MLT: {mlt_texto}"
+        display = texto_impressora(imp)
         lista.append({'id': imp.id, 'modelo': imp.modelo, 'serial': imp.serial, 'mlt': imp.mlt, 'texto_display': display})
     return jsonify(lista)
 
@@ -1164,6 +3442,65 @@ def api_pedido_compra(id):
     data = {'id': p.id, 'fornecedor_id': p.fornecedor_id, 'fornecedor_nome': p.fornecedor.nome, 'data_emissao': p.data_emissao.strftime('%Y-%m-%d'), 'data_entrega': p.data_entrega_prevista.strftime('%Y-%m-%d') if p.data_entrega_prevista else '', 'prazo': p.prazo_pagamento, 'frete': p.frete, 'valor_itens': p.valor_itens, 'valor_total': p.valor_total, 'observacao': p.observacao, 'status': p.status, 'itens': itens}
     return jsonify(data)
 
+@app.route('/aprovar_pedido_compra/<int:id>')
+def aprovar_pedido_compra(id):
+    pedido = PedidoCompra.query.get(id)
+    if pedido and pedido.status == 'Rascunho': pedido.status = 'Pendente'; db.session.commit(); flash('Rascunho aprovado: pedido Pendente.')
+    return redirect(url_for('fornecedores', tab='pedidos'))
+
+def _previsao_registros(previsao):
+    # DataFrame -> lista de dicts com tipos nativos (inf/NaN viram None) para jsonify/template
+    return previsao.replace([np.inf, -np.inf], np.nan).astype(object).where(lambda d: d.notna(), None).to_dict('records')
+
+@app.route('/compras_sugeridas')
+def compras_sugeridas():
+    # "O que comprar esta semana": sugestões agrupadas por fornecedor
+    previsao = prever_demanda()
+    comprar = previsao[previsao['sugerido'] > 0] if not previsao.empty else previsao
+    nomes = dict(db.session.query(Fornecedor.id, Fornecedor.nome).all())
+    grupos = []
+    if not comprar.empty:
+        for f_id, grupo in comprar.groupby(comprar['fornecedor_id'].fillna(0)):
+            grupos.append({'fornecedor': nomes.get(int(f_id), 'Sem fornecedor (sem compra anterior)'), 'fornecedor_id': int(f_id) or None,
+                           'itens': _previsao_registros(grupo.sort_values('cobertura_semanas')), 'total': float(grupo['valor_sugerido'].sum())})
+    grupos.sort(key=lambda g: (g['fornecedor_id'] is None, -g['total']))
+    rascunhos = PedidoCompra.query.filter_by(status='Rascunho').options(joinedload(PedidoCompra.fornecedor)).all()
+    return render_template('compras_sugeridas.html', grupos=grupos, rascunhos=rascunhos, total_itens=len(comprar),
+                           valor_total=float(comprar['valor_sugerido'].sum()) if not comprar.empty else 0.0, cobertura=PREVISAO_COBERTURA)
+
+@app.route('/api/previsao_demanda')
+def api_previsao_demanda():
+    previsao = prever_demanda()
+    if request.args.get('apenas_comprar') and not previsao.empty: previsao = previsao[previsao['sugerido'] > 0]
+    return jsonify({'itens': _previsao_registros(previsao)})
+
+@app.route('/gerar_rascunhos_compra', methods=['POST'])
+def gerar_rascunhos_compra_rota():
+    try:
+        pedidos = gerar_rascunhos_compra(prever_demanda())
+        flash(f'{len(pedidos)} rascunho(s) de pedido de compra gerado(s).')
+    except Exception as e: db.session.rollback(); flash(f'Erro ao gerar rascunhos: {e}')
+    return redirect(url_for('compras_sugeridas'))
+
+@app.route('/aplicar_minimos_sugeridos', methods=['POST'])
+def aplicar_minimos_sugeridos():
+    # Grava o ponto de pedido calculado como Produto.minimo (dos produtos marcados, ou de todos com consumo)
+    try:
+        previsao = prever_demanda()
+        selecionados = {int(i) for i in request.form.getlist('produto_ids[]') if i}
+        if selecionados: previsao = previsao[previsao['id'].isin(selecionados)]
+        previsao = previsao[(previsao['consumo_semanal'] > 0) & (previsao['minimo_sugerido'] != previsao['minimo'])]
+        if not previsao.empty:
+            t = Produto.__table__
+            db.session.execute(update(t).where(t.c.id == bindparam('p_id')).values(minimo=bindparam('p_minimo')),
+                               [{'p_id': int(r.id), 'p_minimo': int(r.minimo_sugerido)} for r in previsao.itertuples()])
+            invalidar_kpis()
+        registrar_log('Sugestão de Compras', f'Mínimo recalculado para {len(previsao)} produtos.')
+        db.session.commit()
+        flash(f'Estoque mínimo atualizado em {len(previsao)} produto(s).')
+    except Exception as e: db.session.rollback(); flash(f'Erro ao aplicar mínimos: {e}')
+    return redirect(url_for('compras_sugeridas'))
+
 @app.route('/editar_movimentacao_historico', methods=['POST'])
 def editar_movimentacao_historico():
     try:
@@ -1183,15 +3520,9 @@ def editar_movimentacao_historico():
 
 @app.route('/api/historico_impressora/<int:id>')
 def api_historico_impressora(id):
-    movs = MovimentacaoImpressora.query.filter_by(impressora_id=id).all()
-    logs = LogManutencao.query.filter_by(impressora_id=id).all()
-    lista_unificada = []
-    for m in movs:
-        lista_unificada.append({'categoria': 'movimentacao', 'data_obj': m.data, 'data': m.data.strftime('%d/%m/%Y %H:%M'), 'tipo': m.tipo, 'origem': m.origem, 'destino': m.destino, 'contador': m.contador_momento, 'observacao': m.observacao})
-    for l in logs:
-        lista_unificada.append({'categoria': 'manutencao', 'data_obj': l.data, 'data': l.data.strftime('%d/%m/%Y %H:%M'), 'titulo': l.titulo, 'observacao': l.observacao})
-    lista_unificada.sort(key=lambda x: x['data_obj'], reverse=True)
-    return jsonify(lista_unificada)
+    # Histórico inteiro, já intercalado pelos índices; telas novas devem usar a linha do tempo paginada
+    itens, _ = linha_do_tempo(id, limite=None)
+    return jsonify(itens)
 
 # --- SUBSTITUIR NO app.py ---
 
@@ -1213,6 +3544,7 @@ def criar_impressora():
             modelo=modelo_final, # Salva o nome completo
             serial=request.form['serial'],
             mlt=request.form['mlt'],
+            endereco_ip=(request.form.get('endereco_ip') or '').strip() or None,
             contador=int(request.form['contador'] or 0),
             status='Disponível', 
             localizacao='Estoque',
@@ -1248,6 +3580,7 @@ def editar_impressora():
         impressora.modelo = request.form.get('modelo')
         impressora.serial = request.form.get('serial')
         impressora.mlt = request.form.get('mlt')
+        impressora.endereco_ip = (request.form.get('endereco_ip') or '').strip() or None
         impressora.observacao = request.form.get('observacao')
         
         # --- AQUI ESTÁ A CORREÇÃO ---
@@ -1272,34 +3605,139 @@ def editar_impressora():
 @app.route('/excluir_impressora/<int:id>')
 def excluir_impressora(id):
     imp = Impressora.query.get(id)
-    if imp: db.session.delete(imp); db.session.commit()
+    if imp:
+        PedidoSaida.query.filter_by(impressora_id=imp.id).update({'impressora_id': None})
+        LeituraContador.query.filter_by(impressora_id=imp.id).delete()
+        NivelToner.query.filter_by(impressora_id=imp.id).delete()
+        db.session.delete(imp); db.session.commit()
     return redirect(url_for('impressoras'))
 
 @app.route('/api/historico_completo/<int:id>')
 def api_historico_completo(id):
     try:
         impressora = Impressora.query.get_or_404(id)
-        movs = MovimentacaoImpressora.query.filter_by(impressora_id=id).order_by(MovimentacaoImpressora.data.desc()).all()
-        manutencoes = Manutencao.query.filter_by(impressora_id=id).order_by(Manutencao.numero_ordem.desc()).all()
-        insumos_lista = []
-        if impressora.serial:
-            pedidos_vinculados = PedidoSaida.query.filter(PedidoSaida.impressora.ilike(f'%{impressora.serial}%'), PedidoSaida.status != 'Cancelado').all()
-            ids_pedidos = [p.id for p in pedidos_vinculados]
-            if ids_pedidos:
-                movs_insumos = Movimentacao.query.filter(Movimentacao.pedido_id.in_(ids_pedidos), Movimentacao.tipo == 'Saida_Locacao', Movimentacao.status != 'Cancelado').order_by(Movimentacao.data.desc()).all()
-                for m in movs_insumos:
-                    insumos_lista.append({'data': m.data.strftime('%d/%m/%Y %H:%M'), 'produto': m.produto.nome, 'marca': m.produto.marca, 'qtd': m.quantidade, 'pedido': m.numero_documento})
-        lista_movs = []
-        for m in movs:
-            lista_movs.append({'data': m.data.strftime('%d/%m/%Y %H:%M'), 'tipo': m.tipo, 'origem': m.origem, 'destino': m.destino, 'contador': m.contador_momento, 'obs': m.observacao})
+        # Movimentações: primeira página da linha do tempo (as seguintes via /api/impressoras/<id>/linha_do_tempo?cursor=)
+        movs, proximo = linha_do_tempo(id, limite=50, fontes=('movimentacao',))
+        # O.S. e os registros técnicos de todas elas em uma consulta (selectinload), sem carregar m.logs uma a uma
+        manutencoes = Manutencao.query.options(selectinload(Manutencao.logs)).filter_by(impressora_id=id).order_by(Manutencao.numero_ordem.desc()).all()
+        insumos_lista = [{'data': d.strftime('%d/%m/%Y %H:%M'), 'produto': nome, 'marca': marca, 'qtd': qtd, 'pedido': doc}
+                         for d, _, nome, marca, qtd, doc, _ in insumos_impressora(impressora.id)]
+        lista_movs = [{'data': m['data'], 'tipo': m['tipo'], 'origem': m['origem'], 'destino': m['destino'], 'contador': m['contador'], 'obs': m['observacao']} for m in movs]
         lista_manut = []
         for m in manutencoes:
-            logs = []
-            for l in m.logs: logs.append({'data': l.data.strftime('%d/%m %H:%M'), 'titulo': l.titulo, 'obs': l.observacao})
+            logs = [{'data': l.data.strftime('%d/%m %H:%M'), 'titulo': l.titulo, 'obs': l.observacao} for l in m.logs]
             lista_manut.append({'numero': m.numero_ordem, 'inicio': m.data_inicio.strftime('%d/%m/%Y'), 'fim': m.data_fim.strftime('%d/%m/%Y') if m.data_fim else 'Em andamento', 'status': m.status_atual, 'motivo': m.motivo_inicial, 'logs': logs})
-        return jsonify({'movimentacoes': lista_movs, 'manutencoes': lista_manut, 'insumos': insumos_lista})
+        return jsonify({'movimentacoes': lista_movs, 'movimentacoes_proximo_cursor': proximo, 'manutencoes': lista_manut, 'insumos': insumos_lista})
     except Exception as e: return jsonify({'movimentacoes': [], 'manutencoes': [], 'insumos': []}), 500
 
+# ==========================================
+#          EXPORTAÇÃO (XLSX / CSV)
+# ==========================================
+# As consultas retornam tuplas simples lidas com yield_per (cursor no servidor), e as linhas
+# vão direto para um gerador CSV ou para um workbook openpyxl write-only: a memória não cresce
+# com o tamanho do período exportado.
+
+def _exp_movimentacoes(inicio, fim):
+    q = db.session.query(Movimentacao.id, Movimentacao.data, Movimentacao.tipo, Movimentacao.status, Produto.nome, Produto.marca, Movimentacao.quantidade,
+                         Movimentacao.valor_unitario_entrada, Movimentacao.categoria_movimento, Movimentacao.numero_documento, Movimentacao.destino_origem,
+                         Movimentacao.observacao, Movimentacao.justificativa_cancelamento).join(Produto, Movimentacao.produto_id == Produto.id)
+    if inicio: q = q.filter(Movimentacao.data >= inicio)
+    if fim: q = q.filter(Movimentacao.data < fim)
+    return q.order_by(Movimentacao.data, Movimentacao.id)
+
+def _exp_movimentacoes_impressoras(inicio, fim):
+    q = db.session.query(MovimentacaoImpressora.id, MovimentacaoImpressora.data, Impressora.modelo, Impressora.serial, Impressora.mlt, MovimentacaoImpressora.tipo,
+                         MovimentacaoImpressora.origem, MovimentacaoImpressora.destino, MovimentacaoImpressora.contador_momento, MovimentacaoImpressora.usuario,
+                         MovimentacaoImpressora.observacao).join(Impressora, MovimentacaoImpressora.impressora_id == Impressora.id)
+    if inicio: q = q.filter(MovimentacaoImpressora.data >= inicio)
+    if fim: q = q.filter(MovimentacaoImpressora.data < fim)
+    return q.order_by(MovimentacaoImpressora.data, MovimentacaoImpressora.id)
+
+def _exp_vendas(inicio, fim):
+    # Uma linha por item vendido, repetindo os dados da venda
+    q = db.session.query(Venda.id, Venda.data, Cliente.nome, Venda.status_geral, Venda.forma_pagamento, Venda.data_vencimento, Venda.status_pagamento,
+                         Venda.status_nf, Venda.numero_nf, Venda.status_boleto, Venda.numero_boleto, Venda.status_envio, Venda.valor_total,
+                         Produto.nome, ItemVenda.quantidade, ItemVenda.valor_unitario, ItemVenda.valor_total).join(Cliente, Venda.cliente_id == Cliente.id) \
+        .outerjoin(ItemVenda, ItemVenda.venda_id == Venda.id).outerjoin(Produto, ItemVenda.produto_id == Produto.id)
+    if inicio: q = q.filter(Venda.data >= inicio)
+    if fim: q = q.filter(Venda.data < fim)
+    return q.order_by(Venda.data, Venda.id, ItemVenda.id)
+
+def _exp_lancamentos(inicio, fim):
+    q = db.session.query(LancamentoFinanceiro.id, LancamentoFinanceiro.data_vencimento, LancamentoFinanceiro.data_pagamento, LancamentoFinanceiro.descricao,
+                         LancamentoFinanceiro.tipo, CategoriaFinanceira.nome, LancamentoFinanceiro.tipo_custo, Fornecedor.nome, Banco.nome_banco,
+                         LancamentoFinanceiro.valor, LancamentoFinanceiro.pago, LancamentoFinanceiro.forma_pagamento, LancamentoFinanceiro.parcela_atual,
+                         LancamentoFinanceiro.total_parcelas, LancamentoFinanceiro.observacao) \
+        .outerjoin(CategoriaFinanceira, LancamentoFinanceiro.categoria_id == CategoriaFinanceira.id) \
+        .outerjoin(Fornecedor, LancamentoFinanceiro.fornecedor_id == Fornecedor.id) \
+        .outerjoin(Banco, LancamentoFinanceiro.banco_id == Banco.id)
+    if inicio: q = q.filter(LancamentoFinanceiro.data_vencimento >= inicio.date())
+    if fim: q = q.filter(LancamentoFinanceiro.data_vencimento < fim.date())
+    return q.order_by(LancamentoFinanceiro.data_vencimento, LancamentoFinanceiro.id)
+
+def _exp_contas_receber(inicio, fim):
+    # Posição atual da carteira: o período não se aplica
+    return consulta_aging(datetime.now().date())
+
+EXPORTACOES = {
+    'movimentacoes': ('Movimentacoes_Estoque', ['ID', 'Data', 'Tipo', 'Status', 'Produto', 'Marca', 'Quantidade', 'Valor Unit. Entrada', 'Categoria',
+                                                'Documento', 'Origem/Destino', 'Observação', 'Justificativa Cancelamento'], _exp_movimentacoes),
+    'movimentacoes_impressoras': ('Movimentacoes_Impressoras', ['ID', 'Data', 'Modelo', 'Serial', 'MLT', 'Tipo', 'Origem', 'Destino', 'Contador',
+                                                                'Usuário', 'Observação'], _exp_movimentacoes_impressoras),
+    'vendas': ('Vendas', ['Venda', 'Data', 'Cliente', 'Status', 'Forma Pagamento', 'Vencimento', 'Pagamento', 'Status NF', 'Número NF', 'Status Boleto',
+                          'Número Boleto', 'Envio', 'Total Venda', 'Produto', 'Qtd', 'Valor Unit.', 'Total Item'], _exp_vendas),
+    'lancamentos': ('Lancamentos_Financeiros', ['ID', 'Vencimento', 'Pagamento', 'Descrição', 'Tipo', 'Categoria', 'Tipo Custo', 'Fornecedor', 'Banco',
+                                                'Valor', 'Pago', 'Forma Pagamento', 'Parcela', 'Total Parcelas', 'Observação'], _exp_lancamentos),
+    'contas_receber': ('Contas_a_Receber_Aging', ['ID Cliente', 'Cliente', 'Documento'] + [r for _, r in AGING_FAIXAS] + ['Total', 'Títulos', 'Vencimento Mais Antigo'],
+                       _exp_contas_receber),
+}
+
+def _valor_csv(v):
+    if v is None: return ''
+    if isinstance(v, datetime): return v.strftime('%d/%m/%Y %H:%M')
+    if isinstance(v, date): return v.strftime('%d/%m/%Y')
+    if isinstance(v, bool): return 'Sim' if v else 'Não'
+    if isinstance(v, float): return f'{v:.2f}'.replace('.', ',')
+    return v
+
+def _gerar_csv(cabecalho, query):
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer, delimiter=';')
+    escritor.writerow(cabecalho)
+    yield '\ufeff' + buffer.getvalue()
+    buffer.seek(0); buffer.truncate()
+    for i, linha in enumerate(query.yield_per(1000), start=1):
+        escritor.writerow([_valor_csv(v) for v in linha])
+        if i % 500 == 0:
+            yield buffer.getvalue()
+            buffer.seek(0); buffer.truncate()
+    buffer.seek(0)
+    yield buffer.getvalue()
+
+@app.route('/exportar/<tipo>')
+def exportar(tipo):
+    if tipo not in EXPORTACOES: return jsonify({'erro': 'Exportação desconhecida'}), 404
+    nome, cabecalho, montar_query = EXPORTACOES[tipo]
+    try:
+        inicio = datetime.strptime(request.args['data_inicio'], '%Y-%m-%d') if request.args.get('data_inicio') else None
+        fim = datetime.strptime(request.args['data_fim'], '%Y-%m-%d') + timedelta(days=1) if request.args.get('data_fim') else None
+    except ValueError: return jsonify({'erro': 'Data inválida (use AAAA-MM-DD)'}), 400
+    query = montar_query(inicio, fim)
+    arquivo = f"{nome}_{datetime.now().strftime('%Y%m%d_%H%M')}"
+
+    if request.args.get('formato') == 'xlsx':
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet(nome[:31])
+        ws.append(cabecalho)
+        for linha in query.yield_per(1000): ws.append(list(linha))
+        tmp = tempfile.TemporaryFile()
+        wb.save(tmp)
+        tmp.seek(0)
+        return send_file(tmp, as_attachment=True, download_name=f'{arquivo}.xlsx', mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+    return Response(stream_with_context(_gerar_csv(cabecalho, query)), mimetype='text/csv; charset=utf-8',
+                    headers={'Content-Disposition': f'attachment; filename={arquivo}.csv'})
+
 @app.route('/logs')
 def logs():
     logs_sistema = SystemLog.query.order_by(SystemLog.data.desc()).limit(100).all()
@@ -1314,7 +3752,37 @@ def salvar_configuracoes():
     return redirect(url_for('configuracoes'))
 
 @app.route('/configuracoes')
-def configuracoes(): return render_template('configuracoes.html')
+def configuracoes():
+    fechamentos = db.session.query(FechamentoEstoque.data_corte, func.count(FechamentoEstoque.id), func.sum(FechamentoEstoque.quantidade * FechamentoEstoque.custo_medio)).group_by(FechamentoEstoque.data_corte).order_by(FechamentoEstoque.data_corte.desc()).limit(12).all()
+    return render_template('configuracoes.html', fechamentos=fechamentos)
+
+@app.route('/fechar_estoque', methods=['POST'])
+def fechar_estoque_route():
+    try:
+        corte, total = fechar_estoque()
+        flash(f'Fechamento de estoque gravado ({total} produtos).', 'success')
+    except Exception as e: db.session.rollback(); flash(f'Erro no fechamento: {e}', 'danger')
+    return redirect(url_for('configuracoes'))
+
+@app.route('/recalcular_custos', methods=['POST'])
+def recalcular_custos_route():
+    try:
+        r = recalcular_custos(incremental=not request.form.get('completo'))
+        flash(f"Custo médio recalculado: {r['produtos']} produtos, {r['alterados']} corrigidos, {r['divergencias']} saldos divergentes do ledger.", 'success')
+    except Exception as e: db.session.rollback(); flash(f'Erro no recálculo de custos: {e}', 'danger')
+    return redirect(url_for('configuracoes'))
+
+@app.route('/api/estoque_em')
+def api_estoque_em():
+    # Saldo e valorização no fim do dia informado (?data=AAAA-MM-DD), opcionalmente para um produto
+    try:
+        data_alvo = datetime.strptime(request.args['data'], '%Y-%m-%d') + timedelta(days=1)
+        produto_id = request.args.get('produto_id')
+        saldos = estoque_em(data_alvo, [int(produto_id)] if produto_id else None)
+    except (KeyError, ValueError) as e: return jsonify({'erro': f'Parâmetro inválido: {e}'}), 400
+    nomes = dict(db.session.query(Produto.id, Produto.nome).filter(Produto.id.in_(list(saldos)))) if saldos else {}
+    itens = [{'produto_id': p_id, 'produto': nomes.get(p_id), 'quantidade': s['quantidade'], 'custo_medio': s['custo_medio'], 'valor': s['valor']} for p_id, s in sorted(saldos.items())]
+    return jsonify({'data': request.args['data'], 'itens': itens, 'quantidade_total': sum(i['quantidade'] for i in itens), 'valor_total': sum(i['valor'] for i in itens)})
 
 # --- ROTAS DE CONTRATOS ---
 
@@ -1388,8 +3856,9 @@ def criar_contrato():
                 imp = Impressora.query.get(imp_id)
                 if imp:
                     imp.status = 'Locada'
-                    imp.localizacao = cliente_obj.nome 
-                    db.session.add(MovimentacaoImpressora(impressora_id=imp.id, tipo='Locação', origem='Estoque', destino=cliente_obj.nome, contador_momento=imp.contador, observacao=f"Novo Contrato {novo_contrato.numero_contrato}"))
+                    origem_cliente_id = mover_impressora_local(imp, cliente_obj)
+                    db.session.add(MovimentacaoImpressora(impressora_id=imp.id, tipo='Locação', origem='Estoque', destino=cliente_obj.nome, origem_cliente_id=origem_cliente_id, destino_cliente_id=cliente_obj.id,
+                                                          contador_momento=imp.contador, observacao=f"Novo Contrato {novo_contrato.numero_contrato}"))
                     mlt_texto = f"MLT: {imp.mlt}" if imp.mlt else "S/M"
                     registrar_hist_contrato(novo_contrato.id, "Inclusão Item", f"Inclusão de {imp.modelo} ({mlt_texto} | S/N: {imp.serial})")
                 db.session.add(novo_item)
@@ -1447,7 +3916,7 @@ def editar_contrato():
             
             # Atualiza Status da Impressora
             imp.status = 'Disponível'
-            imp.localizacao = 'Estoque'
+            origem_cliente_id = mover_impressora_local(imp)
             
             # LOG NA IMPRESSORA (MOVIMENTAÇÃO)
             db.session.add(MovimentacaoImpressora(
@@ -1455,6 +3924,7 @@ def editar_contrato():
                 tipo='Estoque', # Tipo "Estoque" significa retorno
                 origem=cliente_antigo_nome,
                 destino='Estoque',
+                origem_cliente_id=origem_cliente_id,
                 contador_momento=imp.contador,
                 observacao=f"Removida do Contrato {contrato.numero_contrato}"
             ))
@@ -1546,7 +4016,7 @@ def editar_contrato():
                     # Se for NOVA neste contrato (estava no estoque ou outro lugar)
                     if imp_id in ids_adicionar:
                         imp.status = 'Locada'
-                        imp.localizacao = cliente_atual.nome
+                        origem_cliente_id = mover_impressora_local(imp, cliente_atual)
                         
                         # LOG NA IMPRESSORA
                         db.session.add(MovimentacaoImpressora(
@@ -1554,6 +4024,8 @@ def editar_contrato():
                             tipo='Locação', 
                             origem='Estoque', # Assumimos estoque, ou poderíamos pegar imp.localizacao anterior
                             destino=cliente_atual.nome, 
+                            origem_cliente_id=origem_cliente_id,
+                            destino_cliente_id=cliente_atual.id,
                             contador_momento=imp.contador, 
                             observacao=f"Inclusão no Contrato {contrato.numero_contrato}"
                         ))
@@ -1564,7 +4036,7 @@ def editar_contrato():
 
                     # Se já estava (MANTIDA), mas o cliente mudou (Transferência)
                     elif imp_id in ids_manter and cliente_mudou:
-                        imp.localizacao = cliente_atual.nome
+                        origem_cliente_id = mover_impressora_local(imp, cliente_atual)
                         
                         # LOG NA IMPRESSORA
                         db.session.add(MovimentacaoImpressora(
@@ -1572,6 +4044,8 @@ def editar_contrato():
                             tipo='Locação', 
                             origem=cliente_antigo_nome, 
                             destino=cliente_atual.nome, 
+                            origem_cliente_id=origem_cliente_id,
+                            destino_cliente_id=cliente_atual.id,
                             contador_momento=imp.contador, 
                             observacao=f"Transferência de Titularidade (Contrato {contrato.numero_contrato})"
                         ))
@@ -1619,7 +4093,7 @@ def cancelar_contrato_route():
             imp = item.impressora
             if imp:
                 imp.status = 'Disponível'
-                imp.localizacao = 'Estoque'
+                origem_cliente_id = mover_impressora_local(imp)
                 
                 # LOG NA IMPRESSORA
                 db.session.add(MovimentacaoImpressora(
@@ -1627,6 +4101,7 @@ def cancelar_contrato_route():
                     tipo='Estoque', 
                     origem=c.cliente.nome, 
                     destino='Estoque', 
+                    origem_cliente_id=origem_cliente_id,
                     contador_momento=imp.contador, 
                     observacao=f"Fim de Contrato: {justificativa}"
                 ))
@@ -1650,7 +4125,7 @@ def reativar_contrato(id):
         if conflito: flash('Erro: Algumas impressoras já foram locadas. Crie um novo contrato.')
         else:
             c.status = 'Ativo'; c.justificativa_cancelamento = None
-            for item in c.itens: item.impressora.status = 'Locada'; item.impressora.localizacao = c.cliente.nome
+            for item in c.itens: item.impressora.status = 'Locada'; mover_impressora_local(item.impressora, c.cliente)
             db.session.commit(); flash('Contrato reativado.')
     return redirect(url_for('contratos'))
 
@@ -1671,7 +4146,12 @@ def excluir_contrato(id):
 @app.route('/api/contrato_detalhes/<int:id>')
 def api_contrato_detalhes(id):
     try:
-        c = Contrato.query.get_or_404(id)
+        c = Contrato.query.options(selectinload(Contrato.itens).joinedload(ContratoItem.impressora), selectinload(Contrato.itens).joinedload(ContratoItem.franquia_pai)).get_or_404(id)
+        # Data da última devolução ao estoque de cada impressora devolvida, em uma consulta
+        devolvidas = [item.impressora_id for item in c.itens if item.impressora and item.impressora.status == 'Disponível']
+        devolucoes = dict(db.session.query(MovimentacaoImpressora.impressora_id, func.max(MovimentacaoImpressora.data))
+                          .filter(MovimentacaoImpressora.impressora_id.in_(devolvidas), MovimentacaoImpressora.destino == 'Estoque')
+                          .group_by(MovimentacaoImpressora.impressora_id)) if devolvidas else {}
         d_inicio = c.data_inicio.isoformat() if c.data_inicio else ""
         d_inicio_br = c.data_inicio.strftime('%d/%m/%Y') if c.data_inicio else ""
         d_fim = c.data_fim.isoformat() if c.data_fim else ""
@@ -1697,8 +4177,7 @@ def api_contrato_detalhes(id):
             if status_real == 'Manutenção': alerta_tipo = 'warning'; alerta_msg = 'EM MANUTENÇÃO'
             elif status_real == 'Disponível':
                 alerta_tipo = 'danger'; alerta_msg = 'DEVOLVIDA AO ESTOQUE'
-                ult_mov = MovimentacaoImpressora.query.filter_by(impressora_id=item.impressora.id, destino='Estoque').order_by(MovimentacaoImpressora.data.desc()).first()
-                if ult_mov: data_evento = ult_mov.data.strftime('%d/%m/%Y')
+                if devolucoes.get(imp_id): data_evento = devolucoes[imp_id].strftime('%d/%m/%Y')
 
             lista_imp.append({'id': item.id, 'impressora_id': imp_id, 'modelo': item.impressora.modelo if item.impressora else "Desc.", 'serial': serial_display, 'mlt': mlt_display, 'valor': item.valor_locacao_unitario, 'custo_nome': nome_custo, 'tipo_franquia': tipo_franq, 'detalhes_franquia': detalhes, 'alerta_tipo': alerta_tipo, 'alerta_msg': alerta_msg, 'data_evento': data_evento})
         
@@ -1718,11 +4197,16 @@ def api_contrato_historico_log(id):
 
 @app.route('/imprimir_contrato/<int:id>')
 def imprimir_contrato_view(id):
-    contrato = Contrato.query.get_or_404(id)
+    contrato = Contrato.query.options(selectinload(Contrato.itens).joinedload(ContratoItem.impressora), selectinload(Contrato.itens).joinedload(ContratoItem.franquia_pai)).get_or_404(id)
+    # Última locação de cada impressora para este cliente, por id (índice impressora_id, destino_cliente_id, data)
+    inclusoes = dict(db.session.query(MovimentacaoImpressora.impressora_id, func.max(MovimentacaoImpressora.data))
+                     .filter(MovimentacaoImpressora.impressora_id.in_([item.impressora_id for item in contrato.itens]),
+                             MovimentacaoImpressora.destino_cliente_id == contrato.cliente_id, MovimentacaoImpressora.tipo == 'Locação')
+                     .group_by(MovimentacaoImpressora.impressora_id))
     dados_itens = []
     for item in contrato.itens:
-        ultima_mov = MovimentacaoImpressora.query.filter_by(impressora_id=item.impressora_id, tipo='Locação', destino=contrato.cliente.nome).order_by(MovimentacaoImpressora.data.desc()).first()
-        data_add = ultima_mov.data.strftime('%d/%m/%Y') if ultima_mov else contrato.data_inicio.strftime('%d/%m/%Y')
+        ultima_inclusao = inclusoes.get(item.impressora_id)
+        data_add = ultima_inclusao.strftime('%d/%m/%Y') if ultima_inclusao else contrato.data_inicio.strftime('%d/%m/%Y')
         custo_nome = item.franquia_pai.nome if item.franquia_pai else None
         dados_itens.append({'modelo': item.impressora.modelo, 'serial': item.impressora.serial, 'data_inclusao': data_add, 'custo_nome': custo_nome, 'valor': item.valor_locacao_unitario})
     return render_template('imprimir_contrato.html', contrato=contrato, dados_itens=dados_itens, hoje=datetime.now().strftime('%d/%m/%Y %H:%M'))
@@ -1968,6 +4452,55 @@ def verificar_migracoes():
             print("Migrando Contrato Item...")
             try: db.session.execute(text('ALTER TABLE contrato_item ADD COLUMN tipo_franquia_item VARCHAR(20) DEFAULT "Individual"')); db.session.execute(text('ALTER TABLE contrato ADD COLUMN justificativa_cancelamento TEXT')); db.session.commit()
             except: pass
+        try: db.session.execute(text('SELECT impressora_id FROM pedido_saida LIMIT 1'))
+        except:
+            print("Migrando Pedido Saída (impressora_id)...")
+            try:
+                db.session.rollback()
+                db.session.execute(text('ALTER TABLE pedido_saida ADD COLUMN impressora_id INTEGER REFERENCES impressora(id)')); db.session.commit()
+                vinculados, total = vincular_pedidos_impressoras()
+                print(f"{vinculados} de {total} pedidos vinculados a impressoras.")
+            except Exception as e: db.session.rollback(); print(f"Erro migracao impressora_id: {e}")
+        try: db.session.execute(text('SELECT cliente_id FROM impressora LIMIT 1'))
+        except:
+            print("Migrando Impressora (cliente_id)...")
+            try:
+                db.session.rollback()
+                db.session.execute(text('ALTER TABLE impressora ADD COLUMN cliente_id INTEGER REFERENCES cliente(id)'))
+                db.session.execute(text('ALTER TABLE movimentacao_impressora ADD COLUMN origem_cliente_id INTEGER REFERENCES cliente(id)'))
+                db.session.execute(text('ALTER TABLE movimentacao_impressora ADD COLUMN destino_cliente_id INTEGER REFERENCES cliente(id)'))
+                db.session.commit()
+                impressoras, movs = vincular_locais_impressoras()
+                print(f"{impressoras} impressoras e {movs} movimentações vinculadas a clientes.")
+            except Exception as e: db.session.rollback(); print(f"Erro migracao cliente_id: {e}")
+        try: db.session.execute(text('SELECT endereco_ip FROM impressora LIMIT 1'))
+        except:
+            print("Migrando Impressora (endereco_ip)...")
+            try: db.session.rollback(); db.session.execute(text('ALTER TABLE impressora ADD COLUMN endereco_ip VARCHAR(60)')); db.session.commit()
+            except Exception as e: db.session.rollback(); print(f"Erro migracao endereco_ip: {e}")
+        try: db.session.execute(text('SELECT somente_total FROM leitura_contador LIMIT 1'))
+        except:
+            print("Migrando Leitura Contador (somente_total)...")
+            try: db.session.rollback(); db.session.execute(text('ALTER TABLE leitura_contador ADD COLUMN somente_total BOOLEAN DEFAULT 0')); db.session.commit()
+            except Exception as e: db.session.rollback(); print(f"Erro migracao somente_total: {e}")
+        try: db.session.execute(text('SELECT venda_id FROM lancamento_financeiro LIMIT 1'))
+        except:
+            print("Migrando Lançamento Financeiro (venda_id)...")
+            try:
+                db.session.rollback()
+                db.session.execute(text('ALTER TABLE lancamento_financeiro ADD COLUMN venda_id INTEGER REFERENCES venda(id)')); db.session.commit()
+                print(f"{vincular_lancamentos_vendas()} lançamentos vinculados às suas vendas.")
+            except Exception as e: db.session.rollback(); print(f"Erro migracao venda_id: {e}")
+        # Índices declarados nos models para tabelas já existentes (create_all não os cria em tabelas antigas)
+        for tabela in db.metadata.sorted_tables:
+            for indice in tabela.indexes:
+                try: indice.create(bind=db.engine, checkfirst=True)
+                except Exception as e: print(f"Erro ao criar indice {indice.name}: {e}")
+        # Backfill dos rollups de consumo na primeira execução com as novas tabelas
+        if not ConsumoProdutoMensal.query.first() and Movimentacao.query.first():
+            print("Reconstruindo consumo mensal..."); reconstruir_consumo()
+        if not db.session.execute(text('SELECT rowid FROM busca_global LIMIT 1')).first():
+            print("Construindo indice de busca..."); reconstruir_busca()
 
 if __name__ == '__main__':
     verificar_migracoes()
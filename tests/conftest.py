@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# Banco temporário: precisa estar definido antes de importar o app (a engine é criada no import)
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'teste.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
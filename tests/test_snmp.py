@@ -0,0 +1,114 @@
+import asyncio
+import threading
+from datetime import datetime
+
+import pytest
+
+from app import (app, db, verificar_migracoes, coletar_frota, coletar_snmp, importar_leituras, iniciar_simuladores, valores_simulados,
+                 AgenteSNMPSimulado, Impressora, LeituraContador, NivelToner)
+
+
+@pytest.fixture(scope='module')
+def banco():
+    verificar_migracoes()
+    with app.app_context():
+        yield db
+
+
+@pytest.fixture(scope='module')
+def simuladores():
+    # Agentes num loop próprio em outra thread: coletar_snmp abre o seu com asyncio.run
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    transportes = []
+    def iniciar(valores, **opcoes):
+        t, = asyncio.run_coroutine_threadsafe(iniciar_simuladores({0: valores}, **opcoes), loop).result()
+        transportes.append(t)
+        return t.get_extra_info('sockname')[1]
+    yield iniciar
+    for t in transportes: loop.call_soon_threadsafe(t.close)
+    loop.call_soon_threadsafe(loop.stop)
+
+
+class AgentePerdePrimeira(AgenteSNMPSimulado):
+    # Ignora a primeira requisição: força uma repetição determinística
+    recebidas = 0
+    def datagram_received(self, dados, endereco):
+        self.recebidas += 1
+        if self.recebidas > 1: super().datagram_received(dados, endereco)
+
+
+def coletar(agentes, **opcoes):
+    # agentes: [(fabrica do protocolo)] -> resultado de coletar_frota com um alvo por agente
+    async def rodar():
+        loop = asyncio.get_running_loop()
+        abertos = [await loop.create_datagram_endpoint(f, local_addr=('127.0.0.1', 0)) for f in agentes]
+        try:
+            alvos = [(n, '127.0.0.1', t.get_extra_info('sockname')[1]) for n, (t, _) in enumerate(abertos)]
+            return await coletar_frota(alvos, **opcoes), [p for _, p in abertos]
+        finally:
+            for t, _ in abertos: t.close()
+    return asyncio.run(rodar())
+
+
+def test_resposta_normal():
+    resultados, _ = coletar([lambda: AgenteSNMPSimulado(valores_simulados('ABC123', 1500, (80, 55, 30, 10)))])
+    r = resultados[0]
+    assert r['serial'] == 'ABC123' and r['contador'] == 1500 and r['tentativas'] == 1
+    assert [t['percentual'] for t in r['toners']] == [80.0, 55.0, 30.0, 10.0]
+    assert r['toners'][0]['descricao'] == 'Black Toner'
+
+
+def test_repete_apos_tempo_limite():
+    resultados, (agente,) = coletar([lambda: AgentePerdePrimeira(valores_simulados('REP1', 10))], tempo_limite=0.2, tentativas=2)
+    assert resultados[0]['tentativas'] == 2 and resultados[0]['contador'] == 10
+    assert agente.recebidas == 2
+
+
+def test_sem_resposta_esgota_tentativas():
+    valores = valores_simulados('LENTO', 10)
+    resultados, _ = coletar([lambda: AgenteSNMPSimulado(valores, perda=1.0), lambda: AgenteSNMPSimulado(valores, atraso=0.3)],
+                            tempo_limite=0.1, tentativas=1)
+    assert resultados[0] == {'erro': 'sem resposta após 2 tentativas'}
+    # Respostas atrasadas chegam com o request-id de uma tentativa já abandonada e são descartadas
+    assert 'erro' in resultados[1]
+
+
+def test_comunidade_errada_nao_responde():
+    resultados, _ = coletar([lambda: AgenteSNMPSimulado(valores_simulados('COM1', 10), comunidade='secreta')], tempo_limite=0.1, tentativas=0)
+    assert 'erro' in resultados[0]
+
+
+def test_serial_divergente_nao_grava(banco, simuladores):
+    porta = simuladores(valores_simulados('OUTRO', 5000))
+    imp = Impressora(modelo='Teste', serial='SERIAL1', contador=100, endereco_ip=f'127.0.0.1:{porta}')
+    db.session.add(imp); db.session.commit()
+    r = coletar_snmp([imp.id], tempo_limite=0.5)
+    assert r['respondidas'] == 1 and r['leituras_gravadas'] == 0 and r['suprimentos'] == 0
+    assert 'Serial do equipamento (OUTRO)' in r['falhas'][0]['erro']
+    assert LeituraContador.query.filter_by(impressora_id=imp.id).count() == 0
+    assert db.session.get(Impressora, imp.id).contador == 100
+
+
+def test_coleta_grava_leitura_e_toner(banco, simuladores):
+    porta = simuladores(valores_simulados('SERIAL2', 2000, (90, 40, 15, 5)))
+    imp = Impressora(modelo='Teste', serial='serial2', contador=1500, endereco_ip=f'127.0.0.1:{porta}')
+    db.session.add(imp); db.session.commit()
+    r = coletar_snmp([imp.id], tempo_limite=0.5)
+    assert r['falhas'] == [] and r['leituras_gravadas'] == 1 and r['suprimentos'] == 4
+    leitura = LeituraContador.query.filter_by(impressora_id=imp.id).one()
+    assert (leitura.origem, leitura.contador_pb, leitura.contador_cor, leitura.somente_total) == ('SNMP', 2000, 0, True)
+    assert db.session.get(Impressora, imp.id).contador == 2000
+    niveis = {t.indice: t.percentual for t in NivelToner.query.filter_by(impressora_id=imp.id)}
+    assert niveis == {1: 90.0, 2: 40.0, 3: 15.0, 4: 5.0}
+
+
+def test_total_snmp_valida_contra_pb_mais_cor(banco):
+    imp = Impressora(modelo='Teste', serial='SERIAL3', contador=0)
+    db.session.add(imp); db.session.commit()
+    r = importar_leituras([(1, {'impressora_id': imp.id, 'data': datetime(2026, 1, 10), 'contador_pb': 800, 'contador_cor': 200})], 'Planilha')
+    assert r['gravadas'] == 1
+    r = importar_leituras([(1, {'impressora_id': imp.id, 'data': datetime(2026, 1, 20), 'contador_total': 1100})], 'SNMP')
+    assert r['gravadas'] == 1 and r['erros'] == []
+    r = importar_leituras([(1, {'impressora_id': imp.id, 'data': datetime(2026, 1, 25), 'contador_total': 1050})], 'SNMP')
+    assert r['gravadas'] == 0 and 'menor' in r['erros'][0]['erro']